@@ -0,0 +1,227 @@
+"""
+Benchmark of the fused count-and-solve mode against the two-call flow of the two-stage approach.
+
+Both flows solve the recorded objects parsing results of the test set, through replay clients that return recorded
+responses after an injected latency: the two-call flow counts the objects (ObjectsCounter) and then solves the
+question (TwoStepGptVision), and the fused flow (FusedCountAndSolve) does both in one request, whose response is built
+from the recorded counting result and answer of the question. Every flow is run at several concurrency levels, and
+the vision requests, the images sent (and their estimated tokens), the prompt characters, the questions per second and
+the CPU time per question are reported, with the number of questions the local arithmetic solver answered.
+
+Run `python twostagegpt.py bench-fused` from the root directory.
+"""
+import argparse
+import json
+import logging
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional
+
+from benchmarks.replay_benchmark import BENCHMARK_IMAGE, TEST_SET_RESULTS, load_json_file
+from benchmarks.replay_client import ReplayOpenAIClient, ReplayVisionClient
+from conf.data_config import DataConfig
+from conf.gpt_4_vision_config import Gpt4VisionConfig
+from data_enums.image_data_enum import ImageDataEnum
+from experiments.two_step.fused_count_and_solve import (
+    COUNT_JSON_KEY, COUNTS_JSON_KEY, DESCRIPTION_JSON_KEY, OBJECT_JSON_KEY, TOTAL_OBJECTS_JSON_KEY, FusedCountAndSolve
+)
+from experiments.two_step.objects_counter import ObjectsCounter
+from experiments.two_step.two_step_gpt_vision import TwoStepGptVision
+from utils.answer_extraction import ANSWER_JSON_KEY, EXPLANATION_JSON_KEY
+from utils.counting_result_parser import parse_counting_result
+
+OBJECTS_PARSING_RESULTS = TEST_SET_RESULTS.joinpath("objects_parsing_results.json")
+OBJECT_COUNTING_RESULTS = TEST_SET_RESULTS.joinpath("object_counting_results.json")
+TWO_STEP_RESULTS = TEST_SET_RESULTS.joinpath("two_step_gpt_results_vision.json")
+DEFAULT_CONCURRENCY_LEVELS = (1, 8, 32)
+DEFAULT_LATENCY_MS = 20
+# The image tokens of a CLEVR render (480x320) by the image detail: a low detail image costs 85 tokens, and a high
+# detail image (also 'auto' for this size) is a single 512x512 tile, 85 + 170 tokens
+IMAGE_TOKENS_BY_DETAIL = {"low": 85, "high": 255, "auto": 255}
+
+
+@dataclass
+class FusedBenchmarkResult:
+    flow: str
+    concurrency: int
+    latency_ms: float
+    questions: int
+    vision_requests: int
+    images: int
+    estimated_image_tokens: int
+    prompt_characters: int
+    locally_solved_questions: int
+    wall_seconds: float
+    questions_per_second: float
+    cpu_ms_per_question: float
+
+
+def create_fused_response(counting_result: Optional[str], answer_result: dict) -> str:
+    """
+    The response of the fused request of a question, from its recorded counting result and answer.
+    """
+    parsed_counting_result = parse_counting_result(counting_result)
+    return json.dumps({
+        COUNTS_JSON_KEY: [
+            {OBJECT_JSON_KEY: entry.name, DESCRIPTION_JSON_KEY: entry.details, COUNT_JSON_KEY: entry.count}
+            for entry in parsed_counting_result.entries
+        ],
+        TOTAL_OBJECTS_JSON_KEY: parsed_counting_result.total_objects,
+        EXPLANATION_JSON_KEY: answer_result.get(ImageDataEnum.GPT_RESPONSE) or "",
+        ANSWER_JSON_KEY: answer_result.get(ImageDataEnum.NUMERICAL_RESULT),
+    })
+
+
+def create_vision_client(responses: dict[int, str], latency_ms: float, logger: logging.Logger):
+    replay_client = ReplayOpenAIClient(responses=responses, latency_seconds=latency_ms / 1000)
+    return ReplayVisionClient(config=Gpt4VisionConfig(), logger=logger, replay_client=replay_client), replay_client
+
+
+def run_flow(
+        flow: str,
+        concurrency: int,
+        latency_ms: float,
+        max_questions: Optional[int],
+        use_local_arithmetic_solver: bool
+) -> FusedBenchmarkResult:
+    logger = logging.getLogger("fused_benchmark")
+    counting_results = load_json_file(OBJECT_COUNTING_RESULTS)
+    answer_results = load_json_file(TWO_STEP_RESULTS)
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        data_config = DataConfig(use_local_arithmetic_solver=use_local_arithmetic_solver)
+        data_config.description_cache_file = Path(temp_directory).joinpath("description_cache.db")
+        data_config.dead_letters_file = Path(temp_directory).joinpath("dead_letters.jsonl")
+        data_config.objects_parsing_results_file = OBJECTS_PARSING_RESULTS
+
+        if flow == "fused":
+            gpt_client, replay_client = create_vision_client(
+                responses={
+                    int(question_index): create_fused_response(
+                        counting_result=counting_results.get(question_index, {}).get(ImageDataEnum.COUNTING_RESULT),
+                        answer_result=answer_results.get(question_index, {}),
+                    )
+                    for question_index in counting_results
+                },
+                latency_ms=latency_ms,
+                logger=logger,
+            )
+            replay_clients = [replay_client]
+            fused_solver = FusedCountAndSolve(data_config=data_config, gpt_client=gpt_client, logger=logger)
+            answering_solver = fused_solver
+            questions = list(fused_solver.load_questions().items())[:max_questions]
+
+            def solve(question_index: int, question_data: dict):
+                fused_solver.solve_question(question_index=question_index, question_data=question_data)
+        else:
+            counter_client, counter_replay_client = create_vision_client(
+                responses={
+                    int(question_index): question_result.get(ImageDataEnum.COUNTING_RESULT)
+                    for question_index, question_result in counting_results.items()
+                },
+                latency_ms=latency_ms,
+                logger=logger,
+            )
+            solver_client, solver_replay_client = create_vision_client(
+                responses={
+                    int(question_index): question_result.get(ImageDataEnum.GPT_RESPONSE)
+                    for question_index, question_result in answer_results.items()
+                },
+                latency_ms=latency_ms,
+                logger=logger,
+            )
+            replay_clients = [counter_replay_client, solver_replay_client]
+            objects_counter = ObjectsCounter(data_config=data_config, gpt_client=counter_client, logger=logger)
+            two_step_gpt = TwoStepGptVision(data_config=data_config, gpt_client=solver_client, logger=logger)
+            answering_solver = two_step_gpt
+            questions = list(objects_counter.load_questions().items())[:max_questions]
+
+            def solve(question_index: int, question_data: dict):
+                counting_result = objects_counter.solve_question(
+                    question_index=question_index,
+                    question_data=question_data
+                )
+                two_step_gpt.solve_question(question_index=question_index, question_data=counting_result)
+
+        for _, question_data in questions:
+            question_data[ImageDataEnum.IMAGE_PATH] = str(BENCHMARK_IMAGE)
+
+        def solve_question(question: tuple[str, dict]):
+            question_index, question_data = question
+            for replay_client in replay_clients:
+                replay_client.set_current_question(int(question_index))
+            solve(question_index=int(question_index), question_data=question_data)
+
+        start_cpu_time = time.process_time()
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(solve_question, questions))
+        wall_seconds = time.perf_counter() - start_time
+        cpu_seconds = time.process_time() - start_cpu_time
+
+    images_by_detail = sum((replay_client.images_by_detail for replay_client in replay_clients), start=Counter())
+    return FusedBenchmarkResult(
+        flow=flow,
+        concurrency=concurrency,
+        latency_ms=latency_ms,
+        questions=len(questions),
+        vision_requests=sum(replay_client.number_of_requests for replay_client in replay_clients),
+        images=sum(images_by_detail.values()),
+        estimated_image_tokens=sum(
+            IMAGE_TOKENS_BY_DETAIL[detail] * images for detail, images in images_by_detail.items()
+        ),
+        prompt_characters=sum(replay_client.prompt_characters for replay_client in replay_clients),
+        locally_solved_questions=answering_solver.locally_solved_questions,
+        wall_seconds=wall_seconds,
+        questions_per_second=len(questions) / wall_seconds,
+        cpu_ms_per_question=cpu_seconds * 1000 / len(questions),
+    )
+
+
+def format_result(result: FusedBenchmarkResult) -> str:
+    return (f"{result.flow:<9} concurrency {result.concurrency:>3}: {result.questions_per_second:8.1f} questions/sec, "
+            f"{result.cpu_ms_per_question:6.2f} CPU ms/question, "
+            f"{result.vision_requests / result.questions:.2f} vision requests/question, "
+            f"{result.estimated_image_tokens / result.questions:.0f} image tokens/question, "
+            f"{result.prompt_characters / result.questions:.0f} prompt characters/question, "
+            f"{result.locally_solved_questions} solved locally")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fused count-and-solve mode against the two-call "
+                                                 "flow, with recorded responses.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(DEFAULT_CONCURRENCY_LEVELS))
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_LATENCY_MS,
+                        help="The latency injected into every replayed request.")
+    parser.add_argument("--max-questions", type=int, default=None)
+    parser.add_argument("--no-local-arithmetic-solver", action="store_true",
+                        help="Always send the second request of the two-call flow, even when the counts are "
+                             "conclusive.")
+    parser.add_argument("--output", type=Path, default=None, help="Save the results as a json file.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = []
+    for concurrency in args.concurrency:
+        for flow in ("two_call", "fused"):
+            result = run_flow(
+                flow=flow,
+                concurrency=concurrency,
+                latency_ms=args.latency_ms,
+                max_questions=args.max_questions,
+                use_local_arithmetic_solver=not args.no_local_arithmetic_solver,
+            )
+            print(format_result(result))
+            results.append(result)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
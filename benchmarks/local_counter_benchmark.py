@@ -0,0 +1,153 @@
+"""
+Benchmark of the local object counter against the CLEVR scenes annotations.
+
+Every image of the scenes file (up to `--limit`) is counted locally, and its detected objects are compared with the
+annotated objects: the number of objects, every attribute (as the multiset of its values in the image) and the whole
+scene. The benchmark also reports how many images are above the confidence threshold (the images that skip the vision
+model) and how accurate they are, and the counting throughput.
+
+Run `python twostagegpt.py bench-local-counter --images-dir <CLEVR images directory>` from the root directory.
+"""
+import argparse
+import json
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional
+
+from conf.data_config import DataConfig
+from data_enums.clevr_descriptions_enum import ClevrDescriptionsEnum
+from experiments.two_step.local_object_counter import LocalCountingResult, LocalObjectCounter, load_image
+
+ATTRIBUTES = ("size", "color", "material", "shape")
+
+
+@dataclass
+class LocalCounterBenchmarkResult:
+    images: int
+    confidence_threshold: float
+    number_of_objects_accuracy: float
+    attributes_accuracy: dict[str, float]
+    scene_accuracy: float
+    confident_images_fraction: float
+    confident_scene_accuracy: Optional[float]
+    load_ms_per_image: float
+    count_ms_per_image: float
+    images_per_second: float
+
+
+@dataclass
+class ImageEvaluation:
+    number_of_objects_correct: bool
+    attributes_correct: dict[str, bool]
+    scene_correct: bool
+    confidence: float
+
+
+def evaluate_image(counting_result: LocalCountingResult, scene_objects: list[dict]) -> ImageEvaluation:
+    detected_objects = [detected_object.to_scene_object() for detected_object in counting_result.objects]
+
+    def get_values(objects: list[dict], attributes: tuple[str, ...]) -> Counter:
+        return Counter(tuple(scene_object[attribute] for attribute in attributes) for scene_object in objects)
+
+    return ImageEvaluation(
+        number_of_objects_correct=len(detected_objects) == len(scene_objects),
+        attributes_correct={
+            attribute: get_values(detected_objects, (attribute,)) == get_values(scene_objects, (attribute,))
+            for attribute in ATTRIBUTES
+        },
+        scene_correct=get_values(detected_objects, ATTRIBUTES) == get_values(scene_objects, ATTRIBUTES),
+        confidence=counting_result.confidence,
+    )
+
+
+def run_benchmark(
+        images_directory: Path,
+        scenes_file: Path,
+        confidence_threshold: float,
+        limit: Optional[int] = None
+) -> LocalCounterBenchmarkResult:
+    with open(scenes_file, "r") as f:
+        scenes = json.load(f)[ClevrDescriptionsEnum.SCENES][:limit]
+
+    local_object_counter = LocalObjectCounter()
+    evaluations = []
+    load_seconds = 0.0
+    count_seconds = 0.0
+    for scene in scenes:
+        start_time = time.perf_counter()
+        image = load_image(images_directory.joinpath(scene[ClevrDescriptionsEnum.IMAGE_ID]))
+        load_seconds += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        counting_result = local_object_counter.count(image)
+        count_seconds += time.perf_counter() - start_time
+        evaluations.append(evaluate_image(counting_result, scene_objects=scene[ClevrDescriptionsEnum.OBJECTS]))
+
+    def get_accuracy(results: list[bool]) -> Optional[float]:
+        return sum(results) / len(results) if results else None
+
+    confident_evaluations = [evaluation for evaluation in evaluations if evaluation.confidence >= confidence_threshold]
+    number_of_images = len(evaluations)
+    return LocalCounterBenchmarkResult(
+        images=number_of_images,
+        confidence_threshold=confidence_threshold,
+        number_of_objects_accuracy=get_accuracy([evaluation.number_of_objects_correct for evaluation in evaluations]),
+        attributes_accuracy={
+            attribute: get_accuracy([evaluation.attributes_correct[attribute] for evaluation in evaluations])
+            for attribute in ATTRIBUTES
+        },
+        scene_accuracy=get_accuracy([evaluation.scene_correct for evaluation in evaluations]),
+        confident_images_fraction=len(confident_evaluations) / number_of_images,
+        confident_scene_accuracy=get_accuracy([evaluation.scene_correct for evaluation in confident_evaluations]),
+        load_ms_per_image=load_seconds * 1000 / number_of_images,
+        count_ms_per_image=count_seconds * 1000 / number_of_images,
+        images_per_second=number_of_images / count_seconds,
+    )
+
+
+def format_result(result: LocalCounterBenchmarkResult) -> str:
+    def format_accuracy(accuracy: Optional[float]) -> str:
+        return "-" if accuracy is None else f"{accuracy:.1%}"
+
+    lines = [
+        f"Images: {result.images}",
+        f"Number of objects accuracy: {format_accuracy(result.number_of_objects_accuracy)}",
+        *(f"{attribute.capitalize()} accuracy: {format_accuracy(accuracy)}"
+          for attribute, accuracy in result.attributes_accuracy.items()),
+        f"Scene accuracy: {format_accuracy(result.scene_accuracy)}",
+        f"Images with confidence >= {result.confidence_threshold}: {result.confident_images_fraction:.1%}, "
+        f"scene accuracy: {format_accuracy(result.confident_scene_accuracy)}",
+        f"Load: {result.load_ms_per_image:.2f} ms/image, count: {result.count_ms_per_image:.2f} ms/image "
+        f"({result.images_per_second:.0f} images/s)",
+    ]
+    return "\n".join(lines)
+
+
+def main():
+    data_config = DataConfig()
+    parser = argparse.ArgumentParser(description="Benchmark the local object counter against the CLEVR scenes.")
+    parser.add_argument("--images-dir", type=Path, required=True, help="The directory of the CLEVR images.")
+    parser.add_argument("--scenes", type=Path, default=data_config.clevr_val_scenes,
+                        help="The CLEVR scenes file of the images.")
+    parser.add_argument("--limit", type=int, default=None, help="Benchmark only the first images of the scenes.")
+    parser.add_argument("--confidence-threshold", type=float,
+                        default=data_config.local_object_counter_confidence_threshold)
+    parser.add_argument("--output", type=Path, default=None, help="Save the results as a json file.")
+    args = parser.parse_args()
+
+    result = run_benchmark(
+        images_directory=args.images_dir,
+        scenes_file=args.scenes,
+        confidence_threshold=args.confidence_threshold,
+        limit=args.limit,
+    )
+    print(format_result(result))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(asdict(result), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
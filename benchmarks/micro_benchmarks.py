@@ -0,0 +1,246 @@
+"""
+Micro-benchmarks of the local per-question operations, that become the bottleneck when the API calls run concurrently.
+
+Every benchmark runs its operation once for every question of a synthetic split (`--questions`), built from the
+recorded results and the CLEVR images in the data directory, and reports the best time per question over several
+repeats. The results can be saved as a baseline and compared with a stored baseline.
+
+Run `python -m benchmarks.micro_benchmarks` from the root directory.
+Pass `--baseline benchmarks/baselines/micro_benchmarks.json` to compare the results with the stored baseline.
+"""
+import argparse
+import glob
+import itertools
+import json
+import logging
+import random
+import sys
+import tempfile
+import timeit
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
+
+from benchmarks.replay_client import DEFAULT_RESPONSE, ReplayOpenAIClient, ReplayVisionClient
+from conf.data_config import DataConfig
+from conf.gpt_4_vision_config import Gpt4VisionConfig
+from data_enums.clevr_math_labels_enum import ClevrMathLabelsEnum
+from data_enums.image_data_enum import ImageDataEnum
+from experiments.base_gpt_clevr_solver import BaseGptClevrSolver
+from experiments.one_step.oracle_one_step import OracleOneStep
+from gpt_clients.gpt4_vision_client import Gpt4VisionClient
+from utils.clevr_objects import COLORS, MATERIALS, SHAPES, SIZES, describe_scene
+from utils.question_manifest import QuestionManifest
+
+ROOT_DIRECTORY = Path(__file__).parent.parent
+RECORDED_RESULTS_FILES = sorted(glob.glob(str(ROOT_DIRECTORY.joinpath("data", "*_results", "*.json"))))
+BENCHMARK_IMAGES = (
+    ROOT_DIRECTORY.joinpath("data", "CLEVR_train_000000.png"),
+    ROOT_DIRECTORY.joinpath("data", "CLEVR_train_000006.png"),
+)
+# The number of questions of the synthetic split, the order of magnitude of a full CLEVR-math split
+DEFAULT_NUMBER_OF_QUESTIONS = 10000
+DEFAULT_REPEATS = 5
+DEFAULT_TOLERANCE = 0.3
+# CLEVR images have up to 10 objects
+MAX_OBJECTS_IN_SCENE = 10
+
+
+@dataclass
+class MicroBenchmarkResult:
+    name: str
+    questions: int
+    best_us_per_question: float
+    best_total_ms: float
+
+
+@dataclass
+class MicroBenchmark:
+    name: str
+    # Runs the operation for all the questions of the split
+    run: Callable[[], None]
+
+
+def load_recorded_results() -> list[dict]:
+    recorded_results = []
+    for results_file in RECORDED_RESULTS_FILES:
+        with open(results_file, "r") as f:
+            recorded_results.extend(json.load(f).values())
+    # The results of the questions (e.g. not of the object detection)
+    return [result for result in recorded_results if ImageDataEnum.LABEL in result]
+
+
+def create_random_scene(rng: random.Random, number_of_objects: int) -> list[dict]:
+    return [
+        {
+            "size": rng.choice(SIZES),
+            "color": rng.choice(COLORS),
+            "material": rng.choice(MATERIALS),
+            "shape": rng.choice(SHAPES),
+        }
+        for _ in range(number_of_objects)
+    ]
+
+
+class ImmediateVisionClient(ReplayVisionClient):
+    """
+    A vision client that returns the response without preparing the messages, to measure the solver code only.
+    """
+    def get_vision_model_responses(self, image_path: str, prompt: str, **kwargs) -> list[str]:
+        return [DEFAULT_RESPONSE]
+
+
+def create_micro_benchmarks(number_of_questions: int, temp_directory: Path) -> list[MicroBenchmark]:
+    """
+    Create the benchmarks, with synthetic inputs for number_of_questions questions.
+    """
+    rng = random.Random(0)
+    logger = logging.getLogger("micro_benchmarks")
+    recorded_results = load_recorded_results()
+    split_results = list(itertools.islice(itertools.cycle(recorded_results), number_of_questions))
+    image_paths = [str(BENCHMARK_IMAGES[index % len(BENCHMARK_IMAGES)]) for index in range(number_of_questions)]
+    prompts = [f"Answer the question: {result[ImageDataEnum.QUESTION]}" for result in split_results]
+    gpt_responses = [
+        result[ImageDataEnum.GPT_RESPONSE] for result in recorded_results if result.get(ImageDataEnum.GPT_RESPONSE)
+    ]
+
+    vision_client = ReplayVisionClient(
+        config=Gpt4VisionConfig(),
+        logger=logger,
+        replay_client=ReplayOpenAIClient(responses={}),
+    )
+
+    oracle_one_step = OracleOneStep(
+        data_config=DataConfig(use_description_cache=False),
+        gpt_client=ImmediateVisionClient(
+            config=Gpt4VisionConfig(),
+            logger=logger,
+            replay_client=ReplayOpenAIClient(responses={}),
+        ),
+        logger=logger,
+    )
+    image = SimpleNamespace(filename=image_paths[0])
+    question_manifest = QuestionManifest.from_rows([
+        {
+            ClevrMathLabelsEnum.TEMPLATE: result[ImageDataEnum.TEMPLATE],
+            ClevrMathLabelsEnum.QUESTION: result[ImageDataEnum.QUESTION],
+            ClevrMathLabelsEnum.IMAGE: image,
+            ClevrMathLabelsEnum.ID: result[ImageDataEnum.IMAGE_ID],
+            ClevrMathLabelsEnum.LABEL: result[ImageDataEnum.LABEL],
+        }
+        for result in split_results
+    ])
+    question_records = [question_manifest[question_index] for question_index in range(len(question_manifest))]
+    scenes = [create_random_scene(rng, rng.randint(3, MAX_OBJECTS_IN_SCENE)) for _ in range(number_of_questions)]
+
+    results_file = temp_directory.joinpath("results.json")
+    split_results_by_index = {question_index: result for question_index, result in enumerate(split_results)}
+
+    def encode_images():
+        for image_path in image_paths:
+            Gpt4VisionClient.encode_image(image_path)
+
+    def prepare_messages():
+        for image_path, prompt in zip(image_paths, prompts):
+            vision_client.prepare_messages(image_path=image_path, prompt=prompt)
+
+    def describe_scenes():
+        for question_record, image_scene in zip(question_records, scenes):
+            oracle_one_step.get_question_result_with_description(
+                question_record=question_record,
+                description=describe_scene(image_scene)
+            )
+
+    def extract_numeric_answers():
+        for gpt_response in itertools.islice(itertools.cycle(gpt_responses), number_of_questions):
+            BaseGptClevrSolver.extract_numeric_answer(gpt_response)
+
+    def save_json_file():
+        BaseGptClevrSolver.save_json_file(file_path=results_file, data=split_results_by_index)
+
+    return [
+        MicroBenchmark(name="encode_image", run=encode_images),
+        MicroBenchmark(name="prepare_messages", run=prepare_messages),
+        MicroBenchmark(name="oracle_one_step_scene_description", run=describe_scenes),
+        MicroBenchmark(name="extract_numeric_answer", run=extract_numeric_answers),
+        MicroBenchmark(name="save_json_file", run=save_json_file),
+    ]
+
+
+def run_micro_benchmark(
+        micro_benchmark: MicroBenchmark,
+        number_of_questions: int,
+        repeats: int
+) -> MicroBenchmarkResult:
+    best_total_seconds = min(timeit.repeat(micro_benchmark.run, repeat=repeats, number=1))
+    return MicroBenchmarkResult(
+        name=micro_benchmark.name,
+        questions=number_of_questions,
+        best_us_per_question=best_total_seconds * 1_000_000 / number_of_questions,
+        best_total_ms=best_total_seconds * 1000,
+    )
+
+
+def compare_with_baseline(
+        results: list[MicroBenchmarkResult],
+        baseline: list[dict],
+        tolerance: float
+) -> list[str]:
+    """
+    Get the benchmarks whose time per question grew by more than the tolerance (a fraction of the baseline time).
+    """
+    baseline_results = {result["name"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get(result.name)
+        if baseline_result is None:
+            continue
+        if result.best_us_per_question > baseline_result["best_us_per_question"] * (1 + tolerance):
+            regressions.append(f"{result.name}: {result.best_us_per_question:.2f} us/question, "
+                               f"baseline {baseline_result['best_us_per_question']:.2f}")
+    return regressions
+
+
+def format_result(result: MicroBenchmarkResult) -> str:
+    return (f"{result.name:<36} {result.best_us_per_question:10.2f} us/question "
+            f"({result.best_total_ms:.1f} ms for {result.questions} questions)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the local per-question operations.")
+    parser.add_argument("--questions", type=int, default=DEFAULT_NUMBER_OF_QUESTIONS,
+                        help="The number of questions of the synthetic split.")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--benchmarks", nargs="+", default=None, help="Run only these benchmarks.")
+    parser.add_argument("--output", type=Path, default=None, help="Save the results as a json file (a baseline).")
+    parser.add_argument("--baseline", type=Path, default=None, help="Compare the results with a baseline file.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = []
+    with tempfile.TemporaryDirectory() as temp_directory:
+        for micro_benchmark in create_micro_benchmarks(args.questions, temp_directory=Path(temp_directory)):
+            if args.benchmarks is not None and micro_benchmark.name not in args.benchmarks:
+                continue
+            result = run_micro_benchmark(micro_benchmark, number_of_questions=args.questions, repeats=args.repeats)
+            print(format_result(result))
+            results.append(result)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, tolerance=args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+"""
+End-to-end throughput benchmark of the experiments, with recorded responses instead of API calls.
+
+Every experiment stage solves the questions of its recorded input file (from data/test_set_results or
+data/validation_set_results), through a replay client that returns the recorded responses after an injected latency.
+Each stage is run at several concurrency levels, every run in a new process, and the questions per second, the CPU
+time and the peak RSS of each run are reported.
+
+Run `python -m benchmarks.replay_benchmark --output <results.json>` from the root directory.
+Pass `--baseline benchmarks/baselines/replay_benchmark.json` to compare the results with a stored baseline.
+"""
+import argparse
+import json
+import logging
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional
+
+from benchmarks.replay_client import ReplayLangClient, ReplayOpenAIClient, ReplayVisionClient
+from conf.data_config import DataConfig
+from conf.gpt4_lang_config import GPT4LangConfig
+from conf.gpt_4_vision_config import Gpt4VisionConfig
+from data_enums.clevr_descriptions_enum import ClevrDescriptionsEnum
+from data_enums.clevr_math_labels_enum import ClevrMathLabelsEnum
+from data_enums.image_data_enum import ImageDataEnum
+from experiments.base_gpt_clevr_solver import BaseGptClevrSolver
+from utils import tracing
+from utils.clevr_objects import COLORS, MATERIALS, SHAPES, SIZES
+from utils.question_manifest import QuestionManifest
+
+ROOT_DIRECTORY = Path(__file__).parent.parent
+TEST_SET_RESULTS = ROOT_DIRECTORY.joinpath("data", "test_set_results")
+VALIDATION_SET_RESULTS = ROOT_DIRECTORY.joinpath("data", "validation_set_results")
+BENCHMARK_IMAGE = ROOT_DIRECTORY.joinpath("data", "CLEVR_train_000000.png")
+DEFAULT_CONCURRENCY_LEVELS = (1, 8, 32)
+DEFAULT_LATENCY_MS = 20
+DEFAULT_TOLERANCE = 0.25
+
+
+@dataclass(frozen=True)
+class BenchmarkStage:
+    name: str
+    # "module:class" of the solver
+    solver_class: str
+    # "vision" or "lang"
+    client_type: str
+    # The recorded results file and field the responses of the stage are replayed from
+    responses_file: Path
+    response_field: str
+    # The solver attributes of the stage input files, and the recorded files they are pointed to
+    input_files: dict[str, Path] = field(default_factory=dict)
+    # Whether the stage solves the questions from the CLEVR-math dataset rows
+    uses_dataset: bool = False
+    # Whether the stage uses the CLEVR scenes annotations
+    uses_scenes: bool = False
+
+
+BENCHMARK_STAGES: dict[str, BenchmarkStage] = {
+    stage.name: stage for stage in (
+        BenchmarkStage(
+            name="one_step_gpt",
+            solver_class="experiments.one_step.one_step_gpt:OneStepGPT",
+            client_type="vision",
+            responses_file=TEST_SET_RESULTS.joinpath("one_step_gpt_results.json"),
+            response_field=ImageDataEnum.GPT_RESPONSE,
+            input_files={"one_step_gpt_results_file": TEST_SET_RESULTS.joinpath("one_step_gpt_results.json")},
+            uses_dataset=True,
+        ),
+        BenchmarkStage(
+            name="one_step_gpt_cot",
+            solver_class="experiments.one_step.one_step_gpt_CoT:OneStepGPTCot",
+            client_type="vision",
+            responses_file=TEST_SET_RESULTS.joinpath("one_step_gpt_cot_results.json"),
+            response_field=ImageDataEnum.GPT_RESPONSE,
+            input_files={"one_step_gpt_results_file": TEST_SET_RESULTS.joinpath("one_step_gpt_results.json")},
+            uses_dataset=True,
+        ),
+        BenchmarkStage(
+            name="oracle_one_step",
+            solver_class="experiments.one_step.oracle_one_step:OracleOneStep",
+            client_type="vision",
+            responses_file=VALIDATION_SET_RESULTS.joinpath("oracle_one_step_results.json"),
+            response_field=ImageDataEnum.GPT_RESPONSE,
+            input_files={
+                "one_step_gpt_results_file": VALIDATION_SET_RESULTS.joinpath("oracle_one_step_results.json")
+            },
+            uses_dataset=True,
+            uses_scenes=True,
+        ),
+        BenchmarkStage(
+            name="objects_parser",
+            solver_class="experiments.two_step.objects_parser:ObjectsParser",
+            client_type="lang",
+            responses_file=TEST_SET_RESULTS.joinpath("objects_parsing_results.json"),
+            response_field=ImageDataEnum.PARSING_RESULT,
+            input_files={"one_step_gpt_results_file": TEST_SET_RESULTS.joinpath("one_step_gpt_results.json")},
+        ),
+        BenchmarkStage(
+            name="objects_counter",
+            solver_class="experiments.two_step.objects_counter:ObjectsCounter",
+            client_type="vision",
+            responses_file=TEST_SET_RESULTS.joinpath("object_counting_results.json"),
+            response_field=ImageDataEnum.COUNTING_RESULT,
+            input_files={
+                "objects_parsing_results_file": TEST_SET_RESULTS.joinpath("objects_parsing_results.json")
+            },
+        ),
+        BenchmarkStage(
+            name="two_step_gpt_vision",
+            solver_class="experiments.two_step.two_step_gpt_vision:TwoStepGptVision",
+            client_type="vision",
+            responses_file=TEST_SET_RESULTS.joinpath("two_step_gpt_results_vision.json"),
+            response_field=ImageDataEnum.GPT_RESPONSE,
+            input_files={
+                "object_counting_results_file": TEST_SET_RESULTS.joinpath("object_counting_results.json")
+            },
+        ),
+        BenchmarkStage(
+            name="oracle_parser",
+            solver_class="experiments.two_step.oracle_parser:OracleObjectsParser",
+            client_type="lang",
+            responses_file=VALIDATION_SET_RESULTS.joinpath("oracle_parsing_results.json"),
+            response_field=ImageDataEnum.PARSING_RESULT,
+            input_files={
+                "oracle_one_step_results_file": VALIDATION_SET_RESULTS.joinpath("oracle_one_step_results.json")
+            },
+            uses_scenes=True,
+        ),
+        BenchmarkStage(
+            name="oracle_two_step",
+            solver_class="experiments.two_step.oracle_two_step:OracleTwoStep",
+            client_type="vision",
+            responses_file=VALIDATION_SET_RESULTS.joinpath("oracle_two_step_results.json"),
+            response_field=ImageDataEnum.GPT_RESPONSE,
+            input_files={
+                "oracle_parsing_results_file": VALIDATION_SET_RESULTS.joinpath("oracle_parsing_results.json")
+            },
+        ),
+    )
+}
+
+
+@dataclass
+class BenchmarkResult:
+    stage: str
+    concurrency: int
+    latency_ms: float
+    questions: int
+    requests: int
+    wall_seconds: float
+    questions_per_second: float
+    cpu_seconds: float
+    cpu_ms_per_question: float
+    peak_rss_mb: float
+
+
+def load_json_file(file_path: Path) -> dict:
+    with open(file_path, "r") as f:
+        return json.load(f)
+
+
+def load_recorded_responses(stage: BenchmarkStage) -> dict[int, str]:
+    recorded_results = load_json_file(stage.responses_file)
+    return {
+        int(question_index): question_result.get(stage.response_field)
+        for question_index, question_result in recorded_results.items()
+    }
+
+
+def create_dataset_rows(recorded_results: dict[str, dict], image_path: Path) -> dict[int, dict]:
+    """
+    Rows in the format of the CLEVR-math dataset rows, from the recorded results, all with the same local image.
+    """
+    image = SimpleNamespace(filename=str(image_path))
+    return {
+        int(question_index): {
+            ClevrMathLabelsEnum.TEMPLATE: question_result[ImageDataEnum.TEMPLATE],
+            ClevrMathLabelsEnum.QUESTION: question_result[ImageDataEnum.QUESTION],
+            ClevrMathLabelsEnum.IMAGE: image,
+            ClevrMathLabelsEnum.ID: question_result[ImageDataEnum.IMAGE_ID],
+            ClevrMathLabelsEnum.LABEL: question_result[ImageDataEnum.LABEL],
+        }
+        for question_index, question_result in recorded_results.items()
+    }
+
+
+def create_synthetic_scenes(image_ids: list[str], seed: int = 0) -> dict:
+    """
+    A CLEVR scenes file with random objects for the given images, and no objects for the other images.
+    """
+    rng = random.Random(seed)
+    image_indices = {BaseGptClevrSolver.get_image_index_from_id(image_id) for image_id in image_ids}
+    scenes = [{ClevrDescriptionsEnum.OBJECTS: []} for _ in range(max(image_indices) + 1)]
+    for image_index in image_indices:
+        scenes[image_index][ClevrDescriptionsEnum.OBJECTS] = [
+            {
+                "size": rng.choice(SIZES),
+                "color": rng.choice(COLORS),
+                "material": rng.choice(MATERIALS),
+                "shape": rng.choice(SHAPES),
+            }
+            for _ in range(rng.randint(3, 10))
+        ]
+    return {ClevrDescriptionsEnum.SCENES: scenes}
+
+
+def create_solver(
+        stage: BenchmarkStage,
+        replay_client: ReplayOpenAIClient,
+        data_config: DataConfig,
+        logger: logging.Logger
+) -> BaseGptClevrSolver:
+    module_name, class_name = stage.solver_class.split(":")
+    solver_class = getattr(__import__(module_name, fromlist=[class_name]), class_name)
+    if stage.client_type == "vision":
+        gpt_client = ReplayVisionClient(config=Gpt4VisionConfig(), logger=logger, replay_client=replay_client)
+    else:
+        gpt_client = ReplayLangClient(config=GPT4LangConfig(), logger=logger, replay_client=replay_client)
+    return solver_class(data_config=data_config, gpt_client=gpt_client, logger=logger)
+
+
+def run_case(
+        stage: BenchmarkStage,
+        concurrency: int,
+        latency_ms: float,
+        max_questions: Optional[int]
+) -> BenchmarkResult:
+    """
+    Solve the questions of the stage with the given number of threads, and measure the throughput.
+    Only the solving is measured, not the loading of the stage inputs.
+    """
+    logger = logging.getLogger("replay_benchmark")
+    replay_client = ReplayOpenAIClient(responses=load_recorded_responses(stage), latency_seconds=latency_ms / 1000)
+
+    with tempfile.TemporaryDirectory() as temp_directory:
+        data_config = DataConfig()
+        # Start from an empty description cache, and don't write to the data directory
+        data_config.description_cache_file = Path(temp_directory).joinpath("description_cache.db")
+        data_config.dead_letters_file = Path(temp_directory).joinpath("dead_letters.jsonl")
+        recorded_results = load_json_file(stage.responses_file)
+        if stage.uses_scenes:
+            data_config.clevr_val_scenes = Path(temp_directory).joinpath("scenes.json")
+            image_ids = [question_result[ImageDataEnum.IMAGE_ID] for question_result in recorded_results.values()]
+            with open(data_config.clevr_val_scenes, "w") as f:
+                json.dump(create_synthetic_scenes(image_ids), f)
+
+        solver = create_solver(stage=stage, replay_client=replay_client, data_config=data_config, logger=logger)
+        for attribute_name, input_file in stage.input_files.items():
+            setattr(solver, attribute_name, input_file)
+        if stage.uses_dataset:
+            solver.shared_data.manifests[data_config.clevr_math_dataset_name] = QuestionManifest.from_rows(
+                create_dataset_rows(recorded_results, image_path=BENCHMARK_IMAGE)
+            )
+        questions = list(solver.load_questions().items())[:max_questions]
+        for _, question_data in questions:
+            if ImageDataEnum.IMAGE_PATH in question_data:
+                question_data[ImageDataEnum.IMAGE_PATH] = str(BENCHMARK_IMAGE)
+        if stage.uses_scenes:
+            # Load the scenes before the measurement, like the dataset
+            solver.get_image_scene(image_id=next(iter(recorded_results.values()))[ImageDataEnum.IMAGE_ID])
+
+        def solve_question(question: tuple[str, dict], submit_time_ns: int):
+            question_index, question_data = question
+            tracing.add_span(tracing.SPAN_QUEUE_WAIT, start_time_ns=submit_time_ns, end_time_ns=time.time_ns(),
+                             question_index=int(question_index))
+            replay_client.set_current_question(int(question_index))
+            return solver.solve_question(question_index=int(question_index), question_data=question_data)
+
+        start_cpu_time = time.process_time()
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(solve_question, questions, [time.time_ns()] * len(questions)))
+        wall_seconds = time.perf_counter() - start_time
+        cpu_seconds = time.process_time() - start_cpu_time
+
+    return BenchmarkResult(
+        stage=stage.name,
+        concurrency=concurrency,
+        latency_ms=latency_ms,
+        questions=len(questions),
+        requests=replay_client.number_of_requests,
+        wall_seconds=wall_seconds,
+        questions_per_second=len(questions) / wall_seconds,
+        cpu_seconds=cpu_seconds,
+        cpu_ms_per_question=cpu_seconds * 1000 / len(questions),
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    )
+
+
+def run_case_in_new_process(
+        stage_name: str,
+        concurrency: int,
+        latency_ms: float,
+        max_questions: Optional[int]
+) -> BenchmarkResult:
+    """
+    Run the case in a new process, so the peak RSS is of this case only.
+    """
+    arguments = [
+        sys.executable, "-m", "benchmarks.replay_benchmark", "--run-case", stage_name,
+        "--concurrency", str(concurrency), "--latency-ms", str(latency_ms),
+    ]
+    if max_questions is not None:
+        arguments += ["--max-questions", str(max_questions)]
+    completed_process = subprocess.run(arguments, cwd=ROOT_DIRECTORY, capture_output=True, text=True, check=True)
+    return BenchmarkResult(**json.loads(completed_process.stdout))
+
+
+def compare_with_baseline(
+        results: list[BenchmarkResult],
+        baseline: list[dict],
+        tolerance: float
+) -> list[str]:
+    """
+    Get the regressions: cases whose throughput dropped, or whose CPU time per question grew, by more than the
+    tolerance (a fraction of the baseline value), compared to the baseline case with the same stage, concurrency
+    and latency.
+    """
+    baseline_results = {
+        (result["stage"], result["concurrency"], result["latency_ms"]): result for result in baseline
+    }
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get((result.stage, result.concurrency, result.latency_ms))
+        if baseline_result is None:
+            continue
+        case = f"{result.stage} (concurrency {result.concurrency})"
+        if result.questions_per_second < baseline_result["questions_per_second"] * (1 - tolerance):
+            regressions.append(f"{case}: {result.questions_per_second:.1f} questions/sec, "
+                               f"baseline {baseline_result['questions_per_second']:.1f}")
+        if result.cpu_ms_per_question > baseline_result["cpu_ms_per_question"] * (1 + tolerance):
+            regressions.append(f"{case}: {result.cpu_ms_per_question:.2f} CPU ms/question, "
+                               f"baseline {baseline_result['cpu_ms_per_question']:.2f}")
+    return regressions
+
+
+def format_result(result: BenchmarkResult) -> str:
+    return (f"{result.stage:<22} concurrency {result.concurrency:>3}: "
+            f"{result.questions_per_second:8.1f} questions/sec, "
+            f"{result.cpu_ms_per_question:6.2f} CPU ms/question, "
+            f"peak RSS {result.peak_rss_mb:6.1f} MB, {result.requests} requests")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the experiments throughput with recorded responses.")
+    parser.add_argument("--stages", nargs="+", choices=sorted(BENCHMARK_STAGES), default=list(BENCHMARK_STAGES))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(DEFAULT_CONCURRENCY_LEVELS))
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_LATENCY_MS,
+                        help="The latency injected into every replayed request.")
+    parser.add_argument("--max-questions", type=int, default=None)
+    parser.add_argument("--output", type=Path, default=None, help="Save the results as a json file (a baseline).")
+    parser.add_argument("--baseline", type=Path, default=None, help="Compare the results with a baseline file.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--run-case", choices=sorted(BENCHMARK_STAGES), default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.run_case is not None:
+        result = run_case(
+            stage=BENCHMARK_STAGES[args.run_case],
+            concurrency=args.concurrency[0],
+            latency_ms=args.latency_ms,
+            max_questions=args.max_questions,
+        )
+        print(json.dumps(asdict(result)))
+        return
+
+    results = []
+    for stage_name in args.stages:
+        for concurrency in args.concurrency:
+            result = run_case_in_new_process(
+                stage_name=stage_name,
+                concurrency=concurrency,
+                latency_ms=args.latency_ms,
+                max_questions=args.max_questions,
+            )
+            print(format_result(result))
+            results.append(result)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump([asdict(result) for result in results], f, indent=2)
+
+    if args.baseline is not None:
+        regressions = compare_with_baseline(results, load_json_file(args.baseline), tolerance=args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Module for GPT clients that replay recorded responses instead of calling the API, for benchmarking the solvers.
+
+The replay client stands in for the openai client, so the whole GPT client code (messages preparation, image
+encoding, retries and answer parsing) runs as in a real run, and only the network call is replaced by a configurable
+latency. The response of each request is the recorded response of the question that is solved in the current thread.
+"""
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+from conf.base_gpt_config import BaseGptConfig
+from gpt_clients.gpt4_lang_client import Gpt4LangClient
+from gpt_clients.gpt4_vision_client import Gpt4VisionClient
+
+DEFAULT_RESPONSE = "My answer is: 0"
+
+
+@dataclass
+class ReplayMessage:
+    content: str
+
+
+@dataclass
+class ReplayChoice:
+    message: ReplayMessage
+    logprobs: None = None
+
+
+@dataclass
+class ReplayCompletion:
+    choices: list[ReplayChoice]
+
+
+class ReplayCompletions:
+    def __init__(self, replay_client: "ReplayOpenAIClient"):
+        self.replay_client = replay_client
+
+    def create(self, n: int = 1, **request_params) -> ReplayCompletion:
+        return self.replay_client.create_completion(n=n, messages=request_params.get("messages"))
+
+
+class ReplayChat:
+    def __init__(self, replay_client: "ReplayOpenAIClient"):
+        self.completions = ReplayCompletions(replay_client)
+
+
+def get_messages_content_sizes(messages: list[dict]) -> tuple[Counter, int]:
+    """
+    The number of images in the messages by their detail, and the number of characters of their text.
+    """
+    images_by_detail = Counter()
+    prompt_characters = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            prompt_characters += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                image_url = part["image_url"]
+                images_by_detail[image_url.get("detail", "auto") if isinstance(image_url, dict) else "auto"] += 1
+            elif part.get("type") == "text":
+                prompt_characters += len(part.get("text", ""))
+    return images_by_detail, prompt_characters
+
+
+class ReplayOpenAIClient:
+    """
+    Has the interface of the openai client that the GPT clients use (client.chat.completions.create).
+    Every completion waits latency_seconds, like a network call, and returns the recorded response of the current
+    question of the calling thread.
+    """
+
+    def __init__(self, responses: dict[int, str], latency_seconds: float = 0):
+        self.responses = responses
+        self.latency_seconds = latency_seconds
+        self.chat = ReplayChat(self)
+        self.number_of_requests = 0
+        # The images sent in the requests, by their detail ('auto' when the request doesn't set it)
+        self.images_by_detail: Counter = Counter()
+        self.prompt_characters = 0
+        self._requests_lock = threading.Lock()
+        self._current_question = threading.local()
+
+    def set_current_question(self, question_index: Optional[int]):
+        self._current_question.index = question_index
+
+    def create_completion(self, n: int = 1, messages: Optional[list[dict]] = None) -> ReplayCompletion:
+        images_by_detail, prompt_characters = get_messages_content_sizes(messages or [])
+        with self._requests_lock:
+            self.number_of_requests += 1
+            self.images_by_detail.update(images_by_detail)
+            self.prompt_characters += prompt_characters
+        if self.latency_seconds > 0:
+            time.sleep(self.latency_seconds)
+
+        question_index = getattr(self._current_question, "index", None)
+        response = self.responses.get(question_index) or DEFAULT_RESPONSE
+        return ReplayCompletion(choices=[ReplayChoice(message=ReplayMessage(content=response)) for _ in range(n)])
+
+
+class ReplayVisionClient(Gpt4VisionClient):
+    def __init__(self, config: BaseGptConfig, logger, replay_client: ReplayOpenAIClient):
+        self.replay_client = replay_client
+        super().__init__(config=config, logger=logger)
+
+    def create_openai_client(self, config: BaseGptConfig) -> ReplayOpenAIClient:
+        return self.replay_client
+
+
+class ReplayLangClient(Gpt4LangClient):
+    def __init__(self, config: BaseGptConfig, logger, replay_client: ReplayOpenAIClient):
+        self.replay_client = replay_client
+        super().__init__(config=config, logger=logger)
+
+    def create_openai_client(self, config: BaseGptConfig) -> ReplayOpenAIClient:
+        return self.replay_client
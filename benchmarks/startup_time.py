@@ -0,0 +1,141 @@
+"""
+Benchmark of the startup time of the command line entry point and the experiments modules.
+
+Every case is run in a new Python process, and its wall time is measured over several runs. Importing the modules of
+the stages that only read json files should not import the heavy dependencies (datasets, openai, tqdm), so the
+benchmark also checks which of them each module imports.
+
+Run `python twostagegpt.py bench-startup` (or `python -m benchmarks.startup_time`) from the root directory.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional
+
+ROOT_DIRECTORY = Path(__file__).parent.parent
+HEAVY_MODULES = ("datasets", "openai", "tqdm")
+DEFAULT_NUMBER_OF_RUNS = 10
+
+# The case name and the Python arguments it runs
+STARTUP_CASES: dict[str, list[str]] = {
+    "python": ["-c", "pass"],
+    "twostagegpt --help": ["twostagegpt.py", "--help"],
+    "twostagegpt objects-counter --help": ["twostagegpt.py", "objects-counter", "--help"],
+}
+# Modules of stages that only read json files, and should not import the heavy dependencies
+JSON_ONLY_MODULES = (
+    "experiments.two_step.objects_parser",
+    "experiments.two_step.objects_counter",
+    "experiments.two_step.two_step_gpt_vision",
+    "experiments.two_step.oracle_two_step",
+    "experiments.queue_worker",
+)
+
+
+@dataclass
+class StartupTime:
+    case: str
+    median_ms: float
+    min_ms: float
+    max_ms: float
+    # The heavy dependencies the case imported, for the module import cases
+    heavy_modules_imported: Optional[list[str]] = None
+
+
+def run_python(arguments: list[str]) -> str:
+    completed_process = subprocess.run(
+        [sys.executable, *arguments],
+        cwd=ROOT_DIRECTORY,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return completed_process.stdout
+
+
+def measure_startup_time(case: str, arguments: list[str], number_of_runs: int) -> StartupTime:
+    durations_ms = []
+    for _ in range(number_of_runs):
+        start_time = time.perf_counter()
+        run_python(arguments)
+        durations_ms.append((time.perf_counter() - start_time) * 1000)
+    return StartupTime(
+        case=case,
+        median_ms=statistics.median(durations_ms),
+        min_ms=min(durations_ms),
+        max_ms=max(durations_ms),
+    )
+
+
+def get_import_arguments(module_name: str) -> list[str]:
+    return ["-c", f"import {module_name}"]
+
+
+def get_heavy_modules_imported(module_name: str) -> list[str]:
+    output = run_python([
+        "-c",
+        f"import sys, json, {module_name}; "
+        f"print(json.dumps([name for name in {list(HEAVY_MODULES)} if name in sys.modules]))"
+    ])
+    return json.loads(output)
+
+
+def run_benchmark(number_of_runs: int = DEFAULT_NUMBER_OF_RUNS) -> list[StartupTime]:
+    startup_times = [
+        measure_startup_time(case=case, arguments=arguments, number_of_runs=number_of_runs)
+        for case, arguments in STARTUP_CASES.items()
+    ]
+    for module_name in JSON_ONLY_MODULES:
+        startup_time = measure_startup_time(
+            case=f"import {module_name}",
+            arguments=get_import_arguments(module_name),
+            number_of_runs=number_of_runs,
+        )
+        startup_time.heavy_modules_imported = get_heavy_modules_imported(module_name)
+        startup_times.append(startup_time)
+    return startup_times
+
+
+def format_startup_time(startup_time: StartupTime) -> str:
+    line = (f"{startup_time.case:<55} median {startup_time.median_ms:7.1f} ms "
+            f"(min {startup_time.min_ms:.1f}, max {startup_time.max_ms:.1f})")
+    if startup_time.heavy_modules_imported:
+        line += f" imports {', '.join(startup_time.heavy_modules_imported)}"
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of the commands and experiments modules.")
+    parser.add_argument("--runs", type=int, default=DEFAULT_NUMBER_OF_RUNS, help="The number of runs of each case.")
+    parser.add_argument("--output", type=Path, default=None, help="Save the startup times as a json file.")
+    parser.add_argument("--max-overhead-ms", type=float, default=None,
+                        help="Fail if the median startup time of a case is longer than the Python startup time "
+                             "by more than this, or if a json-only module imports a heavy dependency.")
+    args = parser.parse_args()
+
+    startup_times = run_benchmark(number_of_runs=args.runs)
+    for startup_time in startup_times:
+        print(format_startup_time(startup_time))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump([asdict(startup_time) for startup_time in startup_times], f, indent=2)
+
+    if args.max_overhead_ms is not None:
+        python_startup_ms = startup_times[0].median_ms
+        slow_cases = [
+            startup_time.case for startup_time in startup_times
+            if startup_time.median_ms - python_startup_ms > args.max_overhead_ms
+            or startup_time.heavy_modules_imported
+        ]
+        if slow_cases:
+            sys.exit(f"Startup time regressions: {', '.join(slow_cases)}")
+
+
+if __name__ == "__main__":
+    main()
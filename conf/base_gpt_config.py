@@ -1,4 +1,7 @@
 from dataclasses import dataclass, field, MISSING
+from typing import Optional
+
+from data_enums.backend_type_enum import BackendTypeEnum
 
 
 @dataclass
@@ -7,6 +10,33 @@ class BaseGptConfig:
     azure_endpoint: str = MISSING
     vision_model_deployment_name: str = MISSING
     api_version: str = field(default="2023-05-15")
+    # The server the completions are requested from: an Azure OpenAI deployment (azure_endpoint), or an OpenAI
+    # compatible server (base_url, e.g. OpenAI, vLLM, llama.cpp server or Ollama), where the deployment name is the model
+    backend: str = field(default=BackendTypeEnum.AZURE_OPENAI)
+    base_url: Optional[str] = field(default=None)
+    request_timeout_seconds: float = field(default=600.0)
+    # The maximal number of concurrent requests to the server, shared by all its clients (0 - unlimited)
+    max_concurrent_requests: int = field(default=0)
+    # The maximal number of completions sampled in a single request, more samples are split into several requests
+    # (0 - unlimited). Set it to 1 for servers that don't support the n parameter, e.g. Ollama and llama.cpp server
+    max_samples_per_request: int = field(default=0)
     max_tokens: int = field(default=600)
     max_rate_limit_retries: int = field(default=5)
+    # Retries of the other transient errors (timeouts, connection and server errors)
+    max_transient_error_retries: int = field(default=3)
+    # The retries wait a random delay (full jitter) of up to base * 2 ** retry seconds, capped at the max delay
+    retry_base_delay_seconds: float = field(default=2.0)
+    retry_max_delay_seconds: float = field(default=60.0)
     temperature: float = field(default=0.0)
+    # Ask for JSON responses (response_format) when the deployment supports it
+    structured_output: bool = field(default=False)
+    # Number of completions to sample in a single request for self-consistency (majority vote) answers
+    self_consistency_samples: int = field(default=1)
+    self_consistency_temperature: float = field(default=0.7)
+    # Send the images in low detail first, and in high detail only when the response is not conclusive
+    adaptive_image_detail: bool = field(default=False)
+    initial_image_detail: str = field(default="low")
+    escalated_image_detail: str = field(default="high")
+    # The number of base64 encoded images the vision client keeps in memory, to send again without reading and
+    # encoding them (0 - disabled)
+    image_encoding_cache_size: int = field(default=0)
@@ -1,6 +1,7 @@
 from dotenv import load_dotenv
 from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Optional
 
 load_dotenv()
 
@@ -43,6 +44,10 @@ class DataConfig:
         default=Path(__file__).parent.parent.joinpath("data", "two_step_gpt_results_vision.json"),
         metadata={"help": "The name of the file where all the two step gpt results are saved."},
     )
+    fused_count_and_solve_results_file: Path = field(
+        default=Path(__file__).parent.parent.joinpath("data", "fused_count_and_solve_results.json"),
+        metadata={"help": "The name of the file where all the fused count and solve results are saved."},
+    )
     oracle_one_step_results_file: Path = field(
         default=Path(__file__).parent.parent.joinpath(
             "data", "validation_set_results", "oracle_one_step_results.json"
@@ -65,7 +70,81 @@ class DataConfig:
         default=Path(__file__).parent.parent.joinpath("data", "test_set_results", "simple_object_detection_results.json"),
         metadata={"help": "The name of the file where all the simple object detection results are saved."},
     )
+    object_detection_max_images_per_request: int = field(
+        default=1,
+        metadata={"help": "Pack up to this many images in one object detection request. The number of images per "
+                          "request adapts to the max tokens of the responses, and to the packed responses that "
+                          "missed images. 1 sends one image per request."},
+    )
+    cascade_results_file: Path = field(
+        default=Path(__file__).parent.parent.joinpath("data", "cascade_results.json"),
+        metadata={"help": "The name of the file where all the cascade results are saved."},
+    )
+    cascade_tradeoff_file: Path = field(
+        default=Path(__file__).parent.parent.joinpath("data", "cascade_tradeoff.json"),
+        metadata={"help": "The name of the file where the cascade accuracy/cost trade-off curve is saved."},
+    )
+    cascade_confidence_threshold: float = field(
+        default=0.9,
+        metadata={"help": "One step answers with a lower confidence are escalated to the two step pipeline."},
+    )
+    cascade_confidence_method: str = field(
+        default="logprobs",
+        metadata={"help": "How the one step answer confidence is measured: 'logprobs' or 'self_consistency'."},
+    )
+    description_cache_file: Path = field(
+        default=Path(__file__).parent.parent.joinpath("data", "description_cache.db"),
+        metadata={"help": "The name of the cache of the images objects descriptions, shared by all the experiments."},
+    )
+    use_description_cache: bool = field(
+        default=True,
+        metadata={"help": "Reuse the cached descriptions of the images objects, that were created with the same prompt "
+                          "and model, instead of describing the image again."},
+    )
+    dead_letters_file: Path = field(
+        default=Path(__file__).parent.parent.joinpath("data", "dead_letters.jsonl"),
+        metadata={"help": "The name of the file where the questions that failed are saved, to be retried later."},
+    )
+    max_consecutive_dead_letters: int = field(
+        default=20,
+        metadata={"help": "Stop the run when this many questions in a row failed, instead of saving every question in "
+                          "the dead letters file. 0 never stops the run."},
+    )
     number_of_questions_to_solve: int = field(default=400)
+    use_local_arithmetic_solver: bool = field(
+        default=True,
+        metadata={"help": "Solve the two step questions locally from the counting results when they are conclusive, "
+                          "instead of calling the GPT model."},
+    )
+    use_object_spec_counting: bool = field(
+        default=False,
+        metadata={"help": "Ask the vision model only for the number of objects of each combination of the attributes "
+                          "the objects list refers to, and derive the count of every object from the list locally."},
+    )
+    use_local_object_counter: bool = field(
+        default=False,
+        metadata={"help": "Count the objects of the CLEVR renders locally (no model), and call the vision model only "
+                          "for the images the local counter is not confident about."},
+    )
+    local_object_counter_confidence_threshold: float = field(
+        default=0.9,
+        metadata={"help": "The local counts of images with a lower confidence are counted by the vision model."},
+    )
+    matrix_results_dir: Path = field(
+        default=Path(__file__).parent.parent.joinpath("data", "matrix_results"),
+        metadata={"help": "The directory where the experiment matrix saves the results files of its stages, so it "
+                          "doesn't overwrite the results files of the paper."},
+    )
     clevr_math_dataset_name: str = field(default="dali-does/clevr-math")
+    question_manifest_file: Path = field(
+        default=Path(__file__).parent.parent.joinpath("data", "clevr_math_question_manifest.json"),
+        metadata={"help": "The name of the file where the question manifest of the chosen split (the metadata of its "
+                          "questions, without the images) is saved. It is built from the dataset on the first run."},
+    )
+    synthetic_questions_file: Optional[Path] = field(
+        default=None,
+        metadata={"help": "Solve the questions of this generated questions file (`generate-questions`) instead of the "
+                          "CLEVR-math dataset, e.g. for load tests."},
+    )
     cot_subtraction_image: str = "data/CLEVR_train_000006.png"
     cot_addition_image: str = "data/CLEVR_train_000000.png"
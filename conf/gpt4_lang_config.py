@@ -1,8 +1,10 @@
 import os
+from typing import Optional
 from dotenv import load_dotenv
 
 from dataclasses import dataclass
 from conf.base_gpt_config import BaseGptConfig
+from data_enums.backend_type_enum import BackendTypeEnum
 
 load_dotenv()
 
@@ -12,3 +14,7 @@ class GPT4LangConfig(BaseGptConfig):
     api_key: str = os.getenv("GPT4_LANG_KEY")
     azure_endpoint: str = os.getenv("GPT4_LANG_ENDPOINT")
     vision_model_deployment_name: str = os.getenv("GPT4_LANG_DEPLOYMENT_NAME")
+    backend: str = os.getenv("GPT4_LANG_BACKEND", BackendTypeEnum.AZURE_OPENAI.value)
+    base_url: Optional[str] = os.getenv("GPT4_LANG_BASE_URL")
+    max_concurrent_requests: int = int(os.getenv("GPT4_LANG_MAX_CONCURRENT_REQUESTS", "0"))
+    max_samples_per_request: int = int(os.getenv("GPT4_LANG_MAX_SAMPLES_PER_REQUEST", "0"))
@@ -1,8 +1,10 @@
 import os
+from typing import Optional
 from dotenv import load_dotenv
 
 from dataclasses import dataclass
 from conf.base_gpt_config import BaseGptConfig
+from data_enums.backend_type_enum import BackendTypeEnum
 
 load_dotenv()
 
@@ -12,3 +14,7 @@ class Gpt4VisionConfig(BaseGptConfig):
     api_key: str = os.getenv("GPT4_VISION_KEY")
     azure_endpoint: str = os.getenv("GPT4_VISION_ENDPOINT")
     vision_model_deployment_name: str = os.getenv("GPT4_VISION_DEPLOYMENT_NAME")
+    backend: str = os.getenv("GPT4_VISION_BACKEND", BackendTypeEnum.AZURE_OPENAI.value)
+    base_url: Optional[str] = os.getenv("GPT4_VISION_BASE_URL")
+    max_concurrent_requests: int = int(os.getenv("GPT4_VISION_MAX_CONCURRENT_REQUESTS", "0"))
+    max_samples_per_request: int = int(os.getenv("GPT4_VISION_MAX_SAMPLES_PER_REQUEST", "0"))
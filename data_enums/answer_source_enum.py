@@ -0,0 +1,11 @@
+from enum import Enum
+
+
+class AnswerSourceEnum(str, Enum):
+    """
+    The source of the final answer of a question:
+    1. GPT - the answer was extracted from the GPT model response
+    2. Local solver - the answer was computed locally from the counting result
+    """
+    GPT = "gpt"
+    LOCAL_SOLVER = "local_solver"
@@ -0,0 +1,11 @@
+from enum import Enum
+
+
+class BackendTypeEnum(str, Enum):
+    """
+    The type of the server the completions of a GPT client are requested from:
+    1. Azure OpenAI - an Azure OpenAI deployment
+    2. OpenAI compatible - a server with the OpenAI chat completions API, e.g. OpenAI, vLLM, llama.cpp server or Ollama
+    """
+    AZURE_OPENAI = "azure_openai"
+    OPENAI_COMPATIBLE = "openai_compatible"
@@ -0,0 +1,11 @@
+from enum import Enum
+
+
+class ConfidenceMethodEnum(str, Enum):
+    """
+    How the confidence of an answer is measured:
+    1. Logprobs - the probability the model assigned to the answer tokens
+    2. Self consistency - the share of the sampled responses that agree with the majority vote answer
+    """
+    LOGPROBS = "logprobs"
+    SELF_CONSISTENCY = "self_consistency"
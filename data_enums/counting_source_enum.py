@@ -0,0 +1,11 @@
+from enum import Enum
+
+
+class CountingSourceEnum(str, Enum):
+    """
+    The source of the counting result of a question:
+    1. GPT - the objects were counted by the GPT vision model
+    2. Local counter - the objects were counted locally from the image, with no model
+    """
+    GPT = "gpt"
+    LOCAL_COUNTER = "local_counter"
@@ -0,0 +1,15 @@
+from enum import Enum
+
+
+class DeadLetterEnum(str, Enum):
+    """
+    The fields of a question in the dead letters file.
+    """
+    STAGE = "stage"
+    QUESTION_INDEX = "question_index"
+    QUESTION_DATA = "question_data"
+    ERROR_CATEGORY = "error_category"
+    ERROR_TYPE = "error_type"
+    ERROR = "error"
+    ATTEMPTS = "attempts"
+    TIME = "time"
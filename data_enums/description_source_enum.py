@@ -0,0 +1,11 @@
+from enum import Enum
+
+
+class DescriptionSourceEnum(str, Enum):
+    """
+    The source of a description of the objects in an image:
+    1. GPT detection - the objects the GPT vision model detected in the image
+    2. CLEVR scene - the objects from the CLEVR scenes annotations of the image
+    """
+    GPT_DETECTION = "gpt_detection"
+    CLEVR_SCENE = "clevr_scene"
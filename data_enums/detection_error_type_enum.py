@@ -0,0 +1,15 @@
+from enum import Enum
+
+
+class DetectionErrorTypeEnum(str, Enum):
+    """
+    The types of the errors of an object detection (a counting result or a detection result):
+    1. Counting - the objects were identified, but a group or all the objects were miscounted
+    2. Feature identification - an object was described with a wrong attribute (e.g. a gray cube as a blue cube)
+    3. Grouping - an object was counted in a group it does not belong to (e.g. a cylinder as a block)
+    4. Hallucination - an object that is not in the image was described
+    """
+    COUNTING = "counting"
+    FEATURE_IDENTIFICATION = "feature_identification"
+    GROUPING = "grouping"
+    HALLUCINATION = "hallucination"
@@ -0,0 +1,13 @@
+from enum import Enum
+
+
+class ErrorCategoryEnum(str, Enum):
+    """
+    The category of an error of a GPT request:
+    1. Retryable - a transient error (rate limit, timeout, connection error or server error), retried with backoff
+    2. Permanent - the request itself is wrong (e.g. a bad request or authentication error), retrying won't help
+    3. Content filtered - the prompt or the response was blocked by the content filter
+    """
+    RETRYABLE = "retryable"
+    PERMANENT = "permanent"
+    CONTENT_FILTERED = "content_filtered"
@@ -15,4 +15,19 @@ class ImageDataEnum(str, Enum):
     COUNTING_RESULT = "counting_result"
     IS_VALID = "is_valid"
     VALIDATION_EXPLANATION = "explanation"
-
+    ANSWER_SOURCE = "answer_source"
+    LOCAL_SOLUTION = "local_solution"
+    GPT_RESPONSES = "gpt_responses"
+    VOTE_DISTRIBUTION = "vote_distribution"
+    CONFIDENCE = "confidence"
+    ESCALATED = "escalated"
+    ONE_STEP_RESULT = "one_step_result"
+    COUNTING_SOURCE = "counting_source"
+    LOCAL_COUNTING_CONFIDENCE = "local_counting_confidence"
+    DETECTION_RESULT = "detection_result"
+    DETECTION_VALIDATION = "detection_validation"
+    NUMBER_OF_OBJECTS = "number_of_objects"
+    ERROR_TYPES = "error_types"
+    OBJECT_INVENTORY = "object_inventory"
+    STAGE_VERSION = "stage_version"
+    RESULT_VERSION = "result_version"
@@ -0,0 +1,15 @@
+from enum import Enum
+
+
+class QuestionTemplateEnum(str, Enum):
+    """
+    The templates of the CLEVR-math questions:
+    1. Addition - objects are added, e.g. 'Add 2 gray objects. How many gray objects exist?'
+    2. Subtraction - objects are subtracted once, e.g. 'Subtract all cylinders. How many objects are left?'
+    3. Subtraction multihop - objects are subtracted twice, and the remaining objects are counted
+    4. Adversarial - objects are subtracted, and only some of the remaining objects are counted
+    """
+    ADDITION = "addition"
+    SUBTRACTION = "subtraction"
+    SUBTRACTION_MULTIHOP = "subtraction-multihop"
+    ADVERSARIAL = "adversarial"
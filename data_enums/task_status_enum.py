@@ -0,0 +1,15 @@
+from enum import Enum
+
+
+class TaskStatusEnum(str, Enum):
+    """
+    The status of a question in the work queue:
+    1. Pending - waiting for a worker
+    2. Leased - a worker is solving it, until its lease expires
+    3. Done - solved, the result is saved in the queue
+    4. Failed - the question failed in all of its attempts
+    """
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
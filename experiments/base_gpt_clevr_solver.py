@@ -1,27 +1,72 @@
 import json
-import re
+import threading
 
 from abc import ABC, abstractmethod
 from logging import Logger
 from pathlib import Path
-from typing import Union
+from typing import Callable, Optional, Union
 
-from datasets import load_dataset, DownloadConfig
 from conf.data_config import DataConfig
+from data_enums.clevr_descriptions_enum import ClevrDescriptionsEnum
+from data_enums.clevr_math_labels_enum import ClevrMathLabelsEnum
+from data_enums.dead_letter_enum import DeadLetterEnum
+from data_enums.description_source_enum import DescriptionSourceEnum
 from data_enums.image_data_enum import ImageDataEnum
 from gpt_clients.base_client import BaseClient
+from gpt_clients.errors import is_configuration_error
+from utils import answer_extraction, tracing
+from utils.clevr_objects import describe_scene
+from utils.dead_letters import DeadLetters
+from utils.question_generator import load_synthetic_questions
+from utils.question_manifest import QuestionManifest, QuestionRecord, get_scene_index
+from utils.description_cache import DescriptionCache, get_description_fingerprint
+
+# Change when the format of the scene descriptions changes, to describe the scenes again
+SCENE_DESCRIPTION_VERSION = 1
+# The fields of a result that are its versions, and not part of the input of the next stage
+VERSION_FIELDS = (ImageDataEnum.STAGE_VERSION.value, ImageDataEnum.RESULT_VERSION.value)
+
+
+class SharedClevrData:
+    """
+    The question manifests of the CLEVR-math dataset splits and the CLEVR scenes annotations, loaded once and shared
+    by all the solvers that use the same instance (e.g. the experiments of a matrix run). Every solver has its own
+    instance by default.
+    """
+    def __init__(self):
+        self.manifests: dict[str, QuestionManifest] = {}
+        self.scenes: dict[Path, list[dict]] = {}
+        self.lock = threading.Lock()
 
 
 class BaseGptClevrSolver(ABC):
     """
     Base class for GPT solvers for CLEVR dataset.
     """
+    # The fields of the question data the stage reads, or None if it reads all of them. Only these fields are part of
+    # the input of the result versions, so e.g. a new one-step answer doesn't change the version of a parsing result.
+    input_fields: Optional[tuple[ImageDataEnum, ...]] = None
 
     def __init__(self, data_config: DataConfig, gpt_client: BaseClient, logger: Logger):
         self.logger = logger
         self.gpt_client = gpt_client
         self.clevr_val_scenes: Path = data_config.clevr_val_scenes
         self.clevr_math_dataset_name = data_config.clevr_math_dataset_name
+        self.synthetic_questions_file: Optional[Path] = data_config.synthetic_questions_file
+        self.question_manifest_file: Path = data_config.question_manifest_file
+        # The counters of the run are updated by all the threads that solve questions (e.g. in a matrix run)
+        self.counters_lock = threading.Lock()
+        self.extraction_failures: int = 0
+        self.dead_letters = DeadLetters(file_path=data_config.dead_letters_file)
+        self.dead_lettered_questions: int = 0
+        self.max_consecutive_dead_letters: int = data_config.max_consecutive_dead_letters
+        self.consecutive_dead_letters: int = 0
+        self.reused_results: int = 0
+        self._stage_version: Optional[str] = None
+        self.description_cache: Optional[DescriptionCache] = None
+        if data_config.use_description_cache:
+            self.description_cache = DescriptionCache(db_path=data_config.description_cache_file)
+        self.shared_data = SharedClevrData()
 
     @property
     @abstractmethod
@@ -31,11 +76,207 @@ class BaseGptClevrSolver(ABC):
         """
         raise NotImplementedError
 
+    @abstractmethod
+    def load_questions(self) -> dict[str, dict]:
+        """
+        Load the questions this solver solves, keyed by the question index, with the data each of them is solved
+        from (e.g. the results of the previous stage).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        """
+        Solve a single question, given its data from load_questions, and return its result.
+        """
+        raise NotImplementedError
+
+    def solve_versioned_question(self, question_index: int, question_data: dict) -> dict:
+        """
+        Solve the question, and save in its result the version of the stage and the version of the result.
+        """
+        # The input is fingerprinted before solving, since some stages update the question data in their result
+        result_version = self.get_result_version(question_index=question_index, question_data=question_data)
+        question_result = self.solve_question(question_index=question_index, question_data=question_data)
+        question_result[ImageDataEnum.STAGE_VERSION] = self.get_stage_version()
+        question_result[ImageDataEnum.RESULT_VERSION] = result_version
+        return question_result
+
+    def solve_question_or_dead_letter(self, question_index: int, question_data: dict) -> Optional[dict]:
+        """
+        Solve the question, and if it fails, save it in the dead letters file and return None, so the rest of the run
+        continues. Configuration errors (e.g. a wrong key or deployment) and max_consecutive_dead_letters failures in
+        a row are raised instead, since the other questions would fail the same way.
+        """
+        try:
+            question_result = self.solve_versioned_question(question_index=question_index, question_data=question_data)
+            with self.counters_lock:
+                self.consecutive_dead_letters = 0
+            return question_result
+        except Exception as e:
+            if is_configuration_error(e):
+                self.logger.error(f"Failed to solve question {question_index} with a configuration error, stopping "
+                                  f"the run. Error: {e}")
+                raise
+            record = self.dead_letters.add(
+                stage=type(self).__name__,
+                question_index=question_index,
+                question_data=question_data,
+                error=e,
+            )
+            self.logger.error(f"Failed to solve question {question_index} ({record[DeadLetterEnum.ERROR_CATEGORY]} "
+                              f"error), saved it in {self.dead_letters.file_path}. Error: {e}")
+            with self.counters_lock:
+                self.dead_lettered_questions += 1
+                self.consecutive_dead_letters += 1
+                consecutive_dead_letters = self.consecutive_dead_letters
+            if 0 < self.max_consecutive_dead_letters <= consecutive_dead_letters:
+                message = f"{consecutive_dead_letters} questions in a row failed, stopping the run."
+                self.logger.error(message)
+                raise RuntimeError(message) from e
+            return None
+
+    def solve_question_or_reuse(
+            self,
+            question_index: int,
+            question_data: dict,
+            previous_result: Optional[dict] = None
+    ) -> Optional[dict]:
+        """
+        Reuse the previous result of the question if it has the version the question would be solved with now (the
+        same stage version and the same input), and otherwise solve the question.
+        """
+        if previous_result is not None and previous_result.get(ImageDataEnum.RESULT_VERSION) == \
+                self.get_result_version(question_index=question_index, question_data=question_data):
+            with self.counters_lock:
+                self.reused_results += 1
+            return previous_result
+        return self.solve_question_or_dead_letter(question_index=question_index, question_data=question_data)
+
+    def get_version_parameters(self) -> dict:
+        """
+        The parameters of the stage, other than its prompt and its client, that change its results.
+        """
+        return {}
+
+    def get_stage_version(self) -> str:
+        """
+        The version of the stage: a hash of its prompt, the deployment and parameters of its client, and its own
+        parameters. It changes whenever one of them changes.
+        """
+        if self._stage_version is None:
+            self._stage_version = get_description_fingerprint(
+                type(self).__name__,
+                self.prompt,
+                json.dumps(self.gpt_client.get_version_parameters(), sort_keys=True, default=str),
+                json.dumps(self.get_version_parameters(), sort_keys=True, default=str),
+            )
+        return self._stage_version
+
+    def get_input_fingerprint(self, question_index: int, question_data: dict) -> str:
+        """
+        A hash of the input the question is solved from: the input fields of its data (e.g. the result of the previous
+        stage), without the versions of that data.
+        """
+        if self.input_fields is not None:
+            input_data = {field.value: question_data.get(field) for field in self.input_fields}
+        else:
+            input_data = {key: value for key, value in question_data.items() if key not in VERSION_FIELDS}
+        return get_description_fingerprint(question_index, json.dumps(input_data, sort_keys=True, default=str))
+
+    def get_result_version(self, question_index: int, question_data: dict) -> str:
+        """
+        The version of the result of the question: a hash of the stage version and of the question input.
+        """
+        return get_description_fingerprint(
+            self.get_stage_version(),
+            self.get_input_fingerprint(question_index=question_index, question_data=question_data),
+        )
+
+    def get_question_manifest(self) -> QuestionManifest:
+        """
+        Get the question manifest of the chosen split of the CLEVR-math dataset, or of the generated questions when a
+        synthetic questions file is configured. The manifest is loaded only once per shared data.
+        """
+        with self.shared_data.lock:
+            if self.clevr_math_dataset_name not in self.shared_data.manifests:
+                with tracing.span(tracing.SPAN_LOAD, dataset=self.clevr_math_dataset_name):
+                    self.shared_data.manifests[self.clevr_math_dataset_name] = self.load_question_manifest()
+            return self.shared_data.manifests[self.clevr_math_dataset_name]
+
+    def load_question_manifest(self) -> QuestionManifest:
+        """
+        Load the manifest of the chosen split from the question manifest file. If the file is missing or of another
+        split, the dataset is downloaded, and the manifest is built from its columns and saved in the file.
+        """
+        if self.synthetic_questions_file is not None:
+            return QuestionManifest.from_rows(load_synthetic_questions(self.synthetic_questions_file))
+
+        source = f"{self.clevr_math_dataset_name}:{ClevrMathLabelsEnum.CHOSEN_DATASET.value}"
+        manifest = QuestionManifest.load(self.question_manifest_file, source=source)
+        if manifest is None:
+            dataset = self.download_dataset(self.clevr_math_dataset_name)[ClevrMathLabelsEnum.CHOSEN_DATASET]
+            manifest = QuestionManifest.from_dataset(dataset, source=source)
+            manifest.save(self.question_manifest_file)
+            self.logger.info(f"Saved the question manifest of {source} in {self.question_manifest_file}")
+        return manifest
+
+    def get_question_record(self, question_index: int) -> QuestionRecord:
+        return self.get_question_manifest()[question_index]
+
+    def get_image_scene(self, image_id: str) -> list[dict]:
+        """
+        Get the objects of the image from the CLEVR scenes annotations. The scenes file is loaded only once per shared
+        data.
+        """
+        with self.shared_data.lock:
+            if self.clevr_val_scenes not in self.shared_data.scenes:
+                self.shared_data.scenes[self.clevr_val_scenes] = self.load_json_file(file_path=self.clevr_val_scenes)[
+                    ClevrDescriptionsEnum.SCENES
+                ]
+            scenes = self.shared_data.scenes[self.clevr_val_scenes]
+        image_index = self.get_image_index_from_id(image_id=image_id)
+        return scenes[image_index][ClevrDescriptionsEnum.OBJECTS]
+
+    def get_image_description(
+            self,
+            image_path: str,
+            source: DescriptionSourceEnum,
+            fingerprint: str,
+            create: Callable[[], str]
+    ) -> str:
+        """
+        Get the description of the objects in the image from the description cache, or create it with create (and
+        cache it) if it was not described yet from this source with this fingerprint.
+        """
+        if self.description_cache is None:
+            return create()
+        return self.description_cache.get_or_create(
+            image_path=image_path,
+            source=source,
+            fingerprint=fingerprint,
+            create=create
+        )
+
+    def get_scene_description(self, image_id: str, image_path: str) -> str:
+        """
+        Get the description of the objects in the image from its CLEVR scene annotations.
+        """
+        return self.get_image_description(
+            image_path=image_path,
+            source=DescriptionSourceEnum.CLEVR_SCENE,
+            fingerprint=get_description_fingerprint(SCENE_DESCRIPTION_VERSION, self.clevr_val_scenes.name, image_id),
+            create=lambda: describe_scene(self.get_image_scene(image_id=image_id)),
+        )
+
     @staticmethod
     def download_dataset(dataset_name: str):
         """
         Download the dataset from the Hugging Face hub.
+        datasets is imported here, since it is slow to import and most of the stages only read json files.
         """
+        from datasets import load_dataset, DownloadConfig
+
         dl_config = DownloadConfig(resume_download=True,
                                    num_proc=8,
                                    force_download=True)
@@ -44,12 +285,12 @@ class BaseGptClevrSolver(ABC):
 
     @staticmethod
     def load_json_file(file_path):
-        with open(file_path, "r") as f:
+        with tracing.span(tracing.SPAN_LOAD, file=str(file_path)), open(file_path, "r") as f:
             return json.load(f)
 
     @staticmethod
     def save_json_file(file_path, data):
-        with open(file_path, "w") as f:
+        with tracing.span(tracing.SPAN_PERSIST, file=str(file_path)), open(file_path, "w") as f:
             json.dump(data, f)
 
     @staticmethod
@@ -59,7 +300,7 @@ class BaseGptClevrSolver(ABC):
         Example of image_id: CLEVR_val_000000.png
         Corresponding image_index: 0
         """
-        return int(image_id.split(".")[0].split("_")[-1])
+        return get_scene_index(image_id)
 
     @staticmethod
     def extract_numeric_answer(text) -> Union[int, None]:
@@ -67,13 +308,78 @@ class BaseGptClevrSolver(ABC):
         Extracts the numeric answer from a text using regex.
 
         Args:
-        text (str): The text containing the numeric answer in the format 'My answer is: <numeric answer>'
+        text (str): The text containing the numeric answer in the format 'My answer is: <numeric answer>',
+        or a JSON object with an 'answer' key.
 
         Returns:
         int or None: The extracted numeric answer, or None if not found.
         """
-        match = re.search(r"My answer is: (\d+)", text)
-        return int(match.group(1)) if match else None
+        return answer_extraction.extract_numeric_answer(text)
+
+    def format_answer_prompt(self, prompt: str) -> str:
+        """
+        Add the JSON answer format instructions to the prompt, when the client uses structured output.
+        """
+        if self.gpt_client.structured_output:
+            return prompt + answer_extraction.ANSWER_JSON_FORMAT_INSTRUCTIONS
+        return prompt
+
+    def get_numerical_result(self, gpt_response: Optional[str]) -> Optional[int]:
+        """
+        Extract the numeric answer from the model response, and count the responses it could not be extracted from.
+        """
+        with tracing.span(tracing.SPAN_EXTRACTION):
+            numerical_result = self.extract_numeric_answer(text=gpt_response)
+        if numerical_result is None:
+            with self.counters_lock:
+                self.extraction_failures += 1
+            self.logger.warning(f"Failed to extract a numeric answer from the response: {gpt_response}")
+        return numerical_result
+
+    def answers_need_escalation(self, gpt_responses: list[str]) -> bool:
+        """
+        The responses are inconclusive when an answer can't be extracted from one of them, or when the sampled
+        answers disagree.
+        """
+        answers = [self.extract_numeric_answer(text=gpt_response) for gpt_response in gpt_responses]
+        return None in answers or len(set(answers)) > 1
+
+    def log_run_stats(self):
+        """
+        Log the statistics of the current run.
+        """
+        self.logger.info(f"Number of failed answer extractions: {self.extraction_failures}")
+        self.logger.info(f"Number of questions saved in the dead letters file: {self.dead_lettered_questions}")
+        if self.reused_results:
+            self.logger.info(f"Number of results reused from the previous run: {self.reused_results}")
+        if self.description_cache is not None:
+            for stat_name, value in self.description_cache.get_stats().items():
+                self.logger.info(f"{stat_name}: {value}")
+        for stat_name, value in self.gpt_client.get_run_stats().items():
+            self.logger.info(f"{stat_name}: {value}")
+
+    def get_answer_fields(self, gpt_responses: list[str]) -> dict:
+        """
+        Get the answer fields of a question result from the model responses.
+        When several responses were sampled (self-consistency), the answer is the majority vote of their answers,
+        the saved response is the first one that agrees with it, and all the responses and the vote distribution are
+        saved as well.
+        """
+        answers = [self.get_numerical_result(gpt_response=gpt_response) for gpt_response in gpt_responses]
+        if len(gpt_responses) == 1:
+            return {
+                ImageDataEnum.GPT_RESPONSE: gpt_responses[0],
+                ImageDataEnum.NUMERICAL_RESULT: answers[0],
+            }
+
+        numerical_result, vote_distribution = answer_extraction.majority_vote(answers)
+        gpt_response = gpt_responses[answers.index(numerical_result)]
+        return {
+            ImageDataEnum.GPT_RESPONSE: gpt_response,
+            ImageDataEnum.NUMERICAL_RESULT: numerical_result,
+            ImageDataEnum.GPT_RESPONSES: gpt_responses,
+            ImageDataEnum.VOTE_DISTRIBUTION: vote_distribution,
+        }
 
     @staticmethod
     def get_number_of_correct_answers(results: dict[int, dict]) -> int:
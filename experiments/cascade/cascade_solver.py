@@ -0,0 +1,264 @@
+import threading
+from logging import Logger
+from pathlib import Path
+from typing import Optional, Sequence
+
+from conf.data_config import DataConfig
+from conf.gpt4_lang_config import GPT4LangConfig
+from conf.gpt_4_vision_config import Gpt4VisionConfig
+from data_enums.answer_source_enum import AnswerSourceEnum
+from data_enums.confidence_method_enum import ConfidenceMethodEnum
+from data_enums.image_data_enum import ImageDataEnum
+from experiments.one_step.one_step_gpt import OneStepGPT
+from experiments.two_step.objects_counter import ObjectsCounter
+from experiments.two_step.objects_parser import ObjectsParser
+from experiments.two_step.two_step_gpt_vision import TwoStepGptVision
+from gpt_clients.gpt4_lang_client import Gpt4LangClient
+from gpt_clients.gpt4_vision_client import Gpt4VisionClient
+from utils.answer_extraction import answer_token_confidence, vote_agreement
+from utils.logger import init_logger
+from utils.progress import tqdm
+from utils.question_manifest import QuestionRecord
+from utils.tracing import trace_question
+
+DEFAULT_THRESHOLDS = (0.0, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 1.0)
+
+
+class CascadeSolver(OneStepGPT):
+    """
+    This class is used to solve the questions from CLEVR-math with a cascade: each question is first solved in the
+    one-step approach, and only when the model is not confident enough in its answer, the question is escalated to
+    the two-stage approach (objects parsing, objects counting and solving with the counts).
+    The confidence is either the probability of the answer tokens, or the agreement of self-consistency samples.
+    """
+    def __init__(
+            self,
+            data_config: DataConfig,
+            gpt_client: Gpt4VisionClient,
+            objects_parser: ObjectsParser,
+            objects_counter: ObjectsCounter,
+            two_step_gpt: TwoStepGptVision,
+            logger: Logger
+    ):
+        super().__init__(data_config=data_config, gpt_client=gpt_client, logger=logger)
+        self.objects_parser = objects_parser
+        self.objects_counter = objects_counter
+        self.two_step_gpt = two_step_gpt
+        self.cascade_results_file: Path = data_config.cascade_results_file
+        self.cascade_tradeoff_file: Path = data_config.cascade_tradeoff_file
+        self.two_step_gpt_vision_results_file: Path = data_config.two_step_gpt_vision_results_file
+        self.confidence_threshold: float = data_config.cascade_confidence_threshold
+        self.confidence_method = ConfidenceMethodEnum(data_config.cascade_confidence_method)
+        self.confidence_method_lock = threading.Lock()
+        self.escalated_questions: int = 0
+
+    def solve_questions(self) -> dict[int, dict]:
+        """
+        Iterate over the questions from the one step experiment and solve them with the cascade.
+        """
+        self.logger.info("Starting questions solving")
+        results = {}
+
+        try:
+            for question_index, question_data in tqdm(self.load_questions().items()):
+                question_index = int(question_index)
+                question_result = self.solve_question_or_dead_letter(
+                    question_index=question_index,
+                    question_data=question_data
+                )
+                if question_result is not None:
+                    results[question_index] = question_result
+
+        except Exception as e:
+            self.logger.exception(f"Error while solving questions: {e}")
+            raise e
+        finally:
+            return results
+
+    def get_version_parameters(self) -> dict:
+        """
+        The escalated questions are solved by the two-stage solvers, so their versions are part of the cascade version.
+        """
+        return {
+            "confidence_threshold": self.confidence_threshold,
+            "confidence_method": self.confidence_method.value,
+            "objects_parser": self.objects_parser.get_stage_version(),
+            "objects_counter": self.objects_counter.get_stage_version(),
+            "two_step_gpt": self.two_step_gpt.get_stage_version(),
+        }
+
+    @trace_question
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        question_record = self.get_question_record(question_index)
+        question_result = self.get_cascade_result(question_record=question_record)
+        with self.counters_lock:
+            self.questions_counter[question_record.template] += 1
+        return question_result
+
+    def get_cascade_result(self, question_record: QuestionRecord) -> dict:
+        """
+        Solve the question in the one-step approach, and escalate it to the two-stage approach if the one-step
+        answer confidence is below the threshold.
+        """
+        one_step_result = self.get_question_result(question_record=question_record)
+        confidence = one_step_result[ImageDataEnum.CONFIDENCE]
+        if confidence is not None and confidence >= self.confidence_threshold:
+            return {**one_step_result, ImageDataEnum.ESCALATED: False}
+
+        with self.counters_lock:
+            self.escalated_questions += 1
+        parsing_result = self.objects_parser.get_question_parsing_result(question_data=one_step_result)
+        counting_result = self.objects_counter.get_counting_result(
+            question_data=parsing_result,
+            parsing_result=parsing_result[ImageDataEnum.PARSING_RESULT],
+        )
+        two_step_result = self.two_step_gpt.get_question_result(
+            question_data=counting_result,
+            parsing_result=counting_result[ImageDataEnum.PARSING_RESULT],
+            counting_result=counting_result[ImageDataEnum.COUNTING_RESULT],
+        )
+        return {**two_step_result, ImageDataEnum.ESCALATED: True, ImageDataEnum.ONE_STEP_RESULT: one_step_result}
+
+    def get_question_result(self, question_record: QuestionRecord) -> dict:
+        """
+        Call the GPT model to solve the question in the one-step approach, and measure its confidence in the answer.
+        """
+        image_path = question_record.image_path
+        question = question_record.question
+        prompt = self.format_answer_prompt(self.prompt.format(question=question))
+
+        if self.confidence_method == ConfidenceMethodEnum.LOGPROBS:
+            gpt_response, token_logprobs = self.gpt_client.get_vision_model_response_with_logprobs(
+                image_path=image_path,
+                prompt=prompt,
+                json_response=True,
+            )
+            if not token_logprobs:
+                self.fall_back_to_self_consistency()
+            else:
+                result = self.create_result(
+                    gpt_responses=[gpt_response],
+                    image_path=image_path,
+                    question=question,
+                    question_record=question_record,
+                )
+                confidence = answer_token_confidence(token_logprobs, result[ImageDataEnum.NUMERICAL_RESULT])
+
+        if self.confidence_method == ConfidenceMethodEnum.SELF_CONSISTENCY:
+            gpt_responses = self.gpt_client.get_vision_model_responses(
+                image_path=image_path,
+                prompt=prompt,
+                json_response=True,
+                n=max(self.gpt_client.self_consistency_samples, 2),
+            )
+            result = self.create_result(
+                gpt_responses=gpt_responses,
+                image_path=image_path,
+                question=question,
+                question_record=question_record,
+            )
+            confidence = vote_agreement(result[ImageDataEnum.VOTE_DISTRIBUTION], len(gpt_responses))
+
+        result[ImageDataEnum.CONFIDENCE] = confidence
+        return result
+
+    def fall_back_to_self_consistency(self):
+        """
+        Deployments that don't return logprobs (e.g. some Azure API versions) return empty token logprobs, so every
+        answer would have no confidence and be escalated. The confidence is measured with self-consistency instead,
+        for the rest of the run.
+        """
+        with self.confidence_method_lock:
+            if self.confidence_method == ConfidenceMethodEnum.SELF_CONSISTENCY:
+                return
+            self.logger.warning("The GPT deployment returned no logprobs, the answers confidence is measured with "
+                                "self-consistency instead")
+            self.confidence_method = ConfidenceMethodEnum.SELF_CONSISTENCY
+
+    @staticmethod
+    def get_two_step_calls(two_step_result: dict) -> int:
+        """
+        The number of GPT calls of a question in the two-stage approach: parsing, counting and solving, unless the
+        question was solved locally from the counts.
+        """
+        solved_locally = two_step_result.get(ImageDataEnum.ANSWER_SOURCE) == AnswerSourceEnum.LOCAL_SOLVER
+        return 2 if solved_locally else 3
+
+    @classmethod
+    def get_tradeoff_curve(
+            cls,
+            cascade_results: dict[str, dict],
+            two_step_results: dict[str, dict],
+            thresholds: Sequence[float] = DEFAULT_THRESHOLDS
+    ) -> list[dict]:
+        """
+        Compute the accuracy and the number of GPT calls of the cascade for each confidence threshold.
+        The one step answers and confidences are taken from the cascade results, and the answers of the escalated
+        questions from the results of the full two-stage run, so the curve can be computed without any new calls.
+        Only the questions that appear in both results are used.
+        """
+        question_indices = [question_index for question_index in cascade_results if question_index in two_step_results]
+        number_of_questions = len(question_indices)
+        curve = []
+        for threshold in thresholds:
+            correct_answers = 0
+            gpt_calls = 0
+            escalated_questions = 0
+            for question_index in question_indices:
+                cascade_result = cascade_results[question_index]
+                one_step_result = cascade_result.get(ImageDataEnum.ONE_STEP_RESULT, cascade_result)
+                confidence: Optional[float] = one_step_result.get(ImageDataEnum.CONFIDENCE)
+                gpt_calls += 1
+                if confidence is not None and confidence >= threshold:
+                    correct_answers += one_step_result.get(ImageDataEnum.IS_CORRECT) is True
+                else:
+                    two_step_result = two_step_results[question_index]
+                    escalated_questions += 1
+                    gpt_calls += cls.get_two_step_calls(two_step_result)
+                    correct_answers += two_step_result.get(ImageDataEnum.IS_CORRECT) is True
+
+            curve.append({
+                "threshold": threshold,
+                "accuracy": correct_answers / number_of_questions if number_of_questions else None,
+                "escalated_questions": escalated_questions,
+                "gpt_calls": gpt_calls,
+                "gpt_calls_per_question": gpt_calls / number_of_questions if number_of_questions else None,
+            })
+        return curve
+
+
+def main():
+    logger = init_logger(file_name="cascade_solver.log")
+
+    gpt_vision_client = Gpt4VisionClient(config=Gpt4VisionConfig(), logger=logger)
+    gpt_lang_client = Gpt4LangClient(config=GPT4LangConfig(), logger=logger)
+
+    config = DataConfig()
+    cascade_solver = CascadeSolver(
+        data_config=config,
+        gpt_client=gpt_vision_client,
+        objects_parser=ObjectsParser(data_config=config, gpt_client=gpt_lang_client, logger=logger),
+        objects_counter=ObjectsCounter(data_config=config, gpt_client=gpt_vision_client, logger=logger),
+        two_step_gpt=TwoStepGptVision(data_config=config, gpt_client=gpt_vision_client, logger=logger),
+        logger=logger,
+    )
+    answers = cascade_solver.solve_questions()
+
+    cascade_solver.save_json_file(file_path=cascade_solver.cascade_results_file, data=answers)
+    logger.info(f"Finished solving questions.")
+    logger.info(f"Number of correct answers: {cascade_solver.get_number_of_correct_answers(results=answers)}")
+    logger.info(f"Number of questions escalated to the two step approach: {cascade_solver.escalated_questions}")
+    cascade_solver.log_run_stats()
+
+    if cascade_solver.two_step_gpt_vision_results_file.exists():
+        tradeoff_curve = cascade_solver.get_tradeoff_curve(
+            cascade_results=cascade_solver.load_json_file(cascade_solver.cascade_results_file),
+            two_step_results=cascade_solver.load_json_file(cascade_solver.two_step_gpt_vision_results_file),
+        )
+        cascade_solver.save_json_file(file_path=cascade_solver.cascade_tradeoff_file, data=tradeoff_curve)
+        for point in tradeoff_curve:
+            logger.info(f"Accuracy/cost trade-off: {point}")
+
+
+if __name__ == "__main__":
+    main()
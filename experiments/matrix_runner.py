@@ -0,0 +1,275 @@
+"""
+Run several experiment stages together in one process: `python twostagegpt.py matrix [--stages <stage> ...]`.
+
+The stages share the CLEVR-math dataset, the CLEVR scenes and the GPT clients (with their connections, request
+semaphores and encoded images), and their questions are solved by a single thread pool, so the requests of all the
+stages are interleaved under one concurrency budget. A stage whose input stage is also run (e.g. the objects counter
+with the objects parser) solves each question as soon as its input stage solved it, from its result, instead of
+reading the results file of the input stage. The other stages solve the questions they load, optionally limited to
+the questions of a questions file. The results are saved in a separate directory (data/matrix_results by default), so
+the results files of the paper are not overwritten.
+
+Every result is saved with the version it was solved with: a hash of the stage prompt, client deployment and
+parameters, and of the question input (e.g. the result of the input stage). The results of the previous run are
+reused when their version did not change, so after changing the prompt of a stage, only that stage and the questions
+of the next stages whose inputs changed are solved again.
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import chain, zip_longest
+from logging import Logger
+from pathlib import Path
+from typing import Optional
+
+from conf.data_config import DataConfig
+from experiments.base_gpt_clevr_solver import BaseGptClevrSolver, SharedClevrData
+from experiments.stages import STAGES, ClientPool, Stage
+from utils import metrics, tracing
+from utils.logger import init_logger
+from utils.progress import tqdm
+
+# The stages of the experiments of the paper
+PAPER_STAGES = (
+    "one_step_gpt",
+    "one_step_gpt_cot",
+    "oracle_one_step",
+    "simple_object_detector",
+    "objects_parser",
+    "objects_counter",
+    "two_step_gpt_vision",
+    "oracle_parser",
+    "oracle_two_step",
+)
+DEFAULT_CONCURRENCY = 16
+DEFAULT_IMAGE_ENCODING_CACHE_SIZE = 1024
+
+
+class ExperimentMatrix:
+    """
+    Solves the questions of several stages with shared data and clients, and a single thread pool.
+    """
+    def __init__(
+            self,
+            stages: list[Stage],
+            data_config: DataConfig,
+            logger: Logger,
+            client_pool: ClientPool,
+            concurrency: int = DEFAULT_CONCURRENCY
+    ):
+        self.stages = stages
+        self.logger = logger
+        self.concurrency = concurrency
+        shared_data = SharedClevrData()
+        self.solvers: dict[str, BaseGptClevrSolver] = {}
+        for stage in stages:
+            solver = stage.create_solver(data_config, logger, client_pool)
+            solver.shared_data = shared_data
+            self.solvers[stage.name] = solver
+
+        stage_names = {stage.name for stage in stages}
+        self.dependent_stages: dict[str, list[Stage]] = {
+            stage.name: [dependent_stage for dependent_stage in stages if dependent_stage.input_stage == stage.name]
+            for stage in stages
+        }
+        self.root_stages = [stage for stage in stages if stage.input_stage not in stage_names]
+        self.results: dict[str, dict[str, dict]] = {stage.name: {} for stage in stages}
+        # The results of the previous run, that are reused when their version did not change
+        self.previous_results: dict[str, dict[str, dict]] = {stage.name: {} for stage in stages}
+        self._pending_questions = 0
+        self._condition = threading.Condition()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._progress_bar = None
+
+    def load_previous_results(self, data_config: DataConfig, output_dir: Path):
+        """
+        Load the results every stage saved in the previous run, from the files in output_dir the results of this run
+        are saved in.
+        """
+        for stage in self.stages:
+            results_file = self.get_results_file(stage=stage, data_config=data_config, output_dir=output_dir)
+            if not Path(results_file).exists():
+                continue
+            self.previous_results[stage.name] = self.solvers[stage.name].load_json_file(file_path=results_file)
+            self.logger.info(f"Loaded {len(self.previous_results[stage.name])} previous results of the stage "
+                             f"{stage.name} from {results_file}")
+
+    def load_root_questions(
+            self,
+            question_indices: Optional[set[str]] = None,
+            max_questions: Optional[int] = None
+    ) -> dict[str, list[tuple[str, dict]]]:
+        """
+        The questions of every stage whose input stage is not run, limited to question_indices when it is given.
+        """
+        root_questions = {}
+        for stage in self.root_stages:
+            questions = [
+                (str(question_index), question_data)
+                for question_index, question_data in self.solvers[stage.name].load_questions().items()
+                if question_indices is None or str(question_index) in question_indices
+            ]
+            root_questions[stage.name] = questions[:max_questions]
+            self.logger.info(f"Loaded {len(root_questions[stage.name])} questions of the stage {stage.name}")
+        return root_questions
+
+    def run(
+            self,
+            question_indices: Optional[set[str]] = None,
+            max_questions: Optional[int] = None
+    ) -> dict[str, dict[str, dict]]:
+        """
+        Solve the questions of all the stages, and return the results of each stage.
+        The questions of the stages are submitted in turns, so all the stages progress together.
+        """
+        root_questions = self.load_root_questions(question_indices=question_indices, max_questions=max_questions)
+        stages_questions = [
+            [(stage, question_index, question_data) for question_index, question_data in root_questions[stage.name]]
+            for stage in self.root_stages
+        ]
+        interleaved_questions = [
+            question for question in chain.from_iterable(zip_longest(*stages_questions)) if question is not None
+        ]
+
+        metrics.add_collector(self.collect_metrics)
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor, \
+                    tqdm(total=len(interleaved_questions)) as progress_bar:
+                self._executor = executor
+                self._progress_bar = progress_bar
+                for stage, question_index, question_data in interleaved_questions:
+                    self.submit(stage=stage, question_index=question_index, question_data=question_data)
+                with self._condition:
+                    self._condition.wait_for(lambda: self._pending_questions == 0)
+        finally:
+            metrics.remove_collector(self.collect_metrics)
+        return self.results
+
+    def submit(self, stage: Stage, question_index: str, question_data: dict):
+        with self._condition:
+            self._pending_questions += 1
+        future = self._executor.submit(self.solve, stage, question_index, question_data, time.time_ns())
+        future.add_done_callback(self._question_done)
+
+    def solve(self, stage: Stage, question_index: str, question_data: dict, submit_time_ns: int):
+        """
+        Solve the question in the stage, or reuse its previous result, and submit it to the stages that take the result
+        as their input.
+        """
+        tracing.add_span(tracing.SPAN_QUEUE_WAIT, start_time_ns=submit_time_ns, end_time_ns=time.time_ns(),
+                         question_index=int(question_index), stage=stage.name)
+        question_result = self.solvers[stage.name].solve_question_or_reuse(
+            question_index=int(question_index),
+            question_data=question_data,
+            previous_result=self.previous_results[stage.name].get(question_index),
+        )
+        if question_result is None:
+            return
+
+        with self._condition:
+            self.results[stage.name][question_index] = question_result
+            self._progress_bar.total += len(self.dependent_stages[stage.name])
+            self._progress_bar.refresh()
+        for dependent_stage in self.dependent_stages[stage.name]:
+            self.submit(stage=dependent_stage, question_index=question_index, question_data=question_result)
+
+    def _question_done(self, future: Future):
+        if future.exception() is not None:
+            self.logger.error(f"Failed to solve a question: {future.exception()!r}")
+        with self._condition:
+            self._pending_questions -= 1
+            self._progress_bar.update(1)
+            self._condition.notify_all()
+
+    def collect_metrics(self) -> list[metrics.Sample]:
+        """
+        The number of questions that were submitted and not solved yet, as a live metrics sample.
+        """
+        return [(metrics.QUEUE_QUESTIONS, metrics.get_labels({"queue": "matrix", "status": "pending"}),
+                 self._pending_questions)]
+
+    @staticmethod
+    def get_results_file(stage: Stage, data_config: DataConfig, output_dir: Path) -> Path:
+        """
+        The file in output_dir with the name of the results file of the stage.
+        """
+        return output_dir.joinpath(Path(stage.get_results_file(data_config)).name)
+
+    def save_results(self, data_config: DataConfig, output_dir: Path):
+        """
+        Save the results of every stage in output_dir, in a file with the name of its results file. The results files
+        of the stages themselves (e.g. the results of the paper) are not overwritten.
+        """
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for stage in self.stages:
+            results_file = self.get_results_file(stage=stage, data_config=data_config, output_dir=output_dir)
+            self.solvers[stage.name].save_json_file(file_path=results_file, data=self.results[stage.name])
+            self.logger.info(f"Saved the results of {len(self.results[stage.name])} questions of the stage "
+                             f"{stage.name} in {results_file}")
+
+    def log_run_stats(self):
+        for stage in self.stages:
+            self.logger.info(f"Statistics of the stage {stage.name}:")
+            self.solvers[stage.name].log_run_stats()
+
+
+def load_question_indices(questions_file: Path) -> set[str]:
+    """
+    The question indices of a results file (json), or of a file with a question index in every line (e.g. the
+    sampled keys for validation).
+    """
+    if questions_file.suffix == ".json":
+        return {str(question_index) for question_index in BaseGptClevrSolver.load_json_file(questions_file)}
+    with open(questions_file, "r") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run several experiment stages together, with shared data and "
+                                                 "clients, and one concurrency budget.")
+    parser.add_argument("--stages", nargs="+", choices=sorted(STAGES), default=list(PAPER_STAGES),
+                        help="The stages to run. Defaults to the stages of all the experiments of the paper.")
+    parser.add_argument("--questions-file", type=Path, default=None,
+                        help="Solve only the questions of this results file (json) or question indices file.")
+    parser.add_argument("--max-questions", type=int, default=None,
+                        help="The maximal number of questions of every stage that has no input stage in the run.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="The number of questions that are solved at the same time, by all the stages together.")
+    parser.add_argument("--image-cache-size", type=int, default=DEFAULT_IMAGE_ENCODING_CACHE_SIZE,
+                        help="The number of encoded images the shared vision client keeps in memory.")
+    parser.add_argument("--output-dir", type=Path, default=None,
+                        help="Save the results files in this directory. Defaults to matrix_results_dir of the "
+                             "DataConfig (data/matrix_results).")
+    parser.add_argument("--recompute-all", action="store_true",
+                        help="Solve all the questions again, instead of reusing the results of the previous run whose "
+                             "version did not change.")
+    args = parser.parse_args()
+
+    from conf.gpt_4_vision_config import Gpt4VisionConfig
+
+    logger = init_logger(file_name="matrix_runner.log")
+    data_config = DataConfig()
+    client_pool = ClientPool(
+        logger=logger,
+        vision_config=Gpt4VisionConfig(image_encoding_cache_size=args.image_cache_size),
+    )
+    output_dir = args.output_dir if args.output_dir is not None else data_config.matrix_results_dir
+    stages = [STAGES[stage_name] for stage_name in dict.fromkeys(args.stages)]
+    experiment_matrix = ExperimentMatrix(
+        stages=stages,
+        data_config=data_config,
+        logger=logger,
+        client_pool=client_pool,
+        concurrency=args.concurrency,
+    )
+    if not args.recompute_all:
+        experiment_matrix.load_previous_results(data_config=data_config, output_dir=output_dir)
+    question_indices = load_question_indices(args.questions_file) if args.questions_file is not None else None
+    experiment_matrix.run(question_indices=question_indices, max_questions=args.max_questions)
+    experiment_matrix.save_results(data_config=data_config, output_dir=output_dir)
+    experiment_matrix.log_run_stats()
+
+
+if __name__ == "__main__":
+    main()
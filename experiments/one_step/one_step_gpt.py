@@ -1,18 +1,18 @@
 from collections import Counter
 from logging import Logger
 from pathlib import Path
-from random import randint
-from typing import Any
+from random import shuffle
 
-from tqdm import tqdm
-
-from data_enums.clevr_math_labels_enum import ClevrMathLabelsEnum
 from conf.gpt_4_vision_config import Gpt4VisionConfig
 from conf.data_config import DataConfig
 from data_enums.image_data_enum import ImageDataEnum
 from experiments.base_gpt_clevr_solver import BaseGptClevrSolver
 from gpt_clients.gpt4_vision_client import Gpt4VisionClient
+from utils.description_cache import get_description_fingerprint
 from utils.logger import init_logger
+from utils.progress import tqdm
+from utils.question_manifest import QuestionRecord
+from utils.tracing import trace_question
 
 
 class OneStepGPT(BaseGptClevrSolver):
@@ -52,58 +52,97 @@ class OneStepGPT(BaseGptClevrSolver):
 
         try:
             questions_solved = 0
-            dataset = self.download_dataset(self.clevr_math_dataset_name)[ClevrMathLabelsEnum.CHOSEN_DATASET]
-            # rand index to start from
-            progress_bar = tqdm(total=self.number_of_questions_to_solve - questions_solved)
-
-            while questions_solved < self.number_of_questions_to_solve:
-                i = randint(0, len(dataset) - 1)
-                question_data = dataset[i]
-                template = question_data[ClevrMathLabelsEnum.TEMPLATE]
-                if self.questions_counter[template] >= self.limit_question_type or i in results:
+            manifest = self.get_question_manifest()
+            progress_bar = tqdm(total=self.number_of_questions_to_solve)
+            # Every question is tried at most once, in a random order, until enough questions are solved
+            question_indices = list(range(len(manifest)))
+            shuffle(question_indices)
+
+            for i in question_indices:
+                if questions_solved >= self.number_of_questions_to_solve:
+                    break
+                if self.questions_counter[manifest.templates[i]] >= self.limit_question_type:
                     continue
 
-                question_result = self.get_question_result(question_data=question_data)
+                # solve_question reads the question from the dataset and updates the counters
+                question_result = self.solve_question_or_dead_letter(question_index=i, question_data={})
+                if question_result is None:
+                    continue
                 results[i] = question_result
-                # update counters
-                self.questions_counter[template] += 1
                 questions_solved += 1
                 progress_bar.update(1)
 
+            if questions_solved < self.number_of_questions_to_solve:
+                self.logger.warning(f"Solved only {questions_solved} questions, no other question is left to solve.")
+
         finally:
             return results
 
-    def get_question_result(self, question_data: dict[str, Any]) -> dict[str, str]:
+    def load_questions(self) -> dict[str, dict]:
+        """
+        The questions that were sampled in the one step experiment.
+        """
+        return self.load_json_file(self.one_step_gpt_results_file)
+
+    def get_input_fingerprint(self, question_index: int, question_data: dict) -> str:
+        """
+        The question is solved from the dataset, so its input is the question record, and not the question data.
+        """
+        question_record = self.get_question_record(question_index)
+        return get_description_fingerprint(
+            question_index,
+            question_record.image_path,
+            question_record.question,
+            question_record.label,
+        )
+
+    @trace_question
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        """
+        Solve the question with the given index from the dataset.
+        """
+        question_record = self.get_question_record(question_index)
+        question_result = self.get_question_result(question_record=question_record)
+        # update counters
+        with self.counters_lock:
+            self.questions_counter[question_record.template] += 1
+        return question_result
+
+    def get_question_result(self, question_record: QuestionRecord) -> dict[str, str]:
         """
         Call the GPT model to solve the question and return the result.
         """
         # prepare the data for the gpt model and get the response
-        image_path = question_data[ClevrMathLabelsEnum.IMAGE].filename
-        question = question_data[ClevrMathLabelsEnum.QUESTION]
-        prompt = self.prompt.format(question=question)
-        gpt_response = self.gpt_client.get_vision_model_response(image_path, prompt)
+        image_path = question_record.image_path
+        question = question_record.question
+        prompt = self.format_answer_prompt(self.prompt.format(question=question))
+        gpt_responses = self.gpt_client.get_vision_model_responses(
+            image_path,
+            prompt,
+            json_response=True,
+            needs_escalation=self.answers_need_escalation
+        )
 
         return self.create_result(
-            gpt_response=gpt_response,
+            gpt_responses=gpt_responses,
             image_path=image_path,
             question=question,
-            question_data=question_data
+            question_record=question_record
         )
 
-    def create_result(self, gpt_response, image_path, question, question_data):
-        template = question_data[ClevrMathLabelsEnum.TEMPLATE]
-        image_id = question_data[ClevrMathLabelsEnum.ID]
-        label = question_data[ClevrMathLabelsEnum.LABEL]
-        numerical_result = self.extract_numeric_answer(text=gpt_response)
-        is_correct = label == numerical_result
+    def create_result(self, gpt_responses, image_path, question, question_record: QuestionRecord):
+        template = question_record.template
+        image_id = question_record.image_id
+        label = question_record.label
+        answer_fields = self.get_answer_fields(gpt_responses=gpt_responses)
+        is_correct = label == answer_fields[ImageDataEnum.NUMERICAL_RESULT]
         result = {
             ImageDataEnum.IMAGE_PATH: image_path,
             ImageDataEnum.IMAGE_ID: image_id,
             ImageDataEnum.QUESTION: question,
             ImageDataEnum.TEMPLATE: template,
             ImageDataEnum.LABEL: label,
-            ImageDataEnum.GPT_RESPONSE: gpt_response,
-            ImageDataEnum.NUMERICAL_RESULT: numerical_result,
+            **answer_fields,
             ImageDataEnum.IS_CORRECT: is_correct,
         }
         return result
@@ -115,7 +154,7 @@ class OneStepGPT(BaseGptClevrSolver):
         return self.gpt_client.get_vision_model_response(image_path, prompt)
 
 
-if __name__ == "__main__":
+def main():
     logger = init_logger(file_name="one_step_gpt.log")
 
     gpt_config = Gpt4VisionConfig()
@@ -127,3 +166,8 @@ if __name__ == "__main__":
 
     one_step_gpt.save_json_file(file_path=one_step_gpt.one_step_gpt_results_file, data=answers)
     print(one_step_gpt.questions_counter)
+    one_step_gpt.log_run_stats()
+
+
+if __name__ == "__main__":
+    main()
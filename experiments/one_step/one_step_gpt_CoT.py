@@ -1,13 +1,12 @@
 from logging import Logger
 from pathlib import Path
-from tqdm import tqdm
 
 from conf.gpt_4_vision_config import Gpt4VisionConfig
 from conf.data_config import DataConfig
-from data_enums.clevr_math_labels_enum import ClevrMathLabelsEnum
 from gpt_clients.gpt4_vision_client import Gpt4VisionClient
 from utils.logger import init_logger
-from one_step_gpt import OneStepGPT
+from utils.progress import tqdm
+from experiments.one_step.one_step_gpt import OneStepGPT
 
 
 class OneStepGPTCot(OneStepGPT):
@@ -20,12 +19,15 @@ class OneStepGPTCot(OneStepGPT):
         self.cot_subtraction_image: str = data_config.cot_subtraction_image
         self.cot_addition_image: str = data_config.cot_addition_image
         self.cot_one_step_gpt_results_file: Path = data_config.one_step_gpt_cot_results_file
-        self.one_step_gpt_results_file: Path = Path(__file__).parent.joinpath(
+        self.one_step_gpt_results_file: Path = Path(__file__).parent.parent.parent.joinpath(
             "data",
             "validation_set_results",
             "one_step_gpt_results.json"
         )
 
+    def get_version_parameters(self) -> dict:
+        return {"cot_subtraction_image": self.cot_subtraction_image, "cot_addition_image": self.cot_addition_image}
+
     @property
     def prompt(self) -> str:
         prompt = (
@@ -45,17 +47,14 @@ class OneStepGPTCot(OneStepGPT):
         results = {}
 
         try:
-            one_step_gpt_results = self.load_json_file(self.one_step_gpt_results_file)
-            dataset = self.download_dataset(self.clevr_math_dataset_name)[ClevrMathLabelsEnum.CHOSEN_DATASET]
-
-            for question_index in tqdm(one_step_gpt_results.keys()):
+            for question_index, question_data in tqdm(self.load_questions().items()):
                 question_index = int(question_index)
-                question_data = dataset[question_index]
-                template = question_data[ClevrMathLabelsEnum.TEMPLATE]
-                question_result = self.get_question_result(question_data=question_data)
-                results[question_index] = question_result
-                # update counters
-                self.questions_counter[template] += 1
+                question_result = self.solve_question_or_dead_letter(
+                    question_index=question_index,
+                    question_data=question_data
+                )
+                if question_result is not None:
+                    results[question_index] = question_result
 
         except Exception as e:
             self.logger.exception(f"Error while solving questions: {e}")
@@ -67,8 +66,8 @@ class OneStepGPTCot(OneStepGPT):
         """
         This function is adding the chain of thought prompt to the model's request.
         """
-        encoded_subtraction_image = self.gpt_client.encode_image(self.cot_subtraction_image)
-        encoded_addition_image = self.gpt_client.encode_image(self.cot_addition_image)
+        encoded_subtraction_image = self.gpt_client.get_encoded_image(self.cot_subtraction_image)
+        encoded_addition_image = self.gpt_client.get_encoded_image(self.cot_addition_image)
         chain_of_thought_messages = [
             {
                 "role": "user",
@@ -138,8 +137,8 @@ class OneStepGPTCot(OneStepGPT):
         )
 
 
-if __name__ == "__main__":
-    logger = init_logger(file_name="one_step_gpt.log")
+def main():
+    logger = init_logger(file_name="one_step_gpt_cot.log")
 
     gpt_config = Gpt4VisionConfig()
     gpt_vision_client = Gpt4VisionClient(config=gpt_config, logger=logger)
@@ -151,4 +150,8 @@ if __name__ == "__main__":
     one_step_gpt_cot.save_json_file(file_path=one_step_gpt_cot.cot_one_step_gpt_results_file, data=answers)
     logger.info(f"Finished solving questions.")
     logger.info(f"Number of correct answers: {one_step_gpt_cot.get_number_of_correct_answers(results=answers)}")
+    one_step_gpt_cot.log_run_stats()
 
+
+if __name__ == "__main__":
+    main()
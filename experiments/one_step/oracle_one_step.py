@@ -1,16 +1,15 @@
 from logging import Logger
 from pathlib import Path
-from typing import Any
-
-from tqdm import tqdm
 
 from conf.gpt_4_vision_config import Gpt4VisionConfig
 from conf.data_config import DataConfig
-from data_enums.clevr_descriptions_enum import ClevrDescriptionsEnum
-from data_enums.clevr_math_labels_enum import ClevrMathLabelsEnum
 from gpt_clients.gpt4_vision_client import Gpt4VisionClient
 from utils.logger import init_logger
-from one_step_gpt import OneStepGPT
+from utils.progress import tqdm
+from utils.question_manifest import QuestionRecord
+from utils.tracing import trace_question
+from experiments.base_gpt_clevr_solver import SCENE_DESCRIPTION_VERSION
+from experiments.one_step.one_step_gpt import OneStepGPT
 
 
 class OracleOneStep(OneStepGPT):
@@ -23,12 +22,15 @@ class OracleOneStep(OneStepGPT):
     def __init__(self, data_config: DataConfig, gpt_client: Gpt4VisionClient, logger: Logger):
         super().__init__(data_config=data_config, gpt_client=gpt_client, logger=logger)
         self.oracle_one_step_results_file: Path = data_config.oracle_one_step_results_file
-        self.one_step_gpt_results_file: Path = Path(__file__).parent.joinpath(
+        self.one_step_gpt_results_file: Path = Path(__file__).parent.parent.parent.joinpath(
             "data",
             "validation_set_results",
             "one_step_gpt_results.json"
         )
 
+    def get_version_parameters(self) -> dict:
+        return {"scene_description_version": SCENE_DESCRIPTION_VERSION, "scenes": self.clevr_val_scenes.name}
+
     @property
     def prompt(self) -> str:
         prompt = ("Answer the following <question>, based on the given image. You are also provided with a description "
@@ -51,25 +53,14 @@ class OracleOneStep(OneStepGPT):
         results = {}
 
         try:
-            one_step_gpt_results = self.load_json_file(self.one_step_gpt_results_file)
-            dataset = self.download_dataset(self.clevr_math_dataset_name)[ClevrMathLabelsEnum.CHOSEN_DATASET]
-            clevr_val_scenes = self.load_json_file(file_path=self.clevr_val_scenes)[ClevrDescriptionsEnum.SCENES]
-
-            for question_index in tqdm(one_step_gpt_results.keys()):
+            for question_index, question_data in tqdm(self.load_questions().items()):
                 question_index = int(question_index)
-                question_data = dataset[question_index]
-                template = question_data[ClevrMathLabelsEnum.TEMPLATE]
-
-                # Get the image scene
-                image_id = question_data[ClevrMathLabelsEnum.ID]
-                image_index = self.get_image_index_from_id(image_id=image_id)
-                image_data = clevr_val_scenes[image_index]
-                image_scene = image_data[ClevrDescriptionsEnum.OBJECTS]
-
-                question_result = self.get_question_result_with_scenes(question_data=question_data, image_scene=image_scene)
-                results[question_index] = question_result
-                # update counters
-                self.questions_counter[template] += 1
+                question_result = self.solve_question_or_dead_letter(
+                    question_index=question_index,
+                    question_data=question_data
+                )
+                if question_result is not None:
+                    results[question_index] = question_result
 
         except Exception as e:
             self.logger.exception(f"Error while solving questions: {e}")
@@ -77,26 +68,50 @@ class OracleOneStep(OneStepGPT):
         finally:
             return results
 
-    def get_question_result_with_scenes(self, question_data: dict[str, Any], image_scene: dict) -> dict[str, str]:
-        image_path = question_data[ClevrMathLabelsEnum.IMAGE].filename
-        question = question_data[ClevrMathLabelsEnum.QUESTION]
-
-        description = "The image contains the following objects:\n"
-        for data in image_scene:
-            description += f"{data['size']} {data['color']} {data['material']} {data['shape']}\n"
-
-        prompt = self.prompt.format(question=question, description=description)
-        gpt_response = self.gpt_client.get_vision_model_response(image_path, prompt)
+    @trace_question
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        """
+        Solve the question with the given index from the dataset, with the description of its image scene.
+        """
+        question_record = self.get_question_record(question_index)
+        description = self.get_scene_description(
+            image_id=question_record.image_id,
+            image_path=question_record.image_path
+        )
+        question_result = self.get_question_result_with_description(
+            question_record=question_record,
+            description=description
+        )
+        # update counters
+        with self.counters_lock:
+            self.questions_counter[question_record.template] += 1
+        return question_result
+
+    def get_question_result_with_description(
+            self,
+            question_record: QuestionRecord,
+            description: str
+    ) -> dict[str, str]:
+        image_path = question_record.image_path
+        question = question_record.question
+
+        prompt = self.format_answer_prompt(self.prompt.format(question=question, description=description))
+        gpt_responses = self.gpt_client.get_vision_model_responses(
+            image_path,
+            prompt,
+            json_response=True,
+            needs_escalation=self.answers_need_escalation
+        )
 
         return self.create_result(
-            gpt_response=gpt_response,
+            gpt_responses=gpt_responses,
             image_path=image_path,
             question=question,
-            question_data=question_data
+            question_record=question_record
         )
 
 
-if __name__ == "__main__":
+def main():
     logger = init_logger(file_name="oracle_one_step_gpt.log")
 
     gpt_config = Gpt4VisionConfig()
@@ -109,3 +124,8 @@ if __name__ == "__main__":
     oracle_one_step_gpt_cot.save_json_file(file_path=oracle_one_step_gpt_cot.oracle_one_step_results_file, data=answers)
     logger.info(f"Finished solving questions.")
     logger.info(f"Number of correct answers: {oracle_one_step_gpt_cot.get_number_of_correct_answers(results=answers)}")
+    oracle_one_step_gpt_cot.log_run_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,85 @@
+import json
+import re
 from logging import Logger
 from pathlib import Path
-from tqdm import tqdm
+from typing import Optional
 
 from conf.data_config import DataConfig
 from conf.gpt_4_vision_config import Gpt4VisionConfig
+from data_enums.description_source_enum import DescriptionSourceEnum
 from data_enums.image_data_enum import ImageDataEnum
 from experiments.base_gpt_clevr_solver import BaseGptClevrSolver
-from gpt_clients.gpt4_vision_client import Gpt4VisionClient
-from utils.logger import init_logger
+from gpt_clients.gpt4_vision_client import IMAGE_LABEL, Gpt4VisionClient
+from utils.answer_extraction import JSON_OBJECT_PATTERN
+from utils.description_cache import get_description_fingerprint
+from utils.logger import init_logger, log_context
+from utils.progress import tqdm
+from utils.tracing import trace_question
+
+TOTAL_OBJECTS_PATTERN = re.compile(r"(\d+) objects in total", re.IGNORECASE)
+DETECTIONS_JSON_KEY = "detections"
+IMAGE_JSON_KEY = "image"
+DETECTION_JSON_KEY = "detection"
+# The maximal number of images the vision deployments accept in one request
+MAX_IMAGES_PER_REQUEST = 10
+# A generous estimate of the response tokens of the detection of a single image, in the packed JSON response
+DETECTION_RESPONSE_TOKENS = 120
+# The number of packed requests in a row that demultiplexed all their images, before packing one more image
+PACKING_INCREASE_AFTER_SUCCESSES = 3
+
+
+class AdaptivePackingFactor:
+    """
+    The number of images to pack in a request. It is halved when a packed response misses images (e.g. it was cut at
+    the max tokens), and grows back by one image after a few packed responses in a row had all the images.
+    At least two images are packed, so there are packed responses to grow back from.
+    """
+    def __init__(self, max_factor: int):
+        self.max_factor = max(1, max_factor)
+        self.min_factor = min(2, self.max_factor)
+        self.factor = self.max_factor
+        self.successes_in_a_row = 0
+
+    def update(self, all_images_detected: bool):
+        if not all_images_detected:
+            self.factor = max(self.min_factor, self.factor // 2)
+            self.successes_in_a_row = 0
+            return
+        self.successes_in_a_row += 1
+        if self.successes_in_a_row >= PACKING_INCREASE_AFTER_SUCCESSES and self.factor < self.max_factor:
+            self.factor += 1
+            self.successes_in_a_row = 0
 
 
 class SimpleObjectDetector(BaseGptClevrSolver):
+    input_fields = (
+        ImageDataEnum.IMAGE_PATH,
+        ImageDataEnum.IMAGE_ID,
+        ImageDataEnum.QUESTION,
+        ImageDataEnum.NUMBER_OF_OBJECTS,
+    )
+
     def __init__(self, data_config: DataConfig, gpt_client: Gpt4VisionClient, logger: Logger):
         super().__init__(data_config=data_config, gpt_client=gpt_client, logger=logger)
         self.gpt_client: Gpt4VisionClient = gpt_client
         self.simple_object_detection_results_file: Path = data_config.simple_object_detection_results_file
         self.one_step_gpt_results_file: Path = data_config.one_step_gpt_results_file
         self.sampled_questions: Path = data_config.sampled_keys_for_validation
+        # The packing factor is limited by the response tokens of the packed detections
+        self.max_images_per_request: int = min(
+            data_config.object_detection_max_images_per_request,
+            MAX_IMAGES_PER_REQUEST,
+            max(1, self.gpt_client.max_tokens // DETECTION_RESPONSE_TOKENS),
+        )
+        # The cached detections are created again when the prompts or the model change
+        self.detection_fingerprint: str = get_description_fingerprint(
+            self.prompt,
+            self.packed_prompt,
+            self.gpt_client.deployment_name,
+            self.gpt_client.temperature,
+        )
+        # The detections of the packed responses by the image path, until their questions are solved
+        self.packed_detections: dict[str, str] = {}
 
     @property
     def prompt(self) -> str:
@@ -30,6 +93,23 @@ class SimpleObjectDetector(BaseGptClevrSolver):
         )
         return prompt
 
+    @property
+    def packed_prompt(self) -> str:
+        prompt = (
+            "You are given {number_of_images} images, each preceded by its label "
+            f"('{IMAGE_LABEL} 1:', '{IMAGE_LABEL} 2:', ...). "
+            "Describe and count the objects in each of the images separately.\n"
+            "In each description, describe the objects by the following attributes: "
+            "color, size (small/large), shape(sphere/cube/cylinder) and material(shiny/matte).\n"
+            "Conclude each description with the total number of objects in the image.\n"
+            "For example: There are 2 large shiny spheres, 1 small shiny cube, 1 large matte cylinder, "
+            "and 4 objects in total.\n"
+            "Respond only with a JSON object in the following format, with an entry for every image:\n"
+            f'{{{{"{DETECTIONS_JSON_KEY}": [{{{{"{IMAGE_JSON_KEY}": <image number>, '
+            f'"{DETECTION_JSON_KEY}": "<the description of the objects in the image>"}}}}, ...]}}}}'
+        )
+        return prompt
+
     def solve_questions(self) -> dict[int, dict]:
         """
         Iterate over the images from the test experiment and solve the questions.
@@ -39,22 +119,17 @@ class SimpleObjectDetector(BaseGptClevrSolver):
         results = {}
 
         try:
-            one_step_gpt_results = self.load_json_file(self.one_step_gpt_results_file)
-            sampled_keys = self.load_sampled_keys_list(self.sampled_questions)
-
-            for question_index, question_data in tqdm(one_step_gpt_results.items()):
-                question_index = int(question_index)
-                if question_index not in sampled_keys:
-                    continue
-                image_path = question_data[ImageDataEnum.IMAGE_PATH]
-                detection_result = self.detect_objects(image_path=image_path)
-                results[question_index] = {
-                    "detection_result": detection_result,
-                    "number_of_objects": question_data.get("number_of_objects", None),
-                    ImageDataEnum.IMAGE_PATH: image_path,
-                    ImageDataEnum.IMAGE_ID: question_data[ImageDataEnum.IMAGE_ID],
-                    ImageDataEnum.QUESTION: question_data[ImageDataEnum.QUESTION]
-                }
+            if self.max_images_per_request > 1:
+                self.solve_questions_packed(results=results)
+            else:
+                for question_index, question_data in tqdm(self.load_questions().items()):
+                    question_index = int(question_index)
+                    question_result = self.solve_question_or_dead_letter(
+                        question_index=question_index,
+                        question_data=question_data
+                    )
+                    if question_result is not None:
+                        results[question_index] = question_result
 
         except Exception as e:
             self.logger.exception(f"Error while solving questions: {e}")
@@ -62,14 +137,208 @@ class SimpleObjectDetector(BaseGptClevrSolver):
         finally:
             return results
 
+    def get_version_parameters(self) -> dict:
+        return {"packed_prompt": self.packed_prompt}
+
+    def load_questions(self) -> dict[str, dict]:
+        """
+        The questions from the one step experiment that were sampled for validation.
+        """
+        one_step_gpt_results = self.load_json_file(self.one_step_gpt_results_file)
+        sampled_keys = self.load_sampled_keys_list(self.sampled_questions)
+        return {
+            question_index: question_data
+            for question_index, question_data in one_step_gpt_results.items()
+            if int(question_index) in sampled_keys
+        }
+
+    def solve_questions_packed(self, results: dict[int, dict]):
+        """
+        Detect the objects of several images in each request, and demultiplex the detections back to their
+        questions, adding their results. The number of images in each request adapts to the packed responses that
+        missed images.
+        """
+        packing_factor = AdaptivePackingFactor(max_factor=self.max_images_per_request)
+        pending_questions = []
+        for question_index, question_data in self.load_questions().items():
+            if self.get_cached_detection(image_path=question_data[ImageDataEnum.IMAGE_PATH]) is not None:
+                self.solve_packed_question(question_index=int(question_index), question_data=question_data,
+                                           results=results)
+            else:
+                pending_questions.append((int(question_index), question_data))
+        self.logger.info(f"Found the detections of {len(results)} images in the description cache.")
+        progress_bar = tqdm(total=len(pending_questions))
+        while pending_questions:
+            packed_questions = dict(pending_questions[:packing_factor.factor])
+            pending_questions = pending_questions[packing_factor.factor:]
+            all_images_detected = self.solve_packed_questions(packed_questions=packed_questions, results=results)
+            packing_factor.update(all_images_detected=all_images_detected)
+            progress_bar.update(len(packed_questions))
+
+    def solve_packed_questions(self, packed_questions: dict[int, dict], results: dict[int, dict]) -> bool:
+        """
+        Solve the packed questions and add their results. The images that are missing from the packed response are
+        sent again in two smaller packs, and an image that is missing even when it's sent alone is solved with the
+        single image prompt.
+        Returns True if the response had the detections of all the packed images.
+        """
+        if len(packed_questions) == 1:
+            [(question_index, question_data)] = packed_questions.items()
+            self.solve_packed_question(question_index=question_index, question_data=question_data, results=results)
+            return True
+
+        detection_results = self.detect_objects_packed(packed_questions=packed_questions)
+        for question_index, detection_result in detection_results.items():
+            image_path = packed_questions[question_index][ImageDataEnum.IMAGE_PATH]
+            self.cache_detection(image_path=image_path, detection_result=detection_result)
+            self.packed_detections[image_path] = detection_result
+            self.solve_packed_question(
+                question_index=question_index,
+                question_data=packed_questions[question_index],
+                results=results
+            )
+
+        missing_questions = [
+            (question_index, question_data) for question_index, question_data in packed_questions.items()
+            if question_index not in detection_results
+        ]
+        if not missing_questions:
+            return True
+        self.logger.info(f"The packed response missed {len(missing_questions)} of {len(packed_questions)} images, "
+                         f"sending them again in smaller packs.")
+        middle = (len(missing_questions) + 1) // 2
+        for smaller_pack in (missing_questions[:middle], missing_questions[middle:]):
+            if smaller_pack:
+                self.solve_packed_questions(packed_questions=dict(smaller_pack), results=results)
+        return False
+
+    def solve_packed_question(self, question_index: int, question_data: dict, results: dict[int, dict]):
+        """
+        Solve the question and add its result, like the questions that aren't packed, so it is traced and versioned.
+        Its detection is taken from the packed response or from the description cache, if it has one.
+        """
+        question_result = self.solve_question_or_dead_letter(question_index=question_index, question_data=question_data)
+        if question_result is not None:
+            results[question_index] = question_result
+
+    def detect_objects_packed(self, packed_questions: dict[int, dict]) -> dict[int, str]:
+        """
+        Detect the objects in the images of the questions in a single request.
+        Returns the detection results of the images that the response has conclusive detections for, by the question
+        index. A failed request returns no detections, so its questions are sent again in smaller packs.
+        """
+        question_indices = list(packed_questions)
+        image_paths = [
+            packed_questions[question_index][ImageDataEnum.IMAGE_PATH] for question_index in question_indices
+        ]
+        with log_context(stage=type(self).__name__, question_indices=question_indices):
+            try:
+                gpt_response = self.gpt_client.get_vision_model_response_for_images(
+                    image_paths=image_paths,
+                    prompt=self.packed_prompt.format(number_of_images=len(image_paths)),
+                    json_response=True,
+                )
+            except Exception as e:
+                self.logger.warning(f"Failed to detect the objects of the questions {question_indices} in a packed "
+                                    f"request. Error: {e}")
+                return {}
+
+        detections = self.parse_packed_detections(gpt_response=gpt_response, number_of_images=len(image_paths))
+        return {
+            question_indices[image_number - 1]: detection_result
+            for image_number, detection_result in detections.items()
+            if not self.detection_needs_escalation(detection_result)
+        }
+
+    @staticmethod
+    def parse_packed_detections(gpt_response: str, number_of_images: int) -> dict[int, str]:
+        """
+        Parse the detections of a packed response, by the image number (starting from 1).
+        Detections of unknown images are ignored, and a response that isn't valid JSON (e.g. it was cut at the max
+        tokens) has no detections.
+        """
+        match = JSON_OBJECT_PATTERN.search(gpt_response or "")
+        if match is None:
+            return {}
+        try:
+            response = json.loads(match.group(0))
+        except json.JSONDecodeError:
+            return {}
+        detections = {}
+        entries = response.get(DETECTIONS_JSON_KEY) if isinstance(response, dict) else None
+        for entry in entries if isinstance(entries, list) else []:
+            if not isinstance(entry, dict) or not isinstance(entry.get(DETECTION_JSON_KEY), str):
+                continue
+            image_number = entry.get(IMAGE_JSON_KEY)
+            if isinstance(image_number, int) and 1 <= image_number <= number_of_images:
+                detections.setdefault(image_number, entry[DETECTION_JSON_KEY])
+        return detections
+
+    @trace_question
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        image_path = question_data[ImageDataEnum.IMAGE_PATH]
+        detection_result = self.detect_objects(image_path=image_path)
+        return self.create_result(question_data=question_data, detection_result=detection_result)
+
+    @staticmethod
+    def create_result(question_data: dict, detection_result: str) -> dict:
+        return {
+            ImageDataEnum.DETECTION_RESULT: detection_result,
+            ImageDataEnum.NUMBER_OF_OBJECTS: question_data.get(ImageDataEnum.NUMBER_OF_OBJECTS, None),
+            ImageDataEnum.IMAGE_PATH: question_data[ImageDataEnum.IMAGE_PATH],
+            ImageDataEnum.IMAGE_ID: question_data[ImageDataEnum.IMAGE_ID],
+            ImageDataEnum.QUESTION: question_data[ImageDataEnum.QUESTION]
+        }
+
     def detect_objects(self, image_path: str) -> str:
         """
         Call the GPT model to solve the question and return the result.
+        The detection of the image is reused from the packed response or from the description cache if it was
+        already detected.
         """
-        # prepare the data for the gpt model and get the response
-        gpt_response = self.gpt_client.get_vision_model_response(image_path, self.prompt)
+        packed_detection = self.packed_detections.pop(image_path, None)
+        if packed_detection is not None:
+            return packed_detection
 
-        return gpt_response
+        def create_detection() -> str:
+            # prepare the data for the gpt model and get the response
+            return self.gpt_client.get_vision_model_response(
+                image_path,
+                self.prompt,
+                needs_escalation=self.detection_needs_escalation
+            )
+
+        return self.get_image_description(
+            image_path=image_path,
+            source=DescriptionSourceEnum.GPT_DETECTION,
+            fingerprint=self.detection_fingerprint,
+            create=create_detection
+        )
+
+    def get_cached_detection(self, image_path: str) -> Optional[str]:
+        if self.description_cache is None:
+            return None
+        return self.description_cache.get(
+            image_path=image_path,
+            source=DescriptionSourceEnum.GPT_DETECTION,
+            fingerprint=self.detection_fingerprint
+        )
+
+    def cache_detection(self, image_path: str, detection_result: str):
+        if self.description_cache is not None:
+            self.description_cache.put(
+                image_path=image_path,
+                source=DescriptionSourceEnum.GPT_DETECTION,
+                fingerprint=self.detection_fingerprint,
+                description=detection_result
+            )
+
+    @staticmethod
+    def detection_needs_escalation(detection_result: str) -> bool:
+        """
+        A detection result is inconclusive when it does not conclude with the total number of objects.
+        """
+        return TOTAL_OBJECTS_PATTERN.search(detection_result) is None
 
     def load_sampled_keys_list(self, sampled_questions) -> set[int]:
         """
@@ -83,7 +352,7 @@ class SimpleObjectDetector(BaseGptClevrSolver):
         return sampled_keys
 
 
-if __name__ == "__main__":
+def main():
     logger = init_logger(file_name="simple_object_detector.log")
 
     gpt_config = Gpt4VisionConfig()
@@ -96,3 +365,8 @@ if __name__ == "__main__":
     detector.save_json_file(file_path=detector.simple_object_detection_results_file, data=answers)
     logger.info(f"Finished detecting objects.")
     logger.info(f"Results saved in {detector.simple_object_detection_results_file}")
+    detector.log_run_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Run an experiment stage with several workers, on one or more machines, through a SQLite work queue.
+
+1. `python -m experiments.queue_worker --queue <queue.db> init --stage <stage>` adds the stage questions to the queue.
+2. `python -m experiments.queue_worker --queue <queue.db> work` starts a worker. Start as many workers as needed,
+   at any point of the run, on any machine that can access the queue file.
+3. `python -m experiments.queue_worker --queue <queue.db> status` shows the progress of the run.
+4. `python -m experiments.queue_worker --queue <queue.db> merge` saves the results of all the workers in the stage
+   results file.
+"""
+import argparse
+from pathlib import Path
+
+from conf.data_config import DataConfig
+from experiments.stages import STAGES, Stage
+from utils.logger import init_logger
+from utils.work_queue import SqliteWorkQueue, get_default_worker_id, run_worker
+
+STAGE_METADATA_KEY = "stage"
+
+
+def get_queue_stage(args, queue: SqliteWorkQueue) -> Stage:
+    """
+    The stage the queue was initialized for.
+    """
+    stage_name = queue.get_metadata(STAGE_METADATA_KEY)
+    if stage_name is None:
+        raise ValueError(f"The queue {args.queue} was not initialized, run the init command with the stage first.")
+    return STAGES[stage_name]
+
+
+def init_queue(args, queue: SqliteWorkQueue, data_config: DataConfig, logger):
+    stage = STAGES[args.stage]
+    existing_stage = queue.get_metadata(STAGE_METADATA_KEY)
+    if existing_stage is not None and existing_stage != stage.name:
+        raise ValueError(f"The queue {args.queue} was already initialized for the stage {existing_stage}.")
+
+    queue.set_metadata(STAGE_METADATA_KEY, stage.name)
+    solver = stage.create_solver(data_config, logger)
+    added_questions = queue.enqueue(solver.load_questions())
+    logger.info(f"Added {added_questions} questions of the stage {stage.name} to the queue {args.queue}.")
+
+
+def work(args, queue: SqliteWorkQueue, data_config: DataConfig, logger):
+    stage = get_queue_stage(args, queue)
+    solver = stage.create_solver(data_config, logger)
+    run_worker(
+        queue=queue,
+        solve_question=solver.solve_versioned_question,
+        logger=logger,
+        worker_id=args.worker_id,
+        batch_size=args.batch_size,
+        poll_interval_seconds=args.poll_interval,
+    )
+    solver.log_run_stats()
+
+
+def show_status(args, queue: SqliteWorkQueue, data_config: DataConfig, logger):
+    print(f"Stage: {queue.get_metadata(STAGE_METADATA_KEY)}")
+    for status, count in queue.get_status_counts().items():
+        print(f"{status}: {count}")
+    for question_index, error in queue.get_failures().items():
+        print(f"Question {question_index} failed: {error}")
+
+
+def retry_failed(args, queue: SqliteWorkQueue, data_config: DataConfig, logger):
+    logger.info(f"Moved {queue.retry_failed()} failed questions back to the queue.")
+
+
+def merge(args, queue: SqliteWorkQueue, data_config: DataConfig, logger):
+    stage = get_queue_stage(args, queue)
+    output_file = args.output if args.output is not None else stage.get_results_file(data_config)
+    if queue.has_unfinished_questions():
+        logger.warning("Some of the questions are not done yet, merging only the results of the done questions.")
+    results = queue.merge(output_file=output_file)
+    logger.info(f"Saved the results of {len(results)} questions in {output_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an experiment stage with several workers through a work queue.")
+    parser.add_argument("--queue", type=Path, required=True, help="The SQLite queue file.")
+    parser.add_argument("--lease-seconds", type=float, default=300,
+                        help="Questions of a worker that stopped sending heartbeats are retried after this time.")
+    parser.add_argument("--max-attempts", type=int, default=3)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = subparsers.add_parser("init", help="Add the questions of a stage to the queue.")
+    init_parser.add_argument("--stage", choices=sorted(STAGES), required=True)
+    init_parser.set_defaults(handler=init_queue)
+
+    work_parser = subparsers.add_parser("work", help="Solve questions from the queue until it is empty.")
+    work_parser.add_argument("--worker-id", default=get_default_worker_id())
+    work_parser.add_argument("--batch-size", type=int, default=1, help="The number of questions to lease at once.")
+    work_parser.add_argument("--poll-interval", type=float, default=10,
+                             help="Seconds to wait for leases of other workers to expire when no question is pending.")
+    work_parser.set_defaults(handler=work)
+
+    status_parser = subparsers.add_parser("status", help="Show the number of questions in each status.")
+    status_parser.set_defaults(handler=show_status)
+
+    retry_parser = subparsers.add_parser("retry-failed", help="Move the failed questions back to the queue.")
+    retry_parser.set_defaults(handler=retry_failed)
+
+    merge_parser = subparsers.add_parser("merge", help="Save the results of all the workers in a results file.")
+    merge_parser.add_argument("--output", type=Path, default=None,
+                              help="The results file. Defaults to the results file of the stage.")
+    merge_parser.set_defaults(handler=merge)
+
+    args = parser.parse_args()
+    logger = init_logger(file_name="queue_worker.log")
+    queue = SqliteWorkQueue(db_path=args.queue, lease_seconds=args.lease_seconds, max_attempts=args.max_attempts)
+    args.handler(args, queue=queue, data_config=DataConfig(), logger=logger)
+
+
+if __name__ == "__main__":
+    main()
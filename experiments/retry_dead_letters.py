@@ -0,0 +1,74 @@
+"""
+Re-drive the questions of a stage that were saved in the dead letters file, and add their results to the stage
+results file. The questions that fail again are saved in the dead letters file again.
+A question is removed from the dead letters file only after it was retried, so the questions that were not retried
+when the run stopped (e.g. on a configuration error) are kept for the next retry.
+
+`python -m experiments.retry_dead_letters --stage <stage>`, after the stage run finished.
+"""
+import argparse
+from pathlib import Path
+
+from conf.data_config import DataConfig
+from data_enums.dead_letter_enum import DeadLetterEnum
+from data_enums.error_category_enum import ErrorCategoryEnum
+from experiments.stages import STAGES
+from utils.logger import init_logger
+from utils.progress import tqdm
+
+DEFAULT_CATEGORIES = (ErrorCategoryEnum.RETRYABLE.value, ErrorCategoryEnum.PERMANENT.value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retry the questions of a stage from the dead letters file.")
+    parser.add_argument("--stage", choices=sorted(STAGES), required=True)
+    parser.add_argument("--categories", nargs="+", choices=[category.value for category in ErrorCategoryEnum],
+                        default=DEFAULT_CATEGORIES,
+                        help="Retry only the questions that failed with errors of these categories. The content "
+                             "filtered questions are not retried by default, since they are likely to fail again.")
+    parser.add_argument("--output", type=Path, default=None,
+                        help="The results file to add the results to. Defaults to the results file of the stage.")
+    args = parser.parse_args()
+
+    logger = init_logger(file_name="retry_dead_letters.log")
+    data_config = DataConfig()
+    stage = STAGES[args.stage]
+    output_file = args.output if args.output is not None else stage.get_results_file(data_config)
+    solver = stage.create_solver(data_config, logger)
+
+    records = solver.dead_letters.select(
+        stage=type(solver).__name__,
+        categories={ErrorCategoryEnum(category) for category in args.categories},
+    )
+    logger.info(f"Retrying {len(records)} questions of the stage {stage.name} from {solver.dead_letters.file_path}")
+
+    results = solver.load_json_file(file_path=output_file) if Path(output_file).exists() else {}
+    solved_questions = 0
+    # The records that were solved, or that failed again and were saved in the file as new records
+    retried_records = []
+    try:
+        for record in tqdm(records):
+            question_index = int(record[DeadLetterEnum.QUESTION_INDEX])
+            dead_lettered_questions = solver.dead_lettered_questions
+            try:
+                question_result = solver.solve_question_or_dead_letter(
+                    question_index=question_index,
+                    question_data=record[DeadLetterEnum.QUESTION_DATA]
+                )
+            finally:
+                # Also when the run stops after saving the question again (too many failures in a row)
+                if solver.dead_lettered_questions > dead_lettered_questions:
+                    retried_records.append(record)
+            if question_result is not None:
+                retried_records.append(record)
+                results[str(question_index)] = question_result
+                solved_questions += 1
+    finally:
+        solver.dead_letters.remove(retried_records)
+        solver.save_json_file(file_path=output_file, data=results)
+        logger.info(f"Solved {solved_questions} of {len(records)} questions, results saved in {output_file}")
+        solver.log_run_stats()
+
+
+if __name__ == "__main__":
+    main()
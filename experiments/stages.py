@@ -0,0 +1,176 @@
+"""
+Module for the registry of the experiment stages that can be run question by question, e.g. by the queue workers.
+
+Each stage is created by a factory function that imports its solver and GPT client only when the stage is used.
+The GPT clients come from a client pool, so the stages created with the same pool share their clients.
+"""
+import threading
+from dataclasses import dataclass
+from logging import Logger
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional
+
+from conf.data_config import DataConfig
+from experiments.base_gpt_clevr_solver import BaseGptClevrSolver
+
+if TYPE_CHECKING:
+    from conf.base_gpt_config import BaseGptConfig
+    from gpt_clients.gpt4_lang_client import Gpt4LangClient
+    from gpt_clients.gpt4_vision_client import Gpt4VisionClient
+
+
+class ClientPool:
+    """
+    The GPT clients of the stages. Each client is created when it is first used, and shared by all the stages that
+    are created with the pool, with its connections and image encodings.
+    By default, the clients are created with the configs from the environment.
+    """
+    def __init__(
+            self,
+            logger: Logger,
+            vision_config: Optional["BaseGptConfig"] = None,
+            lang_config: Optional["BaseGptConfig"] = None
+    ):
+        self.logger = logger
+        self.vision_config = vision_config
+        self.lang_config = lang_config
+        self._vision_client: Optional["Gpt4VisionClient"] = None
+        self._lang_client: Optional["Gpt4LangClient"] = None
+        self._lock = threading.Lock()
+
+    def get_vision_client(self) -> "Gpt4VisionClient":
+        with self._lock:
+            if self._vision_client is None:
+                from conf.gpt_4_vision_config import Gpt4VisionConfig
+                from gpt_clients.gpt4_vision_client import Gpt4VisionClient
+                self._vision_client = Gpt4VisionClient(
+                    config=self.vision_config if self.vision_config is not None else Gpt4VisionConfig(),
+                    logger=self.logger
+                )
+            return self._vision_client
+
+    def get_lang_client(self) -> "Gpt4LangClient":
+        with self._lock:
+            if self._lang_client is None:
+                from conf.gpt4_lang_config import GPT4LangConfig
+                from gpt_clients.gpt4_lang_client import Gpt4LangClient
+                self._lang_client = Gpt4LangClient(
+                    config=self.lang_config if self.lang_config is not None else GPT4LangConfig(),
+                    logger=self.logger
+                )
+            return self._lang_client
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    factory: Callable[[DataConfig, Logger, ClientPool], BaseGptClevrSolver]
+    # The DataConfig attribute of the file the stage results are saved in
+    results_file_attribute: str
+    # The stage whose results are the questions of this stage (solve_question takes the result of the question in
+    # that stage), or None if the stage solves the questions from the dataset or the sampled questions
+    input_stage: Optional[str] = None
+
+    def create_solver(
+            self,
+            data_config: DataConfig,
+            logger: Logger,
+            client_pool: Optional[ClientPool] = None
+    ) -> BaseGptClevrSolver:
+        return self.factory(data_config, logger, client_pool if client_pool is not None else ClientPool(logger))
+
+    def get_results_file(self, data_config: DataConfig) -> Path:
+        return getattr(data_config, self.results_file_attribute)
+
+
+def create_one_step_gpt(data_config: DataConfig, logger: Logger, client_pool: ClientPool) -> BaseGptClevrSolver:
+    from experiments.one_step.one_step_gpt import OneStepGPT
+    return OneStepGPT(data_config=data_config, gpt_client=client_pool.get_vision_client(), logger=logger)
+
+
+def create_one_step_gpt_cot(data_config: DataConfig, logger: Logger, client_pool: ClientPool) -> BaseGptClevrSolver:
+    from experiments.one_step.one_step_gpt_CoT import OneStepGPTCot
+    return OneStepGPTCot(data_config=data_config, gpt_client=client_pool.get_vision_client(), logger=logger)
+
+
+def create_oracle_one_step(data_config: DataConfig, logger: Logger, client_pool: ClientPool) -> BaseGptClevrSolver:
+    from experiments.one_step.oracle_one_step import OracleOneStep
+    return OracleOneStep(data_config=data_config, gpt_client=client_pool.get_vision_client(), logger=logger)
+
+
+def create_simple_object_detector(
+        data_config: DataConfig,
+        logger: Logger,
+        client_pool: ClientPool
+) -> BaseGptClevrSolver:
+    from experiments.one_step.simple_object_detector import SimpleObjectDetector
+    return SimpleObjectDetector(data_config=data_config, gpt_client=client_pool.get_vision_client(), logger=logger)
+
+
+def create_objects_parser(data_config: DataConfig, logger: Logger, client_pool: ClientPool) -> BaseGptClevrSolver:
+    from experiments.two_step.objects_parser import ObjectsParser
+    return ObjectsParser(data_config=data_config, gpt_client=client_pool.get_lang_client(), logger=logger)
+
+
+def create_objects_counter(data_config: DataConfig, logger: Logger, client_pool: ClientPool) -> BaseGptClevrSolver:
+    from experiments.two_step.objects_counter import ObjectsCounter
+    return ObjectsCounter(data_config=data_config, gpt_client=client_pool.get_vision_client(), logger=logger)
+
+
+def create_two_step_gpt_vision(data_config: DataConfig, logger: Logger, client_pool: ClientPool) -> BaseGptClevrSolver:
+    from experiments.two_step.two_step_gpt_vision import TwoStepGptVision
+    return TwoStepGptVision(data_config=data_config, gpt_client=client_pool.get_vision_client(), logger=logger)
+
+
+def create_fused_count_and_solve(
+        data_config: DataConfig,
+        logger: Logger,
+        client_pool: ClientPool
+) -> BaseGptClevrSolver:
+    from experiments.two_step.fused_count_and_solve import FusedCountAndSolve
+    return FusedCountAndSolve(data_config=data_config, gpt_client=client_pool.get_vision_client(), logger=logger)
+
+
+def create_oracle_parser(data_config: DataConfig, logger: Logger, client_pool: ClientPool) -> BaseGptClevrSolver:
+    from experiments.two_step.oracle_parser import OracleObjectsParser
+    return OracleObjectsParser(data_config=data_config, gpt_client=client_pool.get_lang_client(), logger=logger)
+
+
+def create_oracle_two_step(data_config: DataConfig, logger: Logger, client_pool: ClientPool) -> BaseGptClevrSolver:
+    from experiments.two_step.oracle_two_step import OracleTwoStep
+    return OracleTwoStep(data_config=data_config, gpt_client=client_pool.get_vision_client(), logger=logger)
+
+
+def create_cascade_solver(data_config: DataConfig, logger: Logger, client_pool: ClientPool) -> BaseGptClevrSolver:
+    from experiments.cascade.cascade_solver import CascadeSolver
+    from experiments.two_step.objects_counter import ObjectsCounter
+    from experiments.two_step.objects_parser import ObjectsParser
+    from experiments.two_step.two_step_gpt_vision import TwoStepGptVision
+
+    gpt_vision_client = client_pool.get_vision_client()
+    return CascadeSolver(
+        data_config=data_config,
+        gpt_client=gpt_vision_client,
+        objects_parser=ObjectsParser(data_config=data_config, gpt_client=client_pool.get_lang_client(), logger=logger),
+        objects_counter=ObjectsCounter(data_config=data_config, gpt_client=gpt_vision_client, logger=logger),
+        two_step_gpt=TwoStepGptVision(data_config=data_config, gpt_client=gpt_vision_client, logger=logger),
+        logger=logger,
+    )
+
+
+STAGES: dict[str, Stage] = {
+    stage.name: stage for stage in (
+        Stage("one_step_gpt", create_one_step_gpt, "one_step_gpt_results_file"),
+        Stage("one_step_gpt_cot", create_one_step_gpt_cot, "one_step_gpt_cot_results_file"),
+        Stage("oracle_one_step", create_oracle_one_step, "oracle_one_step_results_file"),
+        Stage("simple_object_detector", create_simple_object_detector, "simple_object_detection_results_file"),
+        Stage("objects_parser", create_objects_parser, "objects_parsing_results_file"),
+        Stage("objects_counter", create_objects_counter, "object_counting_results_file", "objects_parser"),
+        Stage("two_step_gpt_vision", create_two_step_gpt_vision, "two_step_gpt_vision_results_file", "objects_counter"),
+        Stage("fused_count_and_solve", create_fused_count_and_solve, "fused_count_and_solve_results_file",
+              "objects_parser"),
+        Stage("oracle_parser", create_oracle_parser, "oracle_parsing_results_file"),
+        Stage("oracle_two_step", create_oracle_two_step, "oracle_two_step_results_file", "oracle_parser"),
+        Stage("cascade_solver", create_cascade_solver, "cascade_results_file"),
+    )
+}
@@ -0,0 +1,222 @@
+import json
+from logging import Logger
+from pathlib import Path
+from typing import Any, Optional
+
+from conf.gpt_4_vision_config import Gpt4VisionConfig
+from conf.data_config import DataConfig
+from data_enums.answer_source_enum import AnswerSourceEnum
+from data_enums.image_data_enum import ImageDataEnum
+from experiments.base_gpt_clevr_solver import BaseGptClevrSolver
+from experiments.two_step.local_arithmetic_solver import LocalArithmeticSolver
+from gpt_clients.gpt4_vision_client import Gpt4VisionClient
+from utils.answer_extraction import ANSWER_JSON_KEY, EXPLANATION_JSON_KEY, JSON_OBJECT_PATTERN
+from utils.clevr_objects import ObjectDescription
+from utils.counting_result_parser import parse_counting_result
+from utils.logger import init_logger
+from utils.progress import tqdm
+from utils.tracing import trace_question
+
+COUNTS_JSON_KEY = "counts"
+OBJECT_JSON_KEY = "object"
+DESCRIPTION_JSON_KEY = "description"
+COUNT_JSON_KEY = "count"
+TOTAL_OBJECTS_JSON_KEY = "total_objects"
+
+
+class FusedCountAndSolve(BaseGptClevrSolver):
+    """
+    This class solves the questions of the two-stage approach with a single vision request per question: the model
+    counts the objects from the objects_parser results and answers the question from its counts in the same JSON
+    response, instead of counting in one request (ObjectsCounter) and answering in another (TwoStepGptVision), that
+    both send the image.
+    The counts are saved as a counting result in the format of the ObjectsCounter, so the results have the same
+    fields as the results of the two-stage approach.
+    """
+    def __init__(self, data_config: DataConfig, gpt_client: Gpt4VisionClient, logger: Logger):
+        super().__init__(data_config=data_config, gpt_client=gpt_client, logger=logger)
+        self.gpt_client: Gpt4VisionClient = gpt_client
+        self.objects_parsing_results_file: Path = data_config.objects_parsing_results_file
+        self.fused_count_and_solve_results_file: Path = data_config.fused_count_and_solve_results_file
+        self.use_local_arithmetic_solver: bool = data_config.use_local_arithmetic_solver
+        self.local_arithmetic_solver = LocalArithmeticSolver()
+        self.locally_solved_questions: int = 0
+        self.counting_format_failures: int = 0
+
+    @property
+    def prompt(self) -> str:
+        prompt = (
+            "Analyze the provided image and answer the <question> about it.\n"
+            "First, count the objects from the specified <objects list> in the image. "
+            "Ensure that your counts are accurate and consider any overlaps or subsets among the object "
+            "categories (e.g., 'red balls' as a subset of 'balls').\n"
+            "Pay careful attention to the following:\n"
+            "1. The <objects list> may include objects that are not present in the image.\n"
+            "2. The <objects list> may not include all the objects present in the image.\n"
+            "3. For each object from the <objects list>, describe its appearances in the image, referring their "
+            "color, size(small or large), shape(cube, ball, cylinder, etc.) and material(matte/rubber or "
+            "metal/shiny), and count them. Always count all the objects in the image as well.\n"
+            "Then, answer the <question> using your counts, with a brief explanation.\n"
+            "Respond only with a JSON object in the following format:\n"
+            f'{{{{"{COUNTS_JSON_KEY}": [{{{{"{OBJECT_JSON_KEY}": "<object from the objects list>", '
+            f'"{DESCRIPTION_JSON_KEY}": "<its appearances in the image>", "{COUNT_JSON_KEY}": <count>}}}}, ...], '
+            f'"{TOTAL_OBJECTS_JSON_KEY}": <the number of all the objects in the image>, '
+            f'"{EXPLANATION_JSON_KEY}": "<brief explanation>", "{ANSWER_JSON_KEY}": <numeric answer>}}}}\n'
+            "For example, if the <objects list> is: 'red balls, cylinders', a response could be:\n"
+            f'{{{{"{COUNTS_JSON_KEY}": [{{{{"{OBJECT_JSON_KEY}": "red balls", "{DESCRIPTION_JSON_KEY}": '
+            f'"1 small metal/shiny red ball, 1 large red rubber/matte ball", "{COUNT_JSON_KEY}": 2}}}}, '
+            f'{{{{"{OBJECT_JSON_KEY}": "cylinders", "{DESCRIPTION_JSON_KEY}": "Not present in the image", '
+            f'"{COUNT_JSON_KEY}": 0}}}}], "{TOTAL_OBJECTS_JSON_KEY}": 6, '
+            f'"{EXPLANATION_JSON_KEY}": "There are 6 objects, and 2 red balls are subtracted.", '
+            f'"{ANSWER_JSON_KEY}": 4}}}}\n\n'
+            "<question>: {question}\n"
+            "<objects list>: {objects_list}"
+        )
+        return prompt
+
+    def get_version_parameters(self) -> dict:
+        return {"use_local_arithmetic_solver": self.use_local_arithmetic_solver}
+
+    def load_questions(self) -> dict[str, dict]:
+        return self.load_json_file(file_path=self.objects_parsing_results_file)
+
+    @trace_question
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        return self.get_question_result(
+            question_data=question_data,
+            parsing_result=question_data[ImageDataEnum.PARSING_RESULT]
+        )
+
+    def solve_questions(self) -> dict[int, dict]:
+        results = {}
+        self.logger.info("Starting counting the objects and solving the questions")
+
+        try:
+            for question_index, question_data in tqdm(self.load_questions().items()):
+                question_result = self.solve_question_or_dead_letter(
+                    question_index=int(question_index),
+                    question_data=question_data
+                )
+                if question_result is not None:
+                    results[question_index] = question_result
+
+        except Exception as e:
+            self.logger.exception(f"Failed to solve the questions. Error: {e}")
+            raise e
+        finally:
+            return results
+
+    def get_question_result(self, question_data: dict[str, Any], parsing_result: str) -> dict[str, Any]:
+        image_path = question_data[ImageDataEnum.IMAGE_PATH]
+        question = question_data[ImageDataEnum.QUESTION]
+        prompt = self.prompt.format(question=question, objects_list=parsing_result)
+
+        def responses_need_escalation(gpt_responses: list[str]) -> bool:
+            return self.answers_need_escalation(gpt_responses) or any(
+                self.format_counting_result(gpt_response) is None for gpt_response in gpt_responses
+            )
+
+        gpt_responses = self.gpt_client.get_vision_model_responses(
+            prompt=prompt,
+            image_path=image_path,
+            json_response=True,
+            needs_escalation=responses_need_escalation
+        )
+        answer_fields = self.get_answer_fields(gpt_responses=gpt_responses)
+        counting_result = self.format_counting_result(answer_fields[ImageDataEnum.GPT_RESPONSE])
+        if counting_result is None:
+            with self.counters_lock:
+                self.counting_format_failures += 1
+            self.logger.warning(f"Failed to read the counts from the response: "
+                                f"{answer_fields[ImageDataEnum.GPT_RESPONSE]}")
+            counting_result = answer_fields[ImageDataEnum.GPT_RESPONSE]
+
+        # Like in the two-stage approach, a question that can be solved from the counts is solved locally
+        answer_source = AnswerSourceEnum.GPT
+        local_solution = None
+        if self.use_local_arithmetic_solver:
+            local_solution = self.local_arithmetic_solver.solve(
+                question=question,
+                counting_result=parse_counting_result(counting_result),
+            )
+        if local_solution is not None:
+            with self.counters_lock:
+                self.locally_solved_questions += 1
+            answer_fields[ImageDataEnum.NUMERICAL_RESULT] = local_solution.answer
+            answer_source = AnswerSourceEnum.LOCAL_SOLVER
+
+        label = question_data[ImageDataEnum.LABEL]
+        result = {
+            ImageDataEnum.IMAGE_PATH: image_path,
+            ImageDataEnum.IMAGE_ID: question_data[ImageDataEnum.IMAGE_ID],
+            ImageDataEnum.QUESTION: question,
+            ImageDataEnum.TEMPLATE: question_data[ImageDataEnum.TEMPLATE],
+            ImageDataEnum.LABEL: label,
+            ImageDataEnum.PARSING_RESULT: parsing_result,
+            ImageDataEnum.COUNTING_RESULT: counting_result,
+            **answer_fields,
+            ImageDataEnum.IS_CORRECT: label == answer_fields[ImageDataEnum.NUMERICAL_RESULT],
+            ImageDataEnum.ANSWER_SOURCE: answer_source,
+        }
+        if local_solution is not None:
+            result[ImageDataEnum.LOCAL_SOLUTION] = local_solution.explanation
+        return result
+
+    @staticmethod
+    def format_counting_result(gpt_response: Optional[str]) -> Optional[str]:
+        """
+        Format the counts of the JSON response as a counting result of the ObjectsCounter, e.g.:
+        '1. red balls: 1 small metal/shiny red ball, 1 large red rubber/matte ball. Total: 2
+        2. objects: 6'
+        Returns None if the response has no counts.
+        """
+        match = JSON_OBJECT_PATTERN.search(gpt_response or "")
+        if match is None:
+            return None
+        try:
+            response = json.loads(match.group(0))
+        except json.JSONDecodeError:
+            return None
+        counts = response.get(COUNTS_JSON_KEY) if isinstance(response, dict) else None
+        if not isinstance(counts, list):
+            return None
+
+        lines = []
+        for entry in counts:
+            if not isinstance(entry, dict) or not isinstance(entry.get(OBJECT_JSON_KEY), str):
+                continue
+            name = entry[OBJECT_JSON_KEY].strip()
+            description = ObjectDescription.parse(name)
+            if description is not None and description.is_all_objects:
+                # All the objects are counted in the last entry
+                continue
+            details = str(entry.get(DESCRIPTION_JSON_KEY) or "Not present in the image").strip().rstrip(".")
+            lines.append(f"{len(lines) + 1}. {name}: {details}. Total: {entry.get(COUNT_JSON_KEY)}")
+        if response.get(TOTAL_OBJECTS_JSON_KEY) is not None:
+            lines.append(f"{len(lines) + 1}. objects: {response[TOTAL_OBJECTS_JSON_KEY]}")
+        return "\n".join(lines) if lines else None
+
+    def log_run_stats(self):
+        super().log_run_stats()
+        self.logger.info(f"Number of responses the counts could not be read from: {self.counting_format_failures}")
+        self.logger.info(f"Number of questions solved locally from the counts: {self.locally_solved_questions}")
+
+
+def main():
+    logger = init_logger(file_name="fused_count_and_solve.log")
+
+    gpt_config = Gpt4VisionConfig()
+    gpt_client = Gpt4VisionClient(config=gpt_config, logger=logger)
+
+    config = DataConfig()
+    fused_count_and_solve = FusedCountAndSolve(data_config=config, gpt_client=gpt_client, logger=logger)
+
+    answers = fused_count_and_solve.solve_questions()
+    logger.info(f"Finished solving questions.")
+    fused_count_and_solve.save_json_file(file_path=fused_count_and_solve.fused_count_and_solve_results_file,
+                                         data=answers)
+    fused_count_and_solve.log_run_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+from utils.clevr_objects import ObjectDescription
+from utils.counting_result_parser import ParsedCountingResult
+
+ADD_PATTERN = re.compile(r"^add (\d+) (.+)$")
+SUBTRACT_PATTERN = re.compile(r"^subtract (\d+) (.+)$")
+SUBTRACT_ALL_PATTERN = re.compile(r"^subtract all (.+)$")
+HOW_MANY_LEFT_PATTERN = re.compile(r"^how many (.+?) (?:are left|exist|are there)$")
+HOW_MANY_MUST_BE_SUBTRACTED_PATTERN = re.compile(r"^how many (.+?) must be subtracted to get (\d+) (.+)$")
+
+
+@dataclass
+class ArithmeticQuestion:
+    """
+    A CLEVR-math question, as the operations applied on the objects in the image and the objects that are asked about.
+    """
+    target: ObjectDescription
+    added: list[tuple[int, ObjectDescription]] = field(default_factory=list)
+    subtracted: list[tuple[int, ObjectDescription]] = field(default_factory=list)
+    subtracted_all: list[ObjectDescription] = field(default_factory=list)
+    # For 'How many X must be subtracted to get N X?' questions
+    remaining: Optional[int] = None
+
+
+@dataclass
+class LocalSolution:
+    answer: int
+    explanation: str
+
+
+def parse_arithmetic_question(question: str) -> Optional[ArithmeticQuestion]:
+    """
+    Parse the question into an ArithmeticQuestion.
+    Returns None if the question does not match any of the known addition/subtraction templates.
+    """
+    sentences = [sentence.strip().lower() for sentence in re.split(r"[.?]", question) if sentence.strip()]
+    if not sentences:
+        return None
+
+    *operations, query = sentences
+    must_be_subtracted_match = HOW_MANY_MUST_BE_SUBTRACTED_PATTERN.match(query)
+    if must_be_subtracted_match is not None:
+        target = ObjectDescription.parse(must_be_subtracted_match.group(1))
+        if operations or target is None or target != ObjectDescription.parse(must_be_subtracted_match.group(3)):
+            return None
+        return ArithmeticQuestion(target=target, remaining=int(must_be_subtracted_match.group(2)))
+
+    how_many_match = HOW_MANY_LEFT_PATTERN.match(query)
+    target = ObjectDescription.parse(how_many_match.group(1)) if how_many_match is not None else None
+    if target is None:
+        return None
+
+    arithmetic_question = ArithmeticQuestion(target=target)
+    for operation in operations:
+        add_match = ADD_PATTERN.match(operation)
+        subtract_match = SUBTRACT_PATTERN.match(operation)
+        subtract_all_match = SUBTRACT_ALL_PATTERN.match(operation)
+        if add_match is not None:
+            description = ObjectDescription.parse(add_match.group(2))
+            arithmetic_question.added.append((int(add_match.group(1)), description))
+        elif subtract_match is not None:
+            description = ObjectDescription.parse(subtract_match.group(2))
+            arithmetic_question.subtracted.append((int(subtract_match.group(1)), description))
+        elif subtract_all_match is not None:
+            description = ObjectDescription.parse(subtract_all_match.group(1))
+            arithmetic_question.subtracted_all.append(description)
+        else:
+            return None
+        if description is None:
+            return None
+
+    return arithmetic_question
+
+
+class LocalArithmeticSolver:
+    """
+    Solves the addition, subtraction and subtraction-multihop questions directly from the counting results.
+    A question is solved only when every count it requires appears in the counting result, and the counts are
+    consistent with each other. Otherwise, the question should be sent to the GPT model.
+    """
+
+    def solve(self, question: str, counting_result: ParsedCountingResult) -> Optional[LocalSolution]:
+        arithmetic_question = parse_arithmetic_question(question)
+        if arithmetic_question is None or not counting_result.is_consistent():
+            return None
+
+        target_count = counting_result.get_count(arithmetic_question.target)
+        if target_count is None:
+            return None
+
+        if arithmetic_question.remaining is not None:
+            answer = target_count - arithmetic_question.remaining
+            return LocalSolution(
+                answer=answer,
+                explanation=f"There are {target_count} {arithmetic_question.target}s. "
+                            f"{target_count} - {arithmetic_question.remaining} = {answer}.",
+            )
+
+        removed_count = self.count_union_in_target(
+            target=arithmetic_question.target,
+            descriptions=arithmetic_question.subtracted_all,
+            counting_result=counting_result,
+        )
+        added_count = self.count_changes_in_target(arithmetic_question.target, arithmetic_question.added)
+        subtracted_count = self.count_changes_in_target(arithmetic_question.target, arithmetic_question.subtracted)
+        if removed_count is None or added_count is None or subtracted_count is None:
+            return None
+
+        answer = target_count - removed_count + added_count - subtracted_count
+        if answer < 0:
+            return None
+        return LocalSolution(
+            answer=answer,
+            explanation=f"There are {target_count} {arithmetic_question.target}s. "
+                        f"{target_count} - {removed_count} (subtract all) + {added_count} (add) "
+                        f"- {subtracted_count} (subtract) = {answer}.",
+        )
+
+    @staticmethod
+    def count_changes_in_target(
+            target: ObjectDescription,
+            changes: list[tuple[int, ObjectDescription]]
+    ) -> Optional[int]:
+        """
+        Count how many of the added (or subtracted) objects are target objects.
+        Returns None if it can't be determined, e.g. when adding 'small objects' and asking about 'balls'.
+        """
+        count = 0
+        for amount, description in changes:
+            if target.includes(description):
+                count += amount
+            elif not target.is_disjoint(description):
+                return None
+        return count
+
+    @staticmethod
+    def count_union_in_target(
+            target: ObjectDescription,
+            descriptions: list[ObjectDescription],
+            counting_result: ParsedCountingResult
+    ) -> Optional[int]:
+        """
+        Count the target objects that match at least one of the descriptions, by inclusion-exclusion.
+        Returns None if one of the required counts is missing from the counting result.
+        """
+        if not descriptions:
+            return 0
+        if len(descriptions) > 2:
+            return None
+
+        first_count = counting_result.get_count(target.intersection(descriptions[0]))
+        if len(descriptions) == 1:
+            return first_count
+
+        second_count = counting_result.get_count(target.intersection(descriptions[1]))
+        both = target.intersection(descriptions[0])
+        both_count = counting_result.get_count(both.intersection(descriptions[1]) if both is not None else None)
+
+        if first_count is None or second_count is None or both_count is None:
+            return None
+        return first_count + second_count - both_count
@@ -0,0 +1,334 @@
+"""
+Module for a classical (no model) counter of the objects in CLEVR renders.
+
+CLEVR renders are clean synthetic scenes: a smooth gray floor, a few primitive shapes in 8 saturated colors, and two
+materials. The counter finds the objects with background subtraction, assigns their pixels to the CLEVR colors,
+separates the objects with connected components, and guesses their size, shape and material from simple geometric
+and shading heuristics. Every object gets a confidence, and the image confidence is the confidence of its least
+certain object, so the counts of high confidence images can be used instead of calling the vision model.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+from scipy import ndimage
+
+from utils.clevr_objects import ObjectDescription
+
+# The colors of the CLEVR objects, as they are defined in the CLEVR rendering script
+CLEVR_COLORS_RGB = {
+    "gray": (87, 87, 87),
+    "red": (173, 35, 35),
+    "blue": (42, 75, 215),
+    "green": (29, 105, 20),
+    "brown": (129, 74, 25),
+    "purple": (129, 38, 192),
+    "cyan": (41, 208, 208),
+    "yellow": (255, 238, 51),
+}
+CHROMATIC_COLORS = [color for color in CLEVR_COLORS_RGB if color != "gray"]
+# The images are downsampled by this factor before counting (CLEVR renders are 480x320)
+DOWNSAMPLE_FACTOR = 2
+# A pixel is colored when its chroma (max - min channel) is above this threshold
+CHROMA_THRESHOLD = 0.12
+# A gray pixel is part of an object when its brightness deviates from the floor by more than this threshold
+BRIGHTNESS_DEVIATION_THRESHOLD = 0.14
+# Components smaller than this fraction of the (downsampled) image are noise
+MIN_OBJECT_AREA_FRACTION = 0.0012
+# An object is gray when less than this fraction of its pixels is colored
+MIN_COLORED_FRACTION = 0.35
+# A component is split by color when its second color has more than this fraction of its colored pixels
+SPLIT_COLOR_FRACTION = 0.2
+# Uncolored pixels farther than this (in pixels) from the colored pixels of a component are a gray object
+GRAY_OBJECT_MIN_DISTANCE = 4
+# Metal objects: the mean brightness gradient inside the object, above which it is metal
+METAL_SHADING_GRADIENT = 0.075
+# The mean squared distance of the top of the silhouette from an elliptic arc, below which the object is a sphere, and
+# otherwise a cylinder, up to the cube threshold
+SPHERE_MAX_ARC_ERROR = 0.0008
+CYLINDER_MAX_ARC_ERROR = 0.005
+# A value this many times away from a threshold is a certain decision
+THRESHOLD_CONFIDENCE_RATIO = 1.5
+# The square root of the area of an object, relative to the image height and to its distance from the camera (its
+# bottom row), above which it is large
+LARGE_OBJECT_RELATIVE_SIZE = 0.22
+# The horizon row (as a fraction of the image height), where the apparent size of the objects would be 0
+HORIZON_FRACTION = -0.15
+
+
+@dataclass
+class DetectedObject:
+    size: str
+    color: str
+    material: str
+    shape: str
+    confidence: float
+    area: int
+    bounding_box: tuple[int, int, int, int]
+
+    def to_scene_object(self) -> dict:
+        """
+        The object in the format of the objects of the CLEVR scenes annotations.
+        """
+        return {"size": self.size, "color": self.color, "material": self.material, "shape": self.shape}
+
+    def __str__(self) -> str:
+        material = "metal/shiny" if self.material == "metal" else "rubber/matte"
+        return f"{self.size} {self.color} {material} {self.shape}"
+
+
+@dataclass
+class LocalCountingResult:
+    objects: list[DetectedObject]
+    confidence: float
+
+    def count(self, description: ObjectDescription) -> int:
+        return sum(1 for detected_object in self.objects if description.matches(detected_object.to_scene_object()))
+
+    def to_counting_result(self, objects_list: str) -> str:
+        """
+        The counts of the objects from the objects list (e.g. 'red balls, cylinders'), in the format of the counting
+        results of the ObjectsCounter. The last entry is always the total number of objects.
+        """
+        names = [name.strip(" .'\"") for name in objects_list.replace("\n", ",").split(",")]
+        lines = []
+        for name in names:
+            description = ObjectDescription.parse(name)
+            if description is None or description.is_all_objects:
+                continue
+            matching_objects = [
+                str(detected_object) for detected_object in self.objects
+                if description.matches(detected_object.to_scene_object())
+            ]
+            details = ", ".join(f"1 {matching_object}" for matching_object in matching_objects)
+            lines.append(f"{len(lines) + 1}. {name}: {details or 'Not present in the image'}. "
+                         f"Total: {len(matching_objects)}")
+        lines.append(f"{len(lines) + 1}. objects: {len(self.objects)}")
+        return "\n".join(lines)
+
+
+def load_image(image: Union[str, Path, np.ndarray, object]) -> np.ndarray:
+    """
+    Load the image as an RGB uint8 array. The image can be a path, a PIL image or an array.
+    Pillow is imported only when an image file is loaded.
+    """
+    if isinstance(image, (str, Path)):
+        from PIL import Image
+        with Image.open(image) as pil_image:
+            image = np.asarray(pil_image.convert("RGB"))
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = np.repeat(image[:, :, None], 3, axis=2)
+    return image[:, :, :3]
+
+
+def downsample(image: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Downsample the uint8 image by the factor, by averaging blocks of pixels, to an RGB float array in [0, 1].
+    """
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    blocks_sum = np.zeros((height, width, 3), dtype=np.uint16)
+    for row_offset in range(factor):
+        for column_offset in range(factor):
+            blocks_sum += image[row_offset:height * factor:factor, column_offset:width * factor:factor]
+    return blocks_sum.astype(np.float32) * np.float32(1 / (255 * factor ** 2))
+
+
+def get_color_directions() -> np.ndarray:
+    """
+    The chroma directions of the chromatic CLEVR colors: the RGB minus its mean, normalized.
+    """
+    rgb = np.array([CLEVR_COLORS_RGB[color] for color in CHROMATIC_COLORS], dtype=np.float32) / 255
+    chroma = rgb - rgb.mean(axis=1, keepdims=True)
+    return chroma / np.linalg.norm(chroma, axis=1, keepdims=True)
+
+
+COLOR_DIRECTIONS = get_color_directions()
+
+
+def get_threshold_confidence(value: float, threshold: float) -> float:
+    """
+    The confidence of a decision by a threshold, by how far the value is from it: 0 at the threshold, and 1 when the
+    value is at least THRESHOLD_CONFIDENCE_RATIO times (or 1 / THRESHOLD_CONFIDENCE_RATIO times) the threshold.
+    """
+    return float(min(1.0, abs(np.log(max(value, 1e-9) / threshold)) / np.log(THRESHOLD_CONFIDENCE_RATIO)))
+
+
+class LocalObjectCounter:
+    """
+    Counts the objects in CLEVR renders, by their size, color, material and shape, on the CPU.
+    """
+
+    def count(self, image: Union[str, Path, np.ndarray, object]) -> LocalCountingResult:
+        rgb = downsample(load_image(image), factor=DOWNSAMPLE_FACTOR)
+
+        # The channels are reduced one by one, since reducing the short last axis of the array is slow
+        red, green, blue = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+        brightness = (red + green + blue) / 3
+        chroma = np.maximum(np.maximum(red, green), blue) - np.minimum(np.minimum(red, green), blue)
+        colored = chroma > CHROMA_THRESHOLD
+        foreground = colored | (np.abs(brightness - self.estimate_floor(brightness)) > BRIGHTNESS_DEVIATION_THRESHOLD)
+        foreground = ndimage.binary_opening(foreground, iterations=1)
+        foreground = ndimage.binary_fill_holes(foreground)
+
+        # The color of every colored pixel is the CLEVR color with the closest chroma direction
+        pixel_chroma = rgb - brightness[:, :, None]
+        similarities = pixel_chroma @ COLOR_DIRECTIONS.T
+        similarities /= np.sqrt(np.einsum("ijk,ijk->ij", pixel_chroma, pixel_chroma))[:, :, None] + 1e-6
+        color_indices = similarities.argmax(axis=2)
+        color_similarity = similarities.max(axis=2)
+
+        gradient = np.hypot(ndimage.sobel(brightness, axis=0), ndimage.sobel(brightness, axis=1))
+
+        labels, number_of_components = ndimage.label(foreground)
+        min_area = MIN_OBJECT_AREA_FRACTION * foreground.size
+        objects = []
+        for component_index, component_slice in enumerate(ndimage.find_objects(labels), start=1):
+            component = labels[component_slice] == component_index
+            if component.sum() < min_area:
+                continue
+            for object_mask, color, color_confidence in self.split_by_color(
+                    component=component,
+                    colored=colored[component_slice],
+                    color_indices=color_indices[component_slice],
+                    color_similarity=color_similarity[component_slice],
+            ):
+                if object_mask.sum() < min_area:
+                    continue
+                objects.append(self.describe_object(
+                    mask=object_mask,
+                    offset=(component_slice[0].start, component_slice[1].start),
+                    image_height=foreground.shape[0],
+                    gradient=gradient[component_slice],
+                    color=color,
+                    color_confidence=color_confidence,
+                ))
+
+        confidence = min((detected_object.confidence for detected_object in objects), default=0.0)
+        return LocalCountingResult(objects=objects, confidence=confidence)
+
+    @staticmethod
+    def estimate_floor(brightness: np.ndarray) -> np.ndarray:
+        """
+        Estimate the brightness of the floor, that changes smoothly: the median of every row, corrected by the median
+        of every column. The objects cover a small part of every row and column, so they don't move the medians.
+        """
+        row_floor = np.median(brightness, axis=1, keepdims=True)
+        column_correction = np.median(brightness - row_floor, axis=0, keepdims=True)
+        return row_floor + column_correction
+
+    @staticmethod
+    def split_by_color(
+            component: np.ndarray,
+            colored: np.ndarray,
+            color_indices: np.ndarray,
+            color_similarity: np.ndarray
+    ) -> list[tuple[np.ndarray, str, float]]:
+        """
+        Split a connected component into the objects it contains, by their color. Touching objects of different
+        colors are separated, and the uncolored pixels (e.g. highlights) belong to the object of the closest colored
+        pixel, unless they are far from all the colored pixels, and then they are a gray object.
+        """
+        colored_pixels = component & colored
+        if colored_pixels.sum() < MIN_COLORED_FRACTION * component.sum():
+            gray_confidence = 1 - colored_pixels.sum() / (MIN_COLORED_FRACTION * component.sum())
+            return [(component, "gray", 0.5 + gray_confidence / 2)]
+
+        color_counts = np.bincount(color_indices[colored_pixels], minlength=len(CHROMATIC_COLORS))
+        colors = [
+            color_index for color_index in np.argsort(color_counts)[::-1]
+            if color_counts[color_index] > SPLIT_COLOR_FRACTION * colored_pixels.sum()
+        ]
+        # Every pixel of the component belongs to the color of its closest colored pixel of the main colors
+        seeds = colored_pixels & np.isin(color_indices, colors)
+        seed_distances, (nearest_rows, nearest_columns) = ndimage.distance_transform_edt(~seeds, return_indices=True)
+        pixel_colors = color_indices[nearest_rows, nearest_columns]
+
+        objects = []
+        # A gray object that touches a colored object: the uncolored pixels that are far from the colored pixels
+        gray_cores = ndimage.binary_opening(component & (seed_distances > GRAY_OBJECT_MIN_DISTANCE))
+        gray_pixels = np.zeros_like(component)
+        if gray_cores.any():
+            gray_pixels = component & ~colored & ndimage.binary_dilation(
+                gray_cores, iterations=int(GRAY_OBJECT_MIN_DISTANCE)
+            )
+            objects.append((gray_pixels, "gray", 0.8))
+
+        for color_index in colors:
+            object_mask = component & ~gray_pixels & (pixel_colors == color_index)
+            color_confidence = float(np.median(color_similarity[seeds & (color_indices == color_index)]))
+            # Touching objects are less certain, since their shapes are cut by the split
+            if len(objects) + len(colors) > 1:
+                color_confidence *= 0.9
+            objects.append((object_mask, CHROMATIC_COLORS[color_index], color_confidence))
+        return objects
+
+    @staticmethod
+    def describe_object(
+            mask: np.ndarray,
+            offset: tuple[int, int],
+            image_height: int,
+            gradient: np.ndarray,
+            color: str,
+            color_confidence: float
+    ) -> DetectedObject:
+        rows, columns = np.nonzero(mask)
+        top, bottom = rows.min(), rows.max()
+        left, right = columns.min(), columns.max()
+        height, width = bottom - top + 1, right - left + 1
+        area = len(rows)
+
+        # Size: the apparent size shrinks with the distance from the camera, that grows towards the horizon
+        distance_scale = (offset[0] + bottom) / image_height - HORIZON_FRACTION
+        relative_size = np.sqrt(area) / image_height / distance_scale
+        size = "large" if relative_size > LARGE_OBJECT_RELATIVE_SIZE else "small"
+        size_confidence = get_threshold_confidence(relative_size, LARGE_OBJECT_RELATIVE_SIZE)
+
+        # Material: metal objects reflect the scene, so their shading has sharp changes, while rubber shading is smooth
+        inner_mask = ndimage.binary_erosion(mask, iterations=2)
+        shading_mask = inner_mask if inner_mask.any() else mask
+        shading_gradient = float(gradient[shading_mask].mean())
+        material = "metal" if shading_gradient > METAL_SHADING_GRADIENT else "rubber"
+        material_confidence = get_threshold_confidence(shading_gradient, METAL_SHADING_GRADIENT)
+
+        shape, shape_confidence = LocalObjectCounter.classify_shape(mask[top:bottom + 1, left:right + 1])
+
+        confidence = float(min(color_confidence, size_confidence, material_confidence, shape_confidence))
+        return DetectedObject(
+            size=size,
+            color=color,
+            material=material,
+            shape=shape,
+            confidence=max(0.0, confidence),
+            area=int(area) * DOWNSAMPLE_FACTOR ** 2,
+            bounding_box=tuple(int(value) * DOWNSAMPLE_FACTOR for value in (
+                offset[1] + left, offset[0] + top, width, height
+            )),
+        )
+
+    @staticmethod
+    def classify_shape(mask: np.ndarray) -> tuple[str, float]:
+        """
+        Guess the shape from the top of the silhouette: the top of a sphere is an arc of an ellipse as wide as the
+        sphere, the top of a cylinder is a flatter ellipse (its top face), and the top of a cube is made of the
+        straight edges of its top face. The shape is chosen by how far the top is from an elliptic arc.
+        Returns the shape and its confidence.
+        """
+        height, width = mask.shape
+        columns = mask.any(axis=0)
+        top_rows = np.argmax(mask, axis=0)[columns] / width
+        x = (np.arange(width)[columns] + 0.5) / width * 2 - 1
+        arc = np.sqrt(np.clip(1 - x ** 2, 0, 1))
+        coefficients = np.stack([arc, np.ones_like(arc)], axis=1)
+        _, residuals, _, _ = np.linalg.lstsq(coefficients, top_rows, rcond=None)
+        arc_error = float(residuals[0]) / len(top_rows) if len(residuals) else 0.0
+
+        if arc_error < SPHERE_MAX_ARC_ERROR:
+            return "sphere", get_threshold_confidence(arc_error, SPHERE_MAX_ARC_ERROR)
+        if arc_error < CYLINDER_MAX_ARC_ERROR:
+            return "cylinder", min(
+                get_threshold_confidence(arc_error, SPHERE_MAX_ARC_ERROR),
+                get_threshold_confidence(arc_error, CYLINDER_MAX_ARC_ERROR),
+            )
+        return "cube", get_threshold_confidence(arc_error, CYLINDER_MAX_ARC_ERROR)
@@ -1,14 +1,22 @@
 from logging import Logger
 from pathlib import Path
-
-from tqdm import tqdm
+from typing import Callable, Optional
 
 from conf.gpt_4_vision_config import Gpt4VisionConfig
 from conf.data_config import DataConfig
+from data_enums.counting_source_enum import CountingSourceEnum
 from data_enums.image_data_enum import ImageDataEnum
 from experiments.base_gpt_clevr_solver import BaseGptClevrSolver
+from experiments.two_step.local_arithmetic_solver import LocalArithmeticSolver
 from gpt_clients.gpt4_vision_client import Gpt4VisionClient
+from utils.counting_result_parser import parse_counting_result
 from utils.logger import init_logger
+from utils.object_spec import (
+    ATTRIBUTE_VALUES, ObjectSpec, format_inventory_example, get_inventory_attributes, parse_object_inventory,
+    parse_objects_list
+)
+from utils.progress import tqdm
+from utils.tracing import trace_question
 
 
 class ObjectsCounter(BaseGptClevrSolver):
@@ -23,6 +31,16 @@ class ObjectsCounter(BaseGptClevrSolver):
         self.gpt_client: Gpt4VisionClient = gpt_client
         self.objects_parsing_results_file: Path = data_config.objects_parsing_results_file
         self.object_counting_results_file: Path = data_config.object_counting_results_file
+        self.local_arithmetic_solver = LocalArithmeticSolver()
+        self.local_object_counter = None
+        self.local_object_counter_confidence_threshold = data_config.local_object_counter_confidence_threshold
+        self.locally_counted_questions: int = 0
+        self.use_object_spec_counting: bool = data_config.use_object_spec_counting
+        self.inventory_counted_questions: int = 0
+        if data_config.use_local_object_counter:
+            # numpy and scipy are imported only when the local counter is used
+            from experiments.two_step.local_object_counter import LocalObjectCounter
+            self.local_object_counter = LocalObjectCounter()
 
     @property
     def prompt(self) -> str:
@@ -55,6 +73,19 @@ class ObjectsCounter(BaseGptClevrSolver):
 
         return prompt
 
+    @property
+    def object_inventory_prompt(self) -> str:
+        prompt = (
+            "Analyze the provided image and list all the objects in it, grouped by their {attributes}.\n"
+            "Write each group in a separate line, as the number of objects in the group followed by their "
+            "{attributes}, with no other text. Every object must be in exactly one group, and each group must have "
+            "a single value of each of: {attribute_values}.\n"
+            "For example:\n"
+            "{example}"
+        )
+
+        return prompt
+
     def count_objects(self) -> dict[int, dict]:
         """
         Iterate over all the questions and their parsing result, and for each image,
@@ -63,15 +94,13 @@ class ObjectsCounter(BaseGptClevrSolver):
         self.logger.info("Starting objects counting")
         results = {}
         try:
-            parsing_results = self.load_json_file(file_path=self.objects_parsing_results_file)
-            for question_index, question_data in tqdm(parsing_results.items()):
-                parsing_result: str = question_data[ImageDataEnum.PARSING_RESULT]
-
-                counting_result = self.get_counting_result(
-                    question_data=question_data,
-                    parsing_result=parsing_result
+            for question_index, question_data in tqdm(self.load_questions().items()):
+                question_result = self.solve_question_or_dead_letter(
+                    question_index=int(question_index),
+                    question_data=question_data
                 )
-                results[question_index] = counting_result
+                if question_result is not None:
+                    results[question_index] = question_result
 
         except Exception as e:
             self.logger.error(f"Failed to count objects. Error: {e}")
@@ -79,16 +108,69 @@ class ObjectsCounter(BaseGptClevrSolver):
         finally:
             return results
 
+    def get_version_parameters(self) -> dict:
+        return {
+            "object_inventory_prompt": self.object_inventory_prompt,
+            "use_object_spec_counting": self.use_object_spec_counting,
+            "use_local_object_counter": self.local_object_counter is not None,
+            "local_object_counter_confidence_threshold": self.local_object_counter_confidence_threshold,
+        }
+
+    def load_questions(self) -> dict[str, dict]:
+        return self.load_json_file(file_path=self.objects_parsing_results_file)
+
+    @trace_question
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        parsing_result: str = question_data[ImageDataEnum.PARSING_RESULT]
+        return self.get_counting_result(question_data=question_data, parsing_result=parsing_result)
+
     def get_counting_result(self, question_data: dict, parsing_result: str) -> dict[str, str]:
         """
-        Get the counting result from the model.
+        Get the counting result from the local object counter when it is confident and its counts can solve the
+        question, and otherwise from the model.
         """
         image_path = question_data[ImageDataEnum.IMAGE_PATH]
-        prompt = self.prompt.format(objects_list=parsing_result)
-        gpt_response = self.gpt_client.get_vision_model_response(prompt=prompt, image_path=image_path)
+        question = question_data[ImageDataEnum.QUESTION]
+        needs_escalation = self.counting_result_needs_escalation(question=question)
+
+        local_counting_confidence = None
+        counting_result = None
+        if self.local_object_counter is not None:
+            local_counting_confidence, counting_result = self.get_local_counting_result(
+                image_path=image_path,
+                parsing_result=parsing_result
+            )
+            if counting_result is not None and needs_escalation(counting_result):
+                counting_result = None
+
+        counting_source = CountingSourceEnum.LOCAL_COUNTER
+        if counting_result is not None:
+            with self.counters_lock:
+                self.locally_counted_questions += 1
+        object_specs = self.get_object_specs(parsing_result) if self.use_object_spec_counting else None
+        object_inventory = None
+        if counting_result is None and object_specs is not None:
+            counting_source = CountingSourceEnum.GPT
+            object_inventory, counting_result = self.count_object_specs(
+                image_path=image_path,
+                object_specs=object_specs,
+                needs_escalation=needs_escalation
+            )
+            if counting_result is not None:
+                with self.counters_lock:
+                    self.inventory_counted_questions += 1
+            else:
+                self.logger.warning(f"Failed to parse the object inventory, counting the objects list instead: "
+                                    f"{object_inventory}")
+        if counting_result is None:
+            counting_source = CountingSourceEnum.GPT
+            counting_result = self.gpt_client.get_vision_model_response(
+                prompt=self.prompt.format(objects_list=parsing_result),
+                image_path=image_path,
+                needs_escalation=needs_escalation
+            )
 
         image_id = question_data[ImageDataEnum.IMAGE_ID]
-        question = question_data[ImageDataEnum.QUESTION]
         template = question_data[ImageDataEnum.TEMPLATE]
         label = question_data[ImageDataEnum.LABEL]
 
@@ -99,13 +181,98 @@ class ObjectsCounter(BaseGptClevrSolver):
             ImageDataEnum.TEMPLATE: template,
             ImageDataEnum.LABEL: label,
             ImageDataEnum.PARSING_RESULT: parsing_result,
-            ImageDataEnum.COUNTING_RESULT: gpt_response,
+            ImageDataEnum.COUNTING_RESULT: counting_result,
         }
+        if object_inventory is not None:
+            result[ImageDataEnum.OBJECT_INVENTORY] = object_inventory
+        if self.local_object_counter is not None:
+            result[ImageDataEnum.COUNTING_SOURCE] = counting_source
+            result[ImageDataEnum.LOCAL_COUNTING_CONFIDENCE] = local_counting_confidence
 
         return result
 
+    def get_local_counting_result(self, image_path: str, parsing_result: str) -> tuple[float, Optional[str]]:
+        """
+        Count the objects of the image locally.
+        Returns the confidence of the local counts, and the counting result, or None if the confidence is below the
+        threshold.
+        """
+        local_counting_result = self.local_object_counter.count(image_path)
+        if local_counting_result.confidence < self.local_object_counter_confidence_threshold:
+            return local_counting_result.confidence, None
+        return local_counting_result.confidence, local_counting_result.to_counting_result(objects_list=parsing_result)
 
-if __name__ == "__main__":
+    @staticmethod
+    def get_object_specs(parsing_result: str) -> Optional[list[tuple[str, ObjectSpec]]]:
+        """
+        The specs of the objects list, or None if it can't be counted by an inventory: an object is not a CLEVR
+        description, or the list only refers to all the objects.
+        """
+        object_specs = parse_objects_list(parsing_result)
+        if object_specs is None or not get_inventory_attributes([object_spec for _, object_spec in object_specs]):
+            return None
+        return object_specs
+
+    def count_object_specs(
+            self,
+            image_path: str,
+            object_specs: list[tuple[str, ObjectSpec]],
+            needs_escalation: Callable[[str], bool]
+    ) -> tuple[str, Optional[str]]:
+        """
+        Ask the model for an inventory of the objects of the image, grouped only by the attributes the objects list
+        refers to, and derive the count of every object from the list by the groups it includes.
+        Returns the inventory response, and the counting result derived from it, or None if the inventory can't be
+        parsed (an unparsed inventory is escalated like any inconclusive counting result).
+        """
+        attribute_names = get_inventory_attributes([object_spec for _, object_spec in object_specs])
+        prompt = self.object_inventory_prompt.format(
+            attributes=" and ".join(filter(None, (", ".join(attribute_names[:-1]), attribute_names[-1]))),
+            attribute_values="; ".join(
+                f"{attribute_name} ({', '.join(ATTRIBUTE_VALUES[attribute_name])})" for attribute_name in attribute_names
+            ),
+            example=format_inventory_example(attribute_names),
+        )
+
+        def get_counting_result(object_inventory: str) -> Optional[str]:
+            parsed_inventory = parse_object_inventory(object_inventory)
+            if parsed_inventory is None:
+                return None
+            return parsed_inventory.to_counting_result(object_specs=object_specs)
+
+        def inventory_needs_escalation(object_inventory: str) -> bool:
+            counting_result = get_counting_result(object_inventory)
+            return counting_result is None or needs_escalation(counting_result)
+
+        object_inventory = self.gpt_client.get_vision_model_response(
+            prompt=prompt,
+            image_path=image_path,
+            needs_escalation=inventory_needs_escalation
+        )
+        return object_inventory, get_counting_result(object_inventory)
+
+    def log_run_stats(self):
+        super().log_run_stats()
+        if self.local_object_counter is not None:
+            self.logger.info(f"Number of questions counted locally: {self.locally_counted_questions}")
+        if self.use_object_spec_counting:
+            self.logger.info(f"Number of questions counted from an object inventory: "
+                             f"{self.inventory_counted_questions}")
+
+    def counting_result_needs_escalation(self, question: str) -> Callable[[str], bool]:
+        """
+        A counting result is inconclusive when the question can't be solved from its counts: a count is missing,
+        the counts contradict each other, or they conflict with the question (e.g. subtracting more objects than
+        were counted).
+        """
+        def needs_escalation(counting_result: str) -> bool:
+            parsed_counting_result = parse_counting_result(counting_result)
+            return self.local_arithmetic_solver.solve(question=question, counting_result=parsed_counting_result) is None
+
+        return needs_escalation
+
+
+def main():
     logger = init_logger(file_name="objects_counter.log")
 
     gpt_config = Gpt4VisionConfig()
@@ -118,3 +285,8 @@ if __name__ == "__main__":
 
     objects_counter.save_json_file(file_path=objects_counter.object_counting_results_file, data=answers)
     logger.info(f"Finished objects counting. Results saved in {objects_counter.object_counting_results_file}")
+    objects_counter.log_run_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,14 @@
 from logging import Logger
 from pathlib import Path
 
-from tqdm import tqdm
-
 from conf.gpt4_lang_config import GPT4LangConfig
 from conf.data_config import DataConfig
 from data_enums.image_data_enum import ImageDataEnum
 from experiments.base_gpt_clevr_solver import BaseGptClevrSolver
 from gpt_clients.gpt4_lang_client import Gpt4LangClient
 from utils.logger import init_logger
+from utils.progress import tqdm
+from utils.tracing import trace_question
 
 
 class ObjectsParser(BaseGptClevrSolver):
@@ -16,6 +16,14 @@ class ObjectsParser(BaseGptClevrSolver):
     This class is responsible for parsing the questions to retrieve the objects the question is focusing on.
     Read the prompt property to understand the expected input and output.
     """
+    input_fields = (
+        ImageDataEnum.IMAGE_PATH,
+        ImageDataEnum.IMAGE_ID,
+        ImageDataEnum.QUESTION,
+        ImageDataEnum.TEMPLATE,
+        ImageDataEnum.LABEL,
+    )
+
     def __init__(self, data_config: DataConfig, gpt_client: Gpt4LangClient, logger: Logger):
         super().__init__(data_config=data_config, gpt_client=gpt_client, logger=logger)
         self.gpt_client: Gpt4LangClient = gpt_client
@@ -44,13 +52,13 @@ class ObjectsParser(BaseGptClevrSolver):
         results: dict[str, dict] = {}
 
         try:
-            one_step_gpt_results = self.load_json_file(self.one_step_gpt_results_file)
-            for question_index, question_result in tqdm(one_step_gpt_results.items()):
-                question_parsing_result = self.get_question_parsing_result(
-                    question_data=question_result,
+            for question_index, question_result in tqdm(self.load_questions().items()):
+                question_result = self.solve_question_or_dead_letter(
+                    question_index=int(question_index),
+                    question_data=question_result
                 )
-
-                results[question_index] = question_parsing_result
+                if question_result is not None:
+                    results[question_index] = question_result
 
         except Exception as e:
             self.logger.error(f"Failed to parse questions: {e}")
@@ -59,6 +67,13 @@ class ObjectsParser(BaseGptClevrSolver):
         finally:
             return results
 
+    def load_questions(self) -> dict[str, dict]:
+        return self.load_json_file(self.one_step_gpt_results_file)
+
+    @trace_question
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        return self.get_question_parsing_result(question_data=question_data)
+
     def get_question_parsing_result(self, question_data) -> dict[str, str]:
         """
         Get the question parsing result from the gpt.
@@ -79,7 +94,7 @@ class ObjectsParser(BaseGptClevrSolver):
         return result
 
 
-if __name__ == "__main__":
+def main():
     logger = init_logger(file_name="objects_parser.log")
     gpt_client = Gpt4LangClient(config=GPT4LangConfig(), logger=logger)
 
@@ -88,3 +103,7 @@ if __name__ == "__main__":
     objects_parsing_results = objects_parser.parse_questions()
     objects_parser.save_json_file(file_path=objects_parser.objects_parsing_results_file,
                                   data=objects_parsing_results)
+
+
+if __name__ == "__main__":
+    main()
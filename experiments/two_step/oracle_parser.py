@@ -1,24 +1,34 @@
 from logging import Logger
 from pathlib import Path
 
-from tqdm import tqdm
-
 from conf.gpt4_lang_config import GPT4LangConfig
 from conf.data_config import DataConfig
-from base_gpt_clevr_solver import BaseGptClevrSolver
-from data_enums.clevr_descriptions_enum import ClevrDescriptionsEnum
+from experiments.base_gpt_clevr_solver import SCENE_DESCRIPTION_VERSION, BaseGptClevrSolver
 from data_enums.image_data_enum import ImageDataEnum
 from gpt_clients.gpt4_lang_client import Gpt4LangClient
 from utils.logger import init_logger
+from utils.progress import tqdm
+from utils.tracing import trace_question
 
 
 class OracleObjectsParser(BaseGptClevrSolver):
+    input_fields = (
+        ImageDataEnum.IMAGE_PATH,
+        ImageDataEnum.IMAGE_ID,
+        ImageDataEnum.QUESTION,
+        ImageDataEnum.TEMPLATE,
+        ImageDataEnum.LABEL,
+    )
+
     def __init__(self, data_config: DataConfig, gpt_client: Gpt4LangClient, logger: Logger):
         super().__init__(data_config=data_config, gpt_client=gpt_client, logger=logger)
         self.gpt_client: Gpt4LangClient = gpt_client
         self.oracle_one_step_results_file: Path = data_config.oracle_one_step_results_file
         self.oracle_parsing_results_file: Path = data_config.oracle_parsing_results_file
 
+    def get_version_parameters(self) -> dict:
+        return {"scene_description_version": SCENE_DESCRIPTION_VERSION, "scenes": self.clevr_val_scenes.name}
+
     @property
     def prompt(self) -> str:
         prompt = (
@@ -66,19 +76,13 @@ class OracleObjectsParser(BaseGptClevrSolver):
         results: dict[str, dict] = {}
 
         try:
-            oracle_one_step_results = self.load_json_file(self.oracle_one_step_results_file)
-            clevr_val_scenes = self.load_json_file(file_path=self.clevr_val_scenes)[ClevrDescriptionsEnum.SCENES]
-            for question_index, question_result in tqdm(oracle_one_step_results.items()):
-                image_id = question_result[ImageDataEnum.IMAGE_ID]
-                image_index = self.get_image_index_from_id(image_id=image_id)
-                image_data = clevr_val_scenes[image_index]
-                image_scene = image_data[ClevrDescriptionsEnum.OBJECTS]
-                question_parsing_result = self.get_question_parsing_result(
-                    question_data=question_result,
-                    image_scene=image_scene
+            for question_index, question_result in tqdm(self.load_questions().items()):
+                question_result = self.solve_question_or_dead_letter(
+                    question_index=int(question_index),
+                    question_data=question_result
                 )
-
-                results[question_index] = question_parsing_result
+                if question_result is not None:
+                    results[question_index] = question_result
 
         except Exception as e:
             self.logger.error(f"Failed to parse questions: {e}")
@@ -87,17 +91,24 @@ class OracleObjectsParser(BaseGptClevrSolver):
         finally:
             return results
 
-    def get_question_parsing_result(self, question_data, image_scene: dict) -> dict[str, str]:
+    def load_questions(self) -> dict[str, dict]:
+        return self.load_json_file(self.oracle_one_step_results_file)
+
+    @trace_question
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        description = self.get_scene_description(
+            image_id=question_data[ImageDataEnum.IMAGE_ID],
+            image_path=question_data[ImageDataEnum.IMAGE_PATH]
+        )
+        return self.get_question_parsing_result(question_data=question_data, description=description)
+
+    def get_question_parsing_result(self, question_data, description: str) -> dict[str, str]:
         """
         Get the question parsing result.
         """
         # get question and prompt and send to gpt
         question = question_data[ImageDataEnum.QUESTION]
 
-        description = "The image contains the following objects:\n"
-        for data in image_scene:
-            description += f"{data['size']} {data['color']} {data['material']} {data['shape']}\n"
-
         prompt = self.prompt.format(question=question, description=description)
 
         question_parsing_result = self.gpt_client.get_lang_model_response(prompt=prompt)
@@ -113,7 +124,7 @@ class OracleObjectsParser(BaseGptClevrSolver):
         return result
 
 
-if __name__ == "__main__":
+def main():
     logger = init_logger(file_name="oracle_parser.log")
     gpt_client = Gpt4LangClient(config=GPT4LangConfig(), logger=logger)
 
@@ -124,3 +135,7 @@ if __name__ == "__main__":
         file_path=oracle_parser.oracle_parsing_results_file,
         data=objects_parsing_results
     )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,14 @@ from logging import Logger
 from pathlib import Path
 from typing import Any
 
-from tqdm import tqdm
-
-from base_gpt_clevr_solver import BaseGptClevrSolver
+from experiments.base_gpt_clevr_solver import BaseGptClevrSolver
 from conf.gpt_4_vision_config import Gpt4VisionConfig
 from conf.data_config import DataConfig
 from data_enums.image_data_enum import ImageDataEnum
 from gpt_clients.gpt4_vision_client import Gpt4VisionClient
 from utils.logger import init_logger
+from utils.progress import tqdm
+from utils.tracing import trace_question
 
 
 class OracleTwoStep(BaseGptClevrSolver):
@@ -39,20 +39,16 @@ class OracleTwoStep(BaseGptClevrSolver):
     def solve_questions(self) -> dict[int, dict]:
         results = {}
         self.logger.info("Starting solving questions")
-        parsing_results = self.load_json_file(file_path=self.oracle_parsing_results_file)
+        parsing_results = self.load_questions()
 
         try:
             for question_index, question_data in tqdm(parsing_results.items()):
-                parsing_res: str = question_data[ImageDataEnum.PARSING_RESULT]
-                if parsing_res is None:
-                    parsing_res = ""
-
-                question_result = self.get_question_result(
-                    question_data=question_data,
-                    parsing_result=parsing_res,
-
+                question_result = self.solve_question_or_dead_letter(
+                    question_index=int(question_index),
+                    question_data=question_data
                 )
-                results[question_index] = question_result
+                if question_result is not None:
+                    results[question_index] = question_result
 
         except Exception as e:
             self.logger.exception(f"Failed to count objects. Error: {e}")
@@ -60,6 +56,16 @@ class OracleTwoStep(BaseGptClevrSolver):
         finally:
             return results
 
+    def load_questions(self) -> dict[str, dict]:
+        return self.load_json_file(file_path=self.oracle_parsing_results_file)
+
+    @trace_question
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        parsing_res: str = question_data[ImageDataEnum.PARSING_RESULT]
+        if parsing_res is None:
+            parsing_res = ""
+        return self.get_question_result(question_data=question_data, parsing_result=parsing_res)
+
     def get_question_result(
             self,
             question_data: dict[str, Any],
@@ -68,14 +74,19 @@ class OracleTwoStep(BaseGptClevrSolver):
         # prepare the data for the gpt model and get the response
         image_path = question_data[ImageDataEnum.IMAGE_PATH]
         question = question_data[ImageDataEnum.QUESTION]
-        prompt = self.prompt.format(question=question, description=parsing_result)
-        gpt_response = self.gpt_client.get_vision_model_response(prompt=prompt, image_path=image_path)
+        prompt = self.format_answer_prompt(self.prompt.format(question=question, description=parsing_result))
+        gpt_responses = self.gpt_client.get_vision_model_responses(
+            prompt=prompt,
+            image_path=image_path,
+            json_response=True,
+            needs_escalation=self.answers_need_escalation
+        )
 
         template = question_data[ImageDataEnum.TEMPLATE]
         image_id = question_data[ImageDataEnum.IMAGE_ID]
         label = question_data[ImageDataEnum.LABEL]
-        numerical_result = self.extract_numeric_answer(text=gpt_response)
-        is_correct = label == numerical_result
+        answer_fields = self.get_answer_fields(gpt_responses=gpt_responses)
+        is_correct = label == answer_fields[ImageDataEnum.NUMERICAL_RESULT]
 
         result = {
             ImageDataEnum.IMAGE_PATH: image_path,
@@ -84,14 +95,13 @@ class OracleTwoStep(BaseGptClevrSolver):
             ImageDataEnum.TEMPLATE: template,
             ImageDataEnum.LABEL: label,
             ImageDataEnum.PARSING_RESULT: parsing_result,
-            ImageDataEnum.GPT_RESPONSE: gpt_response,
-            ImageDataEnum.NUMERICAL_RESULT: numerical_result,
+            **answer_fields,
             ImageDataEnum.IS_CORRECT: is_correct,
         }
         return result
 
 
-if __name__ == "__main__":
+def main():
     logger = init_logger(file_name="oracle_two_step.log")
 
     gpt_config = Gpt4VisionConfig()
@@ -104,3 +114,8 @@ if __name__ == "__main__":
     logger.info(f"Finished solving questions.")
     oracle_two_step.save_json_file(file_path=oracle_two_step.oracle_two_step_results_file, data=answers)
     logger.info(f"Number of correct answers: {oracle_two_step.get_number_of_correct_answers(results=answers)}")
+    oracle_two_step.log_run_stats()
+
+
+if __name__ == "__main__":
+    main()
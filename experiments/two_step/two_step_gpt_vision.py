@@ -2,14 +2,17 @@ from logging import Logger
 from pathlib import Path
 from typing import Any
 
-from tqdm import tqdm
-
 from conf.gpt_4_vision_config import Gpt4VisionConfig
 from conf.data_config import DataConfig
+from data_enums.answer_source_enum import AnswerSourceEnum
 from data_enums.image_data_enum import ImageDataEnum
 from experiments.base_gpt_clevr_solver import BaseGptClevrSolver
+from experiments.two_step.local_arithmetic_solver import LocalArithmeticSolver
 from gpt_clients.gpt4_vision_client import Gpt4VisionClient
+from utils.counting_result_parser import parse_counting_result
 from utils.logger import init_logger
+from utils.progress import tqdm
+from utils.tracing import trace_question
 
 
 class TwoStepGptVision(BaseGptClevrSolver):
@@ -18,6 +21,9 @@ class TwoStepGptVision(BaseGptClevrSolver):
         self.gpt_client: Gpt4VisionClient = gpt_client
         self.two_step_gpt_vision_results_file: Path = data_config.two_step_gpt_vision_results_file
         self.object_counting_results_file: Path = data_config.object_counting_results_file
+        self.use_local_arithmetic_solver: bool = data_config.use_local_arithmetic_solver
+        self.local_arithmetic_solver = LocalArithmeticSolver()
+        self.locally_solved_questions: int = 0
 
     @property
     def prompt(self) -> str:
@@ -40,17 +46,40 @@ class TwoStepGptVision(BaseGptClevrSolver):
             parsing_result: str,
             counting_result: str
     ) -> dict[str, str]:
-        # prepare the data for the gpt model and get the response
         image_path = question_data[ImageDataEnum.IMAGE_PATH]
         question = question_data[ImageDataEnum.QUESTION]
-        prompt = self.prompt.format(question=question, description=counting_result)
-        gpt_response = self.gpt_client.get_vision_model_response(prompt=prompt, image_path=image_path)
+        local_solution = None
+        if self.use_local_arithmetic_solver:
+            local_solution = self.local_arithmetic_solver.solve(
+                question=question,
+                counting_result=parse_counting_result(counting_result),
+            )
+
+        if local_solution is not None:
+            # the counts are conclusive, so there is no need to call the gpt model
+            with self.counters_lock:
+                self.locally_solved_questions += 1
+            answer_fields = {
+                ImageDataEnum.GPT_RESPONSE: None,
+                ImageDataEnum.NUMERICAL_RESULT: local_solution.answer,
+            }
+            answer_source = AnswerSourceEnum.LOCAL_SOLVER
+        else:
+            # prepare the data for the gpt model and get the response
+            prompt = self.format_answer_prompt(self.prompt.format(question=question, description=counting_result))
+            gpt_responses = self.gpt_client.get_vision_model_responses(
+                prompt=prompt,
+                image_path=image_path,
+                json_response=True,
+                needs_escalation=self.answers_need_escalation
+            )
+            answer_fields = self.get_answer_fields(gpt_responses=gpt_responses)
+            answer_source = AnswerSourceEnum.GPT
 
         template = question_data[ImageDataEnum.TEMPLATE]
         image_id = question_data[ImageDataEnum.IMAGE_ID]
         label = question_data[ImageDataEnum.LABEL]
-        numerical_result = self.extract_numeric_answer(text=gpt_response)
-        is_correct = label == numerical_result
+        is_correct = label == answer_fields[ImageDataEnum.NUMERICAL_RESULT]
 
         result = {
             ImageDataEnum.IMAGE_PATH: image_path,
@@ -60,29 +89,41 @@ class TwoStepGptVision(BaseGptClevrSolver):
             ImageDataEnum.LABEL: label,
             ImageDataEnum.PARSING_RESULT: parsing_result,
             ImageDataEnum.COUNTING_RESULT: counting_result,
-            ImageDataEnum.GPT_RESPONSE: gpt_response,
-            ImageDataEnum.NUMERICAL_RESULT: numerical_result,
+            **answer_fields,
             ImageDataEnum.IS_CORRECT: is_correct,
+            ImageDataEnum.ANSWER_SOURCE: answer_source,
         }
+        if local_solution is not None:
+            result[ImageDataEnum.LOCAL_SOLUTION] = local_solution.explanation
         return result
 
+    def get_version_parameters(self) -> dict:
+        return {"use_local_arithmetic_solver": self.use_local_arithmetic_solver}
+
+    def load_questions(self) -> dict[str, dict]:
+        return self.load_json_file(file_path=self.object_counting_results_file)
+
+    @trace_question
+    def solve_question(self, question_index: int, question_data: dict) -> dict:
+        return self.get_question_result(
+            question_data=question_data,
+            parsing_result=question_data[ImageDataEnum.PARSING_RESULT],
+            counting_result=question_data[ImageDataEnum.COUNTING_RESULT]
+        )
+
     def solve_questions(self) -> dict[int, dict]:
         results = {}
         self.logger.info("Starting solving questions")
-        counting_results = self.load_json_file(file_path=self.object_counting_results_file)
+        counting_results = self.load_questions()
 
         try:
             for question_index, counting_data in tqdm(counting_results.items()):
-                count_res: str = counting_data[ImageDataEnum.COUNTING_RESULT]
-                parsing_res: str = counting_data[ImageDataEnum.PARSING_RESULT]
-
-                question_result = self.get_question_result(
-                    question_data=counting_data,
-                    parsing_result=parsing_res,
-                    counting_result=count_res
-
+                question_result = self.solve_question_or_dead_letter(
+                    question_index=int(question_index),
+                    question_data=counting_data
                 )
-                results[question_index] = question_result
+                if question_result is not None:
+                    results[question_index] = question_result
 
         except Exception as e:
             self.logger.exception(f"Failed to count objects. Error: {e}")
@@ -91,7 +132,7 @@ class TwoStepGptVision(BaseGptClevrSolver):
             return results
 
 
-if __name__ == "__main__":
+def main():
     logger = init_logger(file_name="two_step_gpt.log")
 
     gpt_config = Gpt4VisionConfig()
@@ -103,3 +144,10 @@ if __name__ == "__main__":
     answers = two_step_gpt.solve_questions()
     logger.info(f"Finished solving questions.")
     two_step_gpt.save_json_file(file_path=two_step_gpt.two_step_gpt_vision_results_file, data=answers)
+    two_step_gpt.log_run_stats()
+    logger.info(f"Number of questions solved locally from the counting results: "
+                f"{two_step_gpt.locally_solved_questions}")
+
+
+if __name__ == "__main__":
+    main()
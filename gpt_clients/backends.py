@@ -0,0 +1,84 @@
+"""
+Module for the backends the GPT clients request the completions from.
+
+Every backend type has a factory of the openai client of its server, and the requests to the same server share a
+semaphore, so the number of concurrent requests to a server is limited across all the clients and threads that use it
+(e.g. a local model server that can only run a few requests at once).
+openai is imported only when a client is created, since it is slow to import.
+"""
+import threading
+from typing import TYPE_CHECKING, Callable, Optional
+
+from conf.base_gpt_config import BaseGptConfig
+from data_enums.backend_type_enum import BackendTypeEnum
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+# Local servers don't check the api key, but the openai client requires one
+LOCAL_SERVER_API_KEY = "EMPTY"
+
+_request_semaphores: dict[tuple[str, str], threading.BoundedSemaphore] = {}
+_request_semaphores_lock = threading.Lock()
+
+
+def create_azure_openai_client(config: BaseGptConfig) -> "OpenAI":
+    from openai.lib.azure import AzureOpenAI
+    return AzureOpenAI(
+        azure_endpoint=config.azure_endpoint,
+        api_key=config.api_key,
+        api_version=config.api_version,
+        timeout=config.request_timeout_seconds,
+    )
+
+
+def create_openai_compatible_client(config: BaseGptConfig) -> "OpenAI":
+    from openai import OpenAI
+    if not config.base_url:
+        raise ValueError(f"The {BackendTypeEnum.OPENAI_COMPATIBLE.value} backend requires a base_url.")
+    return OpenAI(
+        base_url=config.base_url,
+        api_key=config.api_key or LOCAL_SERVER_API_KEY,
+        timeout=config.request_timeout_seconds,
+    )
+
+
+OPENAI_CLIENT_FACTORIES: dict[BackendTypeEnum, Callable[[BaseGptConfig], "OpenAI"]] = {
+    BackendTypeEnum.AZURE_OPENAI: create_azure_openai_client,
+    BackendTypeEnum.OPENAI_COMPATIBLE: create_openai_compatible_client,
+}
+
+
+def get_backend_type(config: BaseGptConfig) -> BackendTypeEnum:
+    try:
+        return BackendTypeEnum(config.backend)
+    except ValueError:
+        raise ValueError(f"Unknown backend '{config.backend}', "
+                         f"expected one of {[backend.value for backend in BackendTypeEnum]}.") from None
+
+
+def create_openai_client(config: BaseGptConfig) -> "OpenAI":
+    """
+    Create the openai client of the backend of the config.
+    """
+    return OPENAI_CLIENT_FACTORIES[get_backend_type(config)](config)
+
+
+def get_backend_address(config: BaseGptConfig) -> str:
+    if get_backend_type(config) == BackendTypeEnum.AZURE_OPENAI:
+        return config.azure_endpoint or ""
+    return config.base_url or ""
+
+
+def get_request_semaphore(config: BaseGptConfig) -> Optional[threading.BoundedSemaphore]:
+    """
+    The semaphore of the concurrent requests to the server of the config, or None if they are not limited.
+    The clients of the same server share the semaphore of the first client that was created with a limit.
+    """
+    if config.max_concurrent_requests <= 0:
+        return None
+    key = (get_backend_type(config).value, get_backend_address(config))
+    with _request_semaphores_lock:
+        if key not in _request_semaphores:
+            _request_semaphores[key] = threading.BoundedSemaphore(config.max_concurrent_requests)
+        return _request_semaphores[key]
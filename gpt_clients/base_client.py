@@ -1,11 +1,19 @@
 import logging
+import random
 import time
 from abc import ABC
-
-from openai import RateLimitError
-from openai.lib.azure import AzureOpenAI
+from contextlib import contextmanager, nullcontext
+from typing import TYPE_CHECKING, Iterator, Optional
 
 from conf.base_gpt_config import BaseGptConfig
+from data_enums.error_category_enum import ErrorCategoryEnum
+from gpt_clients.backends import create_openai_client, get_backend_type, get_request_semaphore
+from gpt_clients.errors import ContentFilteredError, GptRequestError, classify_error, get_retry_after_seconds
+from utils import metrics, tracing
+from utils.logger import get_request_logger
+
+if TYPE_CHECKING:
+    from openai import BadRequestError, OpenAI
 
 
 class BaseClient(ABC):
@@ -15,38 +23,234 @@ class BaseClient(ABC):
     def __init__(self, config: BaseGptConfig, logger: logging.Logger):
         self.deployment_name = config.vision_model_deployment_name
         self.max_rate_limit_retries = config.max_rate_limit_retries
+        self.max_transient_error_retries = config.max_transient_error_retries
+        self.retry_base_delay_seconds = config.retry_base_delay_seconds
+        self.retry_max_delay_seconds = config.retry_max_delay_seconds
         self.max_tokens = config.max_tokens
         self.temperature = config.temperature
+        self.structured_output = config.structured_output
+        self.self_consistency_samples = config.self_consistency_samples
+        self.self_consistency_temperature = config.self_consistency_temperature
+        self.max_samples_per_request = config.max_samples_per_request
+        self.backend = get_backend_type(config)
+        self.request_semaphore = get_request_semaphore(config)
         self.logger = logger
-        self.client: AzureOpenAI = AzureOpenAI(
-            azure_endpoint=config.azure_endpoint,
-            api_key=config.api_key,
-            api_version=config.api_version
+        self.request_logger = get_request_logger()
+        self.client: "OpenAI" = self.create_openai_client(config=config)
+
+    def create_openai_client(self, config: BaseGptConfig) -> "OpenAI":
+        """
+        Create the client the completions are requested from, for the backend of the config.
+        """
+        return create_openai_client(config)
+
+    def get_run_stats(self) -> dict[str, int]:
+        """
+        Statistics of the client requests in the current run.
+        """
+        return {}
+
+    def get_version_parameters(self) -> dict:
+        """
+        The parameters of the client that change its responses, which are part of the versions of the stage results.
+        """
+        return {
+            "deployment_name": self.deployment_name,
+            "backend": self.backend.value,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "structured_output": self.structured_output,
+            "self_consistency_samples": self.self_consistency_samples,
+            "self_consistency_temperature": self.self_consistency_temperature,
+        }
+
+    def get_retry_delay(self, retry: int, error: Exception) -> float:
+        """
+        Exponential backoff with full jitter, so clients that failed together don't retry together.
+        The delay is at least the Retry-After delay the server asked for.
+        """
+        backoff = min(self.retry_max_delay_seconds, self.retry_base_delay_seconds * 2 ** retry)
+        delay = random.uniform(0, backoff)
+        retry_after = get_retry_after_seconds(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.retry_max_delay_seconds))
+        return delay
+
+    def handle_retryable_error(self, error: Exception, retry: int):
+        wait_time = self.get_retry_delay(retry=retry, error=error)
+        self.logger.info(f"{type(error).__name__} encountered. Waiting for {wait_time:.1f} seconds.")
+        metrics.add(metrics.RETRIES_TOTAL, error=type(error).__name__)
+        metrics.add(metrics.RETRY_WAIT_SECONDS_TOTAL, wait_time, error=type(error).__name__)
+        with tracing.span(tracing.SPAN_RATE_LIMIT_WAIT, wait_seconds=wait_time, error=type(error).__name__):
+            time.sleep(wait_time)
+
+    def handle_unsupported_response_format(self, error: "BadRequestError") -> bool:
+        """
+        Disable the structured output if the deployment rejected the response_format parameter.
+        Returns True if the request should be sent again without it.
+        """
+        if not self.structured_output or "response_format" not in str(error):
+            return False
+        self.logger.warning(f"The deployment does not support structured output, disabling it. Error: {error}")
+        self.structured_output = False
+        return True
+
+    def log_request(self, start_time: float, outcome: str, attempt: int, **fields):
+        """
+        Log the request as a JSON line of the per-request log. The question index and stage are added from the
+        log context of the question. The request is also counted in the live metrics.
+        """
+        latency_seconds = time.perf_counter() - start_time
+        metrics.add(metrics.REQUESTS_TOTAL, backend=self.backend.value, deployment=self.deployment_name,
+                    outcome=outcome)
+        metrics.add(metrics.REQUEST_SECONDS_TOTAL, latency_seconds, backend=self.backend.value,
+                    deployment=self.deployment_name)
+        self.request_logger.info(
+            "gpt_request",
+            extra={
+                "backend": self.backend.value,
+                "deployment": self.deployment_name,
+                "latency_ms": round(latency_seconds * 1000, 2),
+                "outcome": outcome,
+                "attempt": attempt,
+                **fields,
+            },
         )
 
-    def handle_rate_limit_error(self):
-        wait_time = 5
-        self.logger.info(f"Rate limit error encountered. Waiting for {wait_time} seconds.")
-        time.sleep(wait_time)
+    @contextmanager
+    def request_slot(self) -> Iterator[None]:
+        """
+        Hold a slot of the concurrency limit of the backend (if it has one) while the request is sent, and count the
+        requests that wait for a slot and the requests in flight in the live metrics.
+        """
+        labels = {"backend": self.backend.value, "deployment": self.deployment_name}
+        metrics.add(metrics.REQUESTS_WAITING, 1, **labels)
+        with self.request_semaphore or nullcontext():
+            metrics.add(metrics.REQUESTS_WAITING, -1, **labels)
+            metrics.add(metrics.REQUESTS_IN_FLIGHT, 1, **labels)
+            try:
+                yield
+            finally:
+                metrics.add(metrics.REQUESTS_IN_FLIGHT, -1, **labels)
+
+    def record_token_usage(self, response):
+        """
+        Count the prompt and completion tokens of the response in the live metrics, if the backend reported them.
+        """
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        for token_type in ("prompt", "completion"):
+            tokens = getattr(usage, f"{token_type}_tokens", None)
+            if tokens:
+                metrics.add(metrics.TOKENS_TOTAL, tokens, backend=self.backend.value,
+                            deployment=self.deployment_name, type=token_type)
+
+    def _get_response(self, messages: list[dict], json_response: bool = False) -> str:
+        response = self._create_completion(messages=messages, json_response=json_response)
+        return response.choices[0].message.content
+
+    def _get_responses(
+            self,
+            messages: list[dict],
+            n: Optional[int] = None,
+            json_response: bool = False
+    ) -> list[str]:
+        """
+        Sample n completions in a single request, so the prompt (and the image) are sent and paid for only once.
+        When more than one completion is sampled, the self-consistency temperature is used.
+        If the backend limits the samples per request, the samples are split into several requests.
+        """
+        if n is None:
+            n = self.self_consistency_samples
+        if n <= 1:
+            return [self._get_response(messages=messages, json_response=json_response)]
+
+        samples_per_request = self.max_samples_per_request if self.max_samples_per_request > 0 else n
+        responses = []
+        for sampled in range(0, n, samples_per_request):
+            request_samples = min(samples_per_request, n - sampled)
+            request_params = {"n": request_samples} if request_samples > 1 else {}
+            response = self._create_completion(
+                messages=messages,
+                json_response=json_response,
+                temperature=self.self_consistency_temperature,
+                **request_params,
+            )
+            responses.extend(choice.message.content for choice in response.choices)
+        return responses
+
+    def _get_response_with_logprobs(
+            self,
+            messages: list[dict],
+            json_response: bool = False
+    ) -> tuple[str, list[tuple[str, float]]]:
+        """
+        Get the response together with the log probability of each of its tokens.
+        """
+        response = self._create_completion(messages=messages, json_response=json_response, logprobs=True)
+        choice = response.choices[0]
+        token_logprobs = []
+        if choice.logprobs is not None and choice.logprobs.content is not None:
+            token_logprobs = [(token.token, token.logprob) for token in choice.logprobs.content]
+        return choice.message.content, token_logprobs
+
+    def _create_completion(self, messages: list[dict], json_response: bool = False, **request_params):
+        """
+        Request a completion, and retry the retryable errors with jittered exponential backoff: rate limits up to
+        max_rate_limit_retries times, and the other transient errors up to max_transient_error_retries times.
+        Errors that can't be retried are raised as a GptRequestError with their category.
+        """
+        from openai import BadRequestError, RateLimitError
 
-    def _get_response(self, messages: list[dict]):
         rate_limit_error_count = 0
+        transient_error_count = 0
+        attempt = 0
+        request_params.setdefault("temperature", self.temperature)
         while True:
+            attempt += 1
+            response_format_params = {}
+            if json_response and self.structured_output:
+                response_format_params["response_format"] = {"type": "json_object"}
+            start_time = time.perf_counter()
             try:
-                response = self.client.chat.completions.create(
-                    model=self.deployment_name,
-                    messages=messages,
-                    temperature=self.temperature,
-                    max_tokens=self.max_tokens,
-                )
-                return response.choices[0].message.content
-            except RateLimitError as e:
-                if rate_limit_error_count >= self.max_rate_limit_retries:
-                    self.logger.error(f"Rate limit error count exceeded {self.max_rate_limit_retries}. Exiting.")
-                    raise e
-                else:
-                    self.handle_rate_limit_error()
-                    rate_limit_error_count += 1
+                with self.request_slot(), tracing.span(tracing.SPAN_NETWORK, deployment=self.deployment_name):
+                    response = self.client.chat.completions.create(
+                        model=self.deployment_name,
+                        messages=messages,
+                        max_tokens=self.max_tokens,
+                        **request_params,
+                        **response_format_params,
+                    )
+                self.record_token_usage(response)
+                self.check_content_filter(response)
+            except Exception as e:
+                category = classify_error(e)
+                self.log_request(start_time, outcome=category.value, attempt=attempt, error=repr(e))
+                if isinstance(e, BadRequestError) and response_format_params \
+                        and self.handle_unsupported_response_format(error=e):
                     continue
+                if category != ErrorCategoryEnum.RETRYABLE:
+                    raise GptRequestError(f"{type(e).__name__}: {e}", category=category, attempts=attempt) from e
 
+                if isinstance(e, RateLimitError):
+                    retry, max_retries = rate_limit_error_count, self.max_rate_limit_retries
+                    rate_limit_error_count += 1
+                else:
+                    retry, max_retries = transient_error_count, self.max_transient_error_retries
+                    transient_error_count += 1
+                if retry >= max_retries:
+                    self.logger.error(f"{type(e).__name__} count exceeded {max_retries}.")
+                    raise GptRequestError(f"{type(e).__name__}: {e}", category=category, attempts=attempt) from e
+                self.handle_retryable_error(error=e, retry=retry)
+                continue
+            self.log_request(start_time, outcome="success", attempt=attempt, n=request_params.get("n", 1))
+            return response
 
+    @staticmethod
+    def check_content_filter(response):
+        """
+        Raise a ContentFilteredError if the completion was stopped by the content filter.
+        """
+        if any(getattr(choice, "finish_reason", None) == "content_filter" for choice in response.choices):
+            raise ContentFilteredError("The completion was stopped by the content filter.")
@@ -0,0 +1,87 @@
+"""
+Module for the classification of the errors of GPT requests.
+
+openai is imported only when an error is classified, since it is slow to import.
+"""
+from typing import Optional
+
+from data_enums.error_category_enum import ErrorCategoryEnum
+
+CONTENT_FILTER_CODE = "content_filter"
+# Status codes of transient errors: request timeout, conflict, rate limit and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+# Status codes of a wrong client configuration (key, endpoint or deployment), that fail every request the same way
+CONFIGURATION_ERROR_STATUS_CODES = {401, 403, 404}
+
+
+class GptRequestError(Exception):
+    """
+    A GPT request that failed, after the retries of its category.
+    """
+    def __init__(self, message: str, category: ErrorCategoryEnum, attempts: int):
+        super().__init__(message)
+        self.category = category
+        self.attempts = attempts
+
+
+class ContentFilteredError(Exception):
+    """
+    The completion was stopped by the content filter (finish_reason 'content_filter').
+    """
+
+
+def classify_error(error: BaseException) -> ErrorCategoryEnum:
+    """
+    Classify the error of a GPT request as retryable, permanent or content filtered.
+    """
+    from openai import APIConnectionError, APIStatusError
+
+    if isinstance(error, GptRequestError):
+        return error.category
+    if isinstance(error, ContentFilteredError):
+        return ErrorCategoryEnum.CONTENT_FILTERED
+    # APITimeoutError is an APIConnectionError
+    if isinstance(error, (APIConnectionError, TimeoutError, ConnectionError)):
+        return ErrorCategoryEnum.RETRYABLE
+    if isinstance(error, APIStatusError):
+        if get_error_code(error) == CONTENT_FILTER_CODE:
+            return ErrorCategoryEnum.CONTENT_FILTERED
+        if error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500:
+            return ErrorCategoryEnum.RETRYABLE
+    return ErrorCategoryEnum.PERMANENT
+
+
+def is_configuration_error(error: BaseException) -> bool:
+    """
+    Whether the error is an authentication, permission or not found error, e.g. a wrong key or deployment name.
+    Solving the other questions would fail the same way, so the run should stop instead of continuing.
+    """
+    from openai import APIStatusError
+
+    if isinstance(error, GptRequestError) and error.__cause__ is not None:
+        error = error.__cause__
+    return isinstance(error, APIStatusError) and error.status_code in CONFIGURATION_ERROR_STATUS_CODES
+
+
+def get_error_code(error) -> Optional[str]:
+    """
+    The code of an API error, e.g. 'content_filter' for prompts that the Azure content filter blocked.
+    """
+    code = getattr(error, "code", None)
+    if code is None and isinstance(getattr(error, "body", None), dict):
+        code = error.body.get("code")
+    return code
+
+
+def get_retry_after_seconds(error) -> Optional[float]:
+    """
+    The delay the server asked for in the Retry-After header of the error response, if any.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    retry_after = response.headers.get("retry-after")
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return None
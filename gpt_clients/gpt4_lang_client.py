@@ -1,3 +1,5 @@
+from typing import Optional
+
 from gpt_clients.base_client import BaseClient
 
 
@@ -5,11 +7,19 @@ class Gpt4LangClient(BaseClient):
     """
     GPT-4 client for language models.
     """
-    def get_lang_model_response(self, prompt: str) -> str:
+    def get_lang_model_response(self, prompt: str, json_response: bool = False) -> str:
         messages = self.prepare_messages(prompt=prompt)
-        response = self._get_response(messages=messages)
+        response = self._get_response(messages=messages, json_response=json_response)
         return response
 
+    def get_lang_model_responses(self, prompt: str, json_response: bool = False, n: Optional[int] = None) -> list[str]:
+        """
+        Sample n responses for the same prompt in a single request (self-consistency mode).
+        By default, the number of self-consistency samples from the config is used.
+        """
+        messages = self.prepare_messages(prompt=prompt)
+        return self._get_responses(messages=messages, n=n, json_response=json_response)
+
     def prepare_messages(self, prompt: str) -> list[dict]:
         messages = [
             {
@@ -1,33 +1,162 @@
 import base64
-from typing import Optional
+import threading
+from collections import Counter, OrderedDict
+from typing import Callable, Optional
 
+from conf.base_gpt_config import BaseGptConfig
 from gpt_clients.base_client import BaseClient
+from utils import metrics, tracing
+
+IMAGE_LABEL = "Image"
 
 
 class Gpt4VisionClient(BaseClient):
     """
     This class is a client for the GPT-4 Vision model.
+    When adaptive image detail is enabled, the image is first sent in low detail, and the request is re-issued in
+    high detail only if the caller finds the low detail responses inconclusive.
     """
+    def __init__(self, config: BaseGptConfig, logger):
+        super().__init__(config=config, logger=logger)
+        self.adaptive_image_detail = config.adaptive_image_detail
+        self.initial_image_detail = config.initial_image_detail
+        self.escalated_image_detail = config.escalated_image_detail
+        self.image_detail_stats: Counter = Counter()
+        self.image_encoding_cache_size = config.image_encoding_cache_size
+        self.encoded_images: OrderedDict[str, str] = OrderedDict()
+        self.image_encoding_cache_hits: int = 0
+        self._encoded_images_lock = threading.Lock()
 
     def get_vision_model_response(
             self,
             image_path: str,
             prompt: str,
-            chain_of_thought_messages: Optional[list[dict]] = None
+            chain_of_thought_messages: Optional[list[dict]] = None,
+            json_response: bool = False,
+            needs_escalation: Optional[Callable[[str], bool]] = None
     ) -> str:
+        def responses_need_escalation(responses: list[str]) -> bool:
+            return needs_escalation(responses[0])
+
+        return self.get_vision_model_responses(
+            image_path=image_path,
+            prompt=prompt,
+            chain_of_thought_messages=chain_of_thought_messages,
+            json_response=json_response,
+            n=1,
+            needs_escalation=responses_need_escalation if needs_escalation is not None else None,
+        )[0]
+
+    def get_vision_model_responses(
+            self,
+            image_path: str,
+            prompt: str,
+            chain_of_thought_messages: Optional[list[dict]] = None,
+            json_response: bool = False,
+            n: Optional[int] = None,
+            needs_escalation: Optional[Callable[[list[str]], bool]] = None
+    ) -> list[str]:
+        """
+        Sample n responses for the same image and prompt in a single request (self-consistency mode).
+        By default, the number of self-consistency samples from the config is used.
+        If adaptive image detail is enabled and needs_escalation is given, the image is first sent in the initial
+        (low) detail, and sent again in the escalated (high) detail only if needs_escalation(responses) is True.
+        """
         if chain_of_thought_messages is None:
             chain_of_thought_messages = []
-        prompt_messages = self.prepare_messages(image_path=image_path, prompt=prompt)
-        messages = chain_of_thought_messages + prompt_messages
-        response = self._get_response(messages=messages)
-        return response
 
-    def prepare_messages(self, image_path: str, prompt: str) -> list[dict]:
+        def get_responses(image_detail: Optional[str]) -> list[str]:
+            prompt_messages = self.prepare_messages(image_path=image_path, prompt=prompt, image_detail=image_detail)
+            messages = chain_of_thought_messages + prompt_messages
+            return self._get_responses(messages=messages, n=n, json_response=json_response)
+
+        if not self.adaptive_image_detail or needs_escalation is None:
+            return get_responses(image_detail=None)
+
+        self.image_detail_stats["initial_detail_requests"] += 1
+        responses = get_responses(image_detail=self.initial_image_detail)
+        if not needs_escalation(responses):
+            return responses
+
+        self.image_detail_stats["escalated_requests"] += 1
+        self.logger.info(f"Inconclusive response in {self.initial_image_detail} detail for {image_path}, "
+                         f"sending the image again in {self.escalated_image_detail} detail.")
+        return get_responses(image_detail=self.escalated_image_detail)
+
+    def get_vision_model_response_with_logprobs(
+            self,
+            image_path: str,
+            prompt: str,
+            json_response: bool = False
+    ) -> tuple[str, list[tuple[str, float]]]:
+        """
+        Get the response for the image and prompt, with the log probability of each of the response tokens.
+        """
+        messages = self.prepare_messages(image_path=image_path, prompt=prompt)
+        return self._get_response_with_logprobs(messages=messages, json_response=json_response)
+
+    def get_vision_model_response_for_images(
+            self,
+            image_paths: list[str],
+            prompt: str,
+            json_response: bool = False
+    ) -> str:
+        """
+        Get a single response for several images, that are sent in one request after the prompt, each preceded by
+        its label ('Image 1:', 'Image 2:', ...).
+        """
+        messages = self.prepare_images_messages(image_paths=image_paths, prompt=prompt)
+        return self._get_response(messages=messages, json_response=json_response)
+
+    def get_run_stats(self) -> dict[str, int]:
+        run_stats = dict(self.image_detail_stats)
+        if self.image_encoding_cache_size > 0:
+            run_stats["image_encoding_cache_hits"] = self.image_encoding_cache_hits
+        return run_stats
+
+    def get_version_parameters(self) -> dict:
+        return {
+            **super().get_version_parameters(),
+            "adaptive_image_detail": self.adaptive_image_detail,
+            "initial_image_detail": self.initial_image_detail,
+            "escalated_image_detail": self.escalated_image_detail,
+        }
+
+    def get_encoded_image(self, image_path: str) -> str:
+        """
+        Get the base64 encoded image, from the cache of the recently encoded images when it is enabled.
+        """
+        if self.image_encoding_cache_size <= 0:
+            return self.encode_image(image_path)
+        image_key = str(image_path)
+        with self._encoded_images_lock:
+            encoded_image = self.encoded_images.get(image_key)
+            if encoded_image is not None:
+                self.encoded_images.move_to_end(image_key)
+                self.image_encoding_cache_hits += 1
+        metrics.record_cache_lookup(cache="image_encoding", hit=encoded_image is not None)
+        if encoded_image is not None:
+            return encoded_image
+
+        encoded_image = self.encode_image(image_path)
+        with self._encoded_images_lock:
+            self.encoded_images[image_key] = encoded_image
+            while len(self.encoded_images) > self.image_encoding_cache_size:
+                self.encoded_images.popitem(last=False)
+        return encoded_image
+
+    def prepare_messages(self, image_path: str, prompt: str, image_detail: Optional[str] = None) -> list[dict]:
         """
         Prepare the messages for the GPT-4 Vision model.
         This function expects an image path and a prompt, and adds both to the messages.
+        If image_detail is given ('low', 'high' or 'auto'), the image is sent in that detail.
         """
-        base64_image = self.encode_image(image_path)
+        with tracing.span(tracing.SPAN_MESSAGE_BUILD):
+            return self._prepare_messages(image_path=image_path, prompt=prompt, image_detail=image_detail)
+
+    def _prepare_messages(self, image_path: str, prompt: str, image_detail: Optional[str] = None) -> list[dict]:
+        base64_image = self.get_encoded_image(image_path)
+        image_url = f"data:image/jpeg;base64,{base64_image}"
         messages = [
             {
                 "role": "user",
@@ -38,7 +167,7 @@ class Gpt4VisionClient(BaseClient):
                     },
                     {
                         "type": "image_url",
-                        "image_url": f"data:image/jpeg;base64,{base64_image}",
+                        "image_url": image_url if image_detail is None else {"url": image_url, "detail": image_detail},
                     },
                 ],
             },
@@ -46,10 +175,22 @@ class Gpt4VisionClient(BaseClient):
 
         return messages
 
+    def prepare_images_messages(self, image_paths: list[str], prompt: str) -> list[dict]:
+        """
+        Prepare the messages for a prompt about several images, each preceded by its label, starting from 1.
+        """
+        with tracing.span(tracing.SPAN_MESSAGE_BUILD, images=len(image_paths)):
+            content = [{"type": "text", "text": prompt}]
+            for image_number, image_path in enumerate(image_paths, start=1):
+                content.append({"type": "text", "text": f"{IMAGE_LABEL} {image_number}:"})
+                image_url = f"data:image/jpeg;base64,{self.get_encoded_image(image_path)}"
+                content.append({"type": "image_url", "image_url": image_url})
+            return [{"role": "user", "content": content}]
+
     @staticmethod
     def encode_image(image_path):
         """
         Encode the image to base64.
         """
-        with open(image_path, "rb") as image_file:
+        with tracing.span(tracing.SPAN_IMAGE_ENCODE), open(image_path, "rb") as image_file:
             return base64.b64encode(image_file.read()).decode('utf-8')
@@ -0,0 +1,221 @@
+"""
+The command line entry point of the experiments: `python twostagegpt.py <command>`, from the root directory.
+
+The experiments modules are imported only when their command is run, so showing the help and starting the stages
+that only read json files is fast.
+"""
+import argparse
+import importlib
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass(frozen=True)
+class Command:
+    help: str
+    # The "module:function" entry points the command runs, in order
+    entry_points: tuple[str, ...]
+    # Whether the command has its own arguments, that are passed to its entry point
+    passes_arguments: bool = False
+
+
+COMMANDS: dict[str, Command] = {
+    "one-step": Command(
+        help="Solve the questions in the one-step approach.",
+        entry_points=("experiments.one_step.one_step_gpt:main",),
+    ),
+    "one-step-cot": Command(
+        help="Solve the questions in the one-step approach, with chain of thought examples.",
+        entry_points=("experiments.one_step.one_step_gpt_CoT:main",),
+    ),
+    "oracle-one-step": Command(
+        help="Solve the questions in the one-step approach, with the CLEVR scene description of the image.",
+        entry_points=("experiments.one_step.oracle_one_step:main",),
+    ),
+    "simple-object-detector": Command(
+        help="Detect the objects in the images of the questions sampled for validation.",
+        entry_points=("experiments.one_step.simple_object_detector:main",),
+    ),
+    "objects-parser": Command(
+        help="Parse the objects from the questions (two-stage approach, step 1).",
+        entry_points=("experiments.two_step.objects_parser:main",),
+    ),
+    "objects-counter": Command(
+        help="Count the parsed objects in the images (two-stage approach, step 2).",
+        entry_points=("experiments.two_step.objects_counter:main",),
+    ),
+    "two-step-gpt-vision": Command(
+        help="Solve the questions with the objects counts (two-stage approach, step 3).",
+        entry_points=("experiments.two_step.two_step_gpt_vision:main",),
+    ),
+    "fused-count-and-solve": Command(
+        help="Count the parsed objects and solve the questions in a single vision request per question (replaces "
+             "two-stage steps 2 and 3).",
+        entry_points=("experiments.two_step.fused_count_and_solve:main",),
+    ),
+    "oracle-parser": Command(
+        help="Parse the objects from the questions, and count them from the CLEVR scenes (oracle step 1).",
+        entry_points=("experiments.two_step.oracle_parser:main",),
+    ),
+    "oracle-two-step": Command(
+        help="Solve the questions with the oracle objects counts (oracle step 2).",
+        entry_points=("experiments.two_step.oracle_two_step:main",),
+    ),
+    "cascade": Command(
+        help="Solve the questions in the one-step approach, and escalate the low confidence ones to the two-stage "
+             "approach.",
+        entry_points=("experiments.cascade.cascade_solver:main",),
+    ),
+    "two-step-pipeline": Command(
+        help="Run the whole two-stage approach: objects-parser, objects-counter and two-step-gpt-vision.",
+        entry_points=(
+            "experiments.two_step.objects_parser:main",
+            "experiments.two_step.objects_counter:main",
+            "experiments.two_step.two_step_gpt_vision:main",
+        ),
+    ),
+    "oracle-two-step-pipeline": Command(
+        help="Run the whole oracle two-stage approach: oracle-parser and oracle-two-step.",
+        entry_points=(
+            "experiments.two_step.oracle_parser:main",
+            "experiments.two_step.oracle_two_step:main",
+        ),
+    ),
+    "matrix": Command(
+        help="Run several stages together, with shared data and clients, and one concurrency budget (see "
+             "`matrix --help`).",
+        entry_points=("experiments.matrix_runner:main",),
+        passes_arguments=True,
+    ),
+    "queue": Command(
+        help="Run a stage with several workers through a work queue (see `queue --help`).",
+        entry_points=("experiments.queue_worker:main",),
+        passes_arguments=True,
+    ),
+    "retry-dead-letters": Command(
+        help="Retry the failed questions of a stage from the dead letters file (see `retry-dead-letters --help`).",
+        entry_points=("experiments.retry_dead_letters:main",),
+        passes_arguments=True,
+    ),
+    "compare": Command(
+        help="Compare the accuracy of experiments results files (see `compare --help`).",
+        entry_points=("utils.result_statistics:main",),
+        passes_arguments=True,
+    ),
+    "validate-detections": Command(
+        help="Validate the object detections of results files against the CLEVR scenes "
+             "(see `validate-detections --help`).",
+        entry_points=("utils.detection_validator:main",),
+        passes_arguments=True,
+    ),
+    "generate-questions": Command(
+        help="Generate synthetic CLEVR-math questions from CLEVR scenes, for load tests (see "
+             "`generate-questions --help`).",
+        entry_points=("utils.question_generator:main",),
+        passes_arguments=True,
+    ),
+    "bench-replay": Command(
+        help="Measure the throughput of the experiments with recorded responses (see `bench-replay --help`).",
+        entry_points=("benchmarks.replay_benchmark:main",),
+        passes_arguments=True,
+    ),
+    "bench-micro": Command(
+        help="Measure the local per-question operations (see `bench-micro --help`).",
+        entry_points=("benchmarks.micro_benchmarks:main",),
+        passes_arguments=True,
+    ),
+    "bench-local-counter": Command(
+        help="Measure the local object counter against the CLEVR scenes (see `bench-local-counter --help`).",
+        entry_points=("benchmarks.local_counter_benchmark:main",),
+        passes_arguments=True,
+    ),
+    "bench-fused": Command(
+        help="Compare the fused count-and-solve mode with the two-call flow (see `bench-fused --help`).",
+        entry_points=("benchmarks.fused_benchmark:main",),
+        passes_arguments=True,
+    ),
+    "bench-startup": Command(
+        help="Measure the startup time of the commands (see `bench-startup --help`).",
+        entry_points=("benchmarks.startup_time:main",),
+        passes_arguments=True,
+    ),
+}
+
+
+def run_entry_point(entry_point: str):
+    module_name, function_name = entry_point.split(":")
+    module = importlib.import_module(module_name)
+    getattr(module, function_name)()
+
+
+def run_command(command: Command):
+    for entry_point in command.entry_points:
+        run_entry_point(entry_point)
+
+
+def run_traced_command(command: Command, args: argparse.Namespace):
+    """
+    Run the command with tracing, profiling and live metrics, as requested in the arguments, and export their results
+    even if the command failed.
+    """
+    metrics_server = None
+    if args.metrics_port is not None:
+        from utils import metrics
+
+        metrics_server = metrics.serve_metrics(port=args.metrics_port, host=args.metrics_host)
+        print(f"Serving the live metrics at http://{args.metrics_host}:{metrics_server.port}/metrics", file=sys.stderr)
+
+    tracer = None
+    try:
+        if args.trace is None and args.profile is None:
+            run_command(command)
+            return
+
+        from utils import tracing
+        from utils.profiler import profile_run
+
+        tracer = tracing.enable_tracing() if args.trace is not None else None
+        if args.profile is not None:
+            profile_run(lambda: run_command(command), flamegraph_file=args.profile,
+                        interval_seconds=args.profile_interval_ms / 1000)
+        else:
+            run_command(command)
+    finally:
+        if tracer is not None:
+            tracer.export(args.trace, trace_format=args.trace_format)
+        if metrics_server is not None:
+            metrics_server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="twostagegpt", description="Run the CLEVR-math experiments.")
+    parser.add_argument("--trace", type=Path, default=None,
+                        help="Trace the stages of every question, and save the spans in this file.")
+    parser.add_argument("--trace-format", choices=("chrome", "otlp"), default="chrome",
+                        help="Save the spans as a Chrome trace (chrome://tracing, Perfetto) or as OTLP JSON.")
+    parser.add_argument("--profile", type=Path, default=None,
+                        help="Run the sampling profiler, and save the flamegraph of the run in this SVG file "
+                             "(and the folded stacks next to it).")
+    parser.add_argument("--profile-interval-ms", type=float, default=5)
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve live metrics of the run in the Prometheus text format on this port.")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="The address the metrics are served on. Defaults to local connections only.")
+    subparsers = parser.add_subparsers(dest="command", required=True, metavar="<command>")
+    for name, command in COMMANDS.items():
+        subparsers.add_parser(name, help=command.help, description=command.help,
+                              add_help=not command.passes_arguments)
+
+    # The arguments of the commands that have their own arguments are parsed by their entry point
+    args, arguments = parser.parse_known_args()
+    command = COMMANDS[args.command]
+    if command.passes_arguments:
+        sys.argv = [f"{parser.prog} {args.command}", *arguments]
+    elif arguments:
+        parser.error(f"unrecognized arguments: {' '.join(arguments)}")
+    run_traced_command(command, args)
+
+
+if __name__ == "__main__":
+    main()
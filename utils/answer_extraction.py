@@ -0,0 +1,182 @@
+"""
+Module for extracting the numeric answer from the GPT responses.
+
+The answer is extracted from a JSON response when the structured output protocol is used, and otherwise from the
+'My answer is: <numeric answer>' phrase, while tolerating markdown formatting, negative numbers and numbers written
+as words.
+"""
+import json
+import math
+import re
+from collections import Counter
+from typing import Optional, Union
+
+ANSWER_JSON_KEY = "answer"
+EXPLANATION_JSON_KEY = "explanation"
+ANSWER_JSON_FORMAT_INSTRUCTIONS = (
+    "\n\nPay attention: instead of concluding with 'My answer is: <numeric answer>', respond only with a JSON "
+    "object in the following format:\n"
+    f'{{"{EXPLANATION_JSON_KEY}": "<brief explanation>", "{ANSWER_JSON_KEY}": <numeric answer>}}'
+)
+
+UNITS = {
+    "zero": 0, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7,
+    "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "thirteen": 13, "fourteen": 14, "fifteen": 15,
+    "sixteen": 16, "seventeen": 17, "eighteen": 18, "nineteen": 19,
+}
+TENS = {
+    "twenty": 20, "thirty": 30, "forty": 40, "fifty": 50, "sixty": 60, "seventy": 70, "eighty": 80, "ninety": 90,
+}
+NEGATIVE_WORDS = ("minus", "negative")
+# 'none' is an answer of 0 only in the requested phrase and in a JSON answer, since in the looser phrases it is
+# usually prose (e.g. 'the answer is none of these')
+ZERO_WORDS = ("none",)
+
+_NUMBER_WORD = "|".join(sorted(list(UNITS) + list(TENS), key=len, reverse=True))
+_NUMBER = rf"(?:-\s*)?\d+|(?:(?:{'|'.join(NEGATIVE_WORDS)})\s+)?(?:{_NUMBER_WORD})(?:[\s-](?:{_NUMBER_WORD}))?"
+_ZERO_WORD = rf"(?:{'|'.join(ZERO_WORDS)})\b(?!\s+of\b)"
+# The phrases are ordered by priority: the requested phrase first, then looser variants of it.
+# Each phrase is given with whether it accepts the zero words.
+ANSWER_PATTERNS = [
+    (re.compile(rf"my\s+answer\s+is\s*:?\s*({_NUMBER}|{_ZERO_WORD})\b", re.IGNORECASE), True),
+    (re.compile(rf"(?:final\s+)?answer\s*(?:is|=|:)\s*:?\s*({_NUMBER})\b", re.IGNORECASE), False),
+]
+JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+FORMATTING_CHARACTERS = re.compile(r"[*_`#]")
+
+
+def parse_number(token: Union[str, int, float, None], allow_zero_words: bool = False) -> Optional[int]:
+    """
+    Parse a number that is written with digits or words, e.g.: '3', '-3', 'three', 'minus three', 'twenty-one', and
+    'none' when allow_zero_words is set.
+    Returns None if the token is not a number.
+    """
+    if token is None or isinstance(token, bool):
+        return None
+    if isinstance(token, (int, float)):
+        return int(token) if float(token).is_integer() else None
+
+    token = token.strip().lower().rstrip(".")
+    sign = 1
+    for negative_word in NEGATIVE_WORDS:
+        if token.startswith(negative_word):
+            sign = -1
+            token = token[len(negative_word):].strip()
+    if token.startswith("-"):
+        sign = -sign
+        token = token[1:].strip()
+
+    if token.isdigit():
+        return sign * int(token)
+
+    if allow_zero_words and token in ZERO_WORDS:
+        return 0
+
+    words = re.split(r"[\s-]+", token)
+    if len(words) == 1 and words[0] in UNITS:
+        return sign * UNITS[words[0]]
+    if len(words) == 1 and words[0] in TENS:
+        return sign * TENS[words[0]]
+    if len(words) == 2 and words[0] in TENS and words[1] in UNITS and 0 < UNITS[words[1]] < 10:
+        return sign * (TENS[words[0]] + UNITS[words[1]])
+    return None
+
+
+def extract_json_answer(text: str) -> Optional[int]:
+    """
+    Extract the answer from a JSON response (possibly wrapped in a markdown code block).
+    """
+    match = JSON_OBJECT_PATTERN.search(text)
+    if match is None:
+        return None
+    try:
+        response = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(response, dict):
+        return None
+    return parse_number(response.get(ANSWER_JSON_KEY), allow_zero_words=True)
+
+
+def extract_phrase_answer(text: str) -> Optional[int]:
+    """
+    Extract the answer from the 'My answer is: <numeric answer>' phrase, or a looser variant of it.
+    If the phrase appears more than once, the last occurrence is used, as the answer concludes the response.
+    """
+    text = FORMATTING_CHARACTERS.sub("", text)
+    for pattern, allow_zero_words in ANSWER_PATTERNS:
+        matches = pattern.findall(text)
+        for match in reversed(matches):
+            answer = parse_number(match, allow_zero_words=allow_zero_words)
+            if answer is not None:
+                return answer
+    return None
+
+
+def extract_numeric_answer(text: Optional[str]) -> Optional[int]:
+    """
+    Extracts the numeric answer from a GPT response.
+
+    Args:
+    text (str): The GPT response, either a JSON object with an 'answer' key, or a text that concludes with
+    'My answer is: <numeric answer>'.
+
+    Returns:
+    int or None: The extracted numeric answer, or None if not found.
+    """
+    if not text:
+        return None
+    answer = extract_json_answer(text)
+    if answer is None:
+        answer = extract_phrase_answer(text)
+    return answer
+
+
+def majority_vote(answers: list[Optional[int]]) -> tuple[Optional[int], dict[str, int]]:
+    """
+    Aggregate the answers extracted from several sampled responses by a majority vote.
+    Ties are broken in favor of the answer that was sampled first, and answers that could not be extracted don't vote.
+
+    Returns:
+    The winning answer (or None if no answer was extracted), and the vote distribution: the number of votes of each
+    answer, keyed by the answer as a string (so it can be saved as a JSON object).
+    """
+    votes = Counter(answer for answer in answers if answer is not None)
+    if not votes:
+        return None, {}
+    winner, _ = votes.most_common(1)[0]
+    return winner, {str(answer): count for answer, count in votes.most_common()}
+
+
+def answer_token_confidence(token_logprobs: list[tuple[str, float]], answer: Optional[int]) -> Optional[float]:
+    """
+    The probability the model assigned to the answer tokens: the tokens of the last occurrence of the answer in the
+    response, which is where the response concludes with the answer.
+    Returns None if there is no answer, or if it can't be found in the response tokens (e.g. a number word).
+    """
+    if answer is None or not token_logprobs:
+        return None
+
+    text = "".join(token for token, _ in token_logprobs)
+    answer_start = text.rfind(str(answer))
+    if answer_start == -1:
+        return None
+    answer_end = answer_start + len(str(answer))
+
+    answer_logprob = 0.0
+    token_start = 0
+    for token, logprob in token_logprobs:
+        token_end = token_start + len(token)
+        if token_start < answer_end and token_end > answer_start:
+            answer_logprob += logprob
+        token_start = token_end
+    return math.exp(answer_logprob)
+
+
+def vote_agreement(vote_distribution: dict[str, int], number_of_samples: int) -> Optional[float]:
+    """
+    The share of the sampled responses that voted for the winning answer.
+    """
+    if not vote_distribution or number_of_samples == 0:
+        return None
+    return max(vote_distribution.values()) / number_of_samples
@@ -0,0 +1,127 @@
+"""
+Module for the CLEVR objects attributes.
+
+A CLEVR object is described by its size, color, material and shape. The questions and the GPT responses refer to
+groups of objects by some of these attributes, with synonyms (e.g. 'tiny metallic balls' are 'small metal spheres'),
+and any attribute that is not mentioned matches all the objects ('objects' and 'things' match every object).
+"""
+import re
+from dataclasses import dataclass, fields
+from typing import Optional
+
+SIZES = ("small", "large")
+COLORS = ("gray", "red", "blue", "green", "brown", "purple", "cyan", "yellow")
+MATERIALS = ("rubber", "metal")
+SHAPES = ("cube", "sphere", "cylinder")
+SCENE_DESCRIPTION_HEADER = "The image contains the following objects:\n"
+
+ATTRIBUTE_SYNONYMS: dict[str, dict[str, str]] = {
+    "size": {"small": "small", "tiny": "small", "large": "large", "big": "large"},
+    "color": {color: color for color in COLORS} | {"grey": "gray"},
+    "material": {
+        "rubber": "rubber", "matte": "rubber",
+        "metal": "metal", "metallic": "metal", "shiny": "metal",
+    },
+    "shape": {
+        "cube": "cube", "cubes": "cube", "block": "cube", "blocks": "cube",
+        "sphere": "sphere", "spheres": "sphere", "ball": "sphere", "balls": "sphere",
+        "cylinder": "cylinder", "cylinders": "cylinder",
+    },
+}
+# Words that refer to all the objects, with no shape restriction
+GENERIC_OBJECT_WORDS = {"object", "objects", "thing", "things", "item", "items"}
+# Words that may appear in a description of a group of objects without changing it
+IGNORED_WORDS = {"all", "the", "of", "and", "other", "remaining", "a", "an"}
+
+
+@dataclass(frozen=True)
+class ObjectDescription:
+    """
+    A description of a group of CLEVR objects. An attribute that is None matches every value.
+    """
+    size: Optional[str] = None
+    color: Optional[str] = None
+    material: Optional[str] = None
+    shape: Optional[str] = None
+
+    @classmethod
+    def parse(cls, text: str) -> Optional["ObjectDescription"]:
+        """
+        Parse a description such as 'small gray metal cubes' or 'big purple matte things'.
+        Returns None if the text contains a word that is not a CLEVR attribute, or contradicting attributes.
+        """
+        words = re.findall(r"[a-z]+", text.lower())
+        if not words:
+            return None
+
+        attributes: dict[str, str] = {}
+        for word in words:
+            if word in IGNORED_WORDS or word in GENERIC_OBJECT_WORDS:
+                continue
+            for attribute_name, synonyms in ATTRIBUTE_SYNONYMS.items():
+                if word in synonyms:
+                    value = synonyms[word]
+                    if attributes.get(attribute_name, value) != value:
+                        return None
+                    attributes[attribute_name] = value
+                    break
+            else:
+                return None
+        return cls(**attributes)
+
+    @property
+    def specified_attributes(self) -> dict[str, str]:
+        return {
+            attribute.name: getattr(self, attribute.name)
+            for attribute in fields(self)
+            if getattr(self, attribute.name) is not None
+        }
+
+    @property
+    def is_all_objects(self) -> bool:
+        return not self.specified_attributes
+
+    def includes(self, other: "ObjectDescription") -> bool:
+        """
+        Whether every object that matches other also matches this description, e.g. 'balls' includes 'red balls'.
+        """
+        return all(getattr(other, name) == value for name, value in self.specified_attributes.items())
+
+    def is_disjoint(self, other: "ObjectDescription") -> bool:
+        """
+        Whether no object can match both descriptions, e.g. 'red balls' and 'blue objects'.
+        """
+        return any(
+            getattr(other, name) is not None and getattr(other, name) != value
+            for name, value in self.specified_attributes.items()
+        )
+
+    def intersection(self, other: "ObjectDescription") -> Optional["ObjectDescription"]:
+        """
+        The description of the objects that match both descriptions, or None if there are no such objects.
+        """
+        if self.is_disjoint(other):
+            return None
+        return ObjectDescription(**(other.specified_attributes | self.specified_attributes))
+
+    def matches(self, scene_object: dict) -> bool:
+        """
+        Whether an object from the CLEVR scenes annotations matches this description.
+        """
+        return all(scene_object.get(name) == value for name, value in self.specified_attributes.items())
+
+    def __str__(self) -> str:
+        words = [value for value in (self.size, self.color, self.material, self.shape) if value is not None]
+        if self.shape is None:
+            words.append("object")
+        return " ".join(words)
+
+
+def describe_scene(image_scene: list[dict]) -> str:
+    """
+    Describe the objects of a CLEVR scene, one object per line, e.g. 'large red metal sphere'.
+    """
+    return SCENE_DESCRIPTION_HEADER + "".join(
+        f"{scene_object['size']} {scene_object['color']} {scene_object['material']} {scene_object['shape']}\n"
+        for scene_object in image_scene
+    )
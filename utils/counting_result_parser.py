@@ -0,0 +1,119 @@
+"""
+Module for parsing the counting results of the ObjectsCounter into structured counts.
+
+The counting result is an ordered list, with an entry for each object from the objects list, e.g.:
+'1. small gray metal cubes: 1 small gray metal/shiny cube. Total: 1
+2. gray metal objects: 1 small gray metal/shiny cube, 1 large gray metal/shiny ball. Total: 2
+3. objects: 3'
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+from utils.clevr_objects import ObjectDescription
+
+ENTRY_PATTERN = re.compile(r"^\W*\d+\s*[.)]\s*(?P<name>[^:]+?)\s*:\s*(?P<details>.*?)\W*$")
+TOTAL_PATTERN = re.compile(r"total\s*:?\s*(\d+)", re.IGNORECASE)
+COUNT_ONLY_PATTERN = re.compile(r"^(\d+)$")
+NOT_PRESENT_PATTERN = re.compile(r"not present|none|no such", re.IGNORECASE)
+
+
+@dataclass
+class CountingEntry:
+    name: str
+    description: Optional[ObjectDescription]
+    count: Optional[int]
+    # The description of the counted objects, e.g. '1 small gray metal/shiny cube, 1 large gray metal/shiny ball'
+    details: str = ""
+
+
+@dataclass
+class ParsedCountingResult:
+    """
+    The counts of a counting result, by the object descriptions from the objects list.
+    """
+    entries: list[CountingEntry] = field(default_factory=list)
+    total_objects: Optional[int] = None
+
+    @property
+    def counts(self) -> dict[ObjectDescription, int]:
+        counts = {
+            entry.description: entry.count
+            for entry in self.entries
+            if entry.description is not None and entry.count is not None
+        }
+        if self.total_objects is not None:
+            counts[ObjectDescription()] = self.total_objects
+        return counts
+
+    @property
+    def is_complete(self) -> bool:
+        """
+        Whether every entry was parsed into an object description and a count.
+        """
+        return bool(self.entries) and all(
+            entry.description is not None and entry.count is not None for entry in self.entries
+        )
+
+    def get_count(self, description: Optional[ObjectDescription]) -> Optional[int]:
+        """
+        Get the count of the objects that match the description. A None description matches no objects.
+        Returns None if the description was not counted.
+        """
+        if description is None:
+            return 0
+        return self.counts.get(description)
+
+    def is_consistent(self) -> bool:
+        """
+        Check that the counts do not contradict each other: the count of a category can't be larger than the count
+        of a category that includes it, or than the total number of objects.
+        """
+        counts = self.counts
+        for description, count in counts.items():
+            for other_description, other_count in counts.items():
+                if description.includes(other_description) and other_count > count:
+                    return False
+        return True
+
+
+def parse_counting_entry(line: str) -> Optional[CountingEntry]:
+    match = ENTRY_PATTERN.match(line.strip())
+    if match is None:
+        return None
+
+    name = match.group("name").strip(" '\"*")
+    details = match.group("details")
+    total_match = TOTAL_PATTERN.findall(details)
+    count_only_match = COUNT_ONLY_PATTERN.match(details.strip(" .'\"*"))
+    if total_match:
+        count = int(total_match[-1])
+    elif count_only_match:
+        count = int(count_only_match.group(1))
+    elif NOT_PRESENT_PATTERN.search(details):
+        count = 0
+    else:
+        count = None
+
+    return CountingEntry(name=name, description=ObjectDescription.parse(name), count=count, details=details)
+
+
+def parse_counting_result(counting_result: Optional[str]) -> ParsedCountingResult:
+    """
+    Parse the counting result text into the count of each object description in it.
+    The entry that counts all the objects ('objects: 9') is used as the total number of objects.
+    """
+    parsed_result = ParsedCountingResult()
+    if not counting_result:
+        return parsed_result
+
+    for line in counting_result.strip().strip("'\"").splitlines():
+        entry = parse_counting_entry(line)
+        if entry is None:
+            continue
+        if entry.description is not None and entry.description.is_all_objects:
+            parsed_result.total_objects = entry.count
+        else:
+            parsed_result.entries.append(entry)
+
+    return parsed_result
@@ -0,0 +1,74 @@
+"""
+Module for the dead letters file: the questions that failed, with the data they were solved from and their error.
+
+Every failed question is appended as a JSON line, so the file is safe to write from several threads, and the rest of
+the run continues. The questions are re-driven later with `python twostagegpt.py retry-dead-letters --stage <stage>`.
+"""
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Union
+
+from data_enums.dead_letter_enum import DeadLetterEnum
+from data_enums.error_category_enum import ErrorCategoryEnum
+from gpt_clients.errors import GptRequestError, classify_error
+
+
+class DeadLetters:
+    """
+    The dead letters JSONL file.
+    """
+
+    def __init__(self, file_path: Union[str, Path]):
+        self.file_path = Path(file_path)
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, question_index: int, question_data: dict, error: Exception) -> dict:
+        """
+        Append the failed question to the file, and return its record.
+        """
+        record = {
+            DeadLetterEnum.STAGE: stage,
+            DeadLetterEnum.QUESTION_INDEX: question_index,
+            DeadLetterEnum.QUESTION_DATA: question_data,
+            DeadLetterEnum.ERROR_CATEGORY: classify_error(error).value,
+            DeadLetterEnum.ERROR_TYPE: type(error.__cause__ or error).__name__,
+            DeadLetterEnum.ERROR: str(error),
+            DeadLetterEnum.ATTEMPTS: error.attempts if isinstance(error, GptRequestError) else 1,
+            DeadLetterEnum.TIME: time.time(),
+        }
+        # Questions data that isn't json serializable (e.g. dataset rows with images) is saved as strings
+        line = json.dumps(record, default=str)
+        with self._lock, open(self.file_path, "a") as f:
+            f.write(line + "\n")
+        return record
+
+    def load(self) -> list[dict]:
+        if not self.file_path.exists():
+            return []
+        with open(self.file_path, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def select(self, stage: str, categories: set[ErrorCategoryEnum]) -> list[dict]:
+        """
+        The records of the stage with the given error categories.
+        """
+        return [
+            record for record in self.load()
+            if record[DeadLetterEnum.STAGE] == stage
+            and ErrorCategoryEnum(record[DeadLetterEnum.ERROR_CATEGORY]) in categories
+        ]
+
+    def remove(self, records: list[dict]):
+        """
+        Remove the records from the file, e.g. after they were retried.
+        The file must not be written by a running stage at the same time.
+        """
+        if not records:
+            return
+        with self._lock:
+            remaining_records = [record for record in self.load() if record not in records]
+            with open(self.file_path, "w") as f:
+                for record in remaining_records:
+                    f.write(json.dumps(record) + "\n")
@@ -0,0 +1,154 @@
+"""
+Module for a cache of the descriptions of the objects in the images, shared by all the experiments.
+
+A description is cached per image and per source (e.g. a GPT detection or the CLEVR scene annotations), so an image
+is described once per source, however many questions or experiments use it. Images are keyed by the hash of their
+content, so the same image is found under any path. Every description is saved with the fingerprint of how it was
+created (e.g. the prompt and the model), and a description with a different fingerprint is created again.
+
+The cache is a SQLite database on the local disk, with an in-memory copy of the descriptions that were used.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+from data_enums.description_source_enum import DescriptionSourceEnum
+from utils import metrics
+
+CREATE_TABLES_QUERY = """
+CREATE TABLE IF NOT EXISTS descriptions (
+    image_key TEXT NOT NULL,
+    source TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    description TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (image_key, source)
+);
+"""
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def get_description_fingerprint(*parts) -> str:
+    """
+    The fingerprint of how a description is created, from everything that changes it (e.g. the prompt and the model).
+    """
+    return hashlib.sha256("\n".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+class DescriptionCache:
+    """
+    The descriptions of the images objects, by the image content hash and the description source.
+    It can be used from several threads, and several processes on the same machine.
+    """
+
+    def __init__(self, db_path: Union[str, Path], busy_timeout_seconds: float = 60):
+        self.db_path = Path(db_path)
+        self.busy_timeout_seconds = busy_timeout_seconds
+        self.hits: int = 0
+        self.misses: int = 0
+        self._descriptions: dict[tuple[str, str], tuple[str, str]] = {}
+        # The content hash of every image path, with the modification time and size it was computed for
+        self._image_keys: dict[str, tuple[int, int, str]] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        connection = self.get_connection()
+        # The cache is on the local disk, so WAL can be used, and the readers don't block the writer
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(CREATE_TABLES_QUERY)
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, timeout=self.busy_timeout_seconds, isolation_level=None)
+        # A description that is lost in a crash is only created again, so the commits don't wait for the disk
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def get_connection(self) -> sqlite3.Connection:
+        """
+        The connection of the current thread, that is opened once and reused.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self.connect()
+            self._local.connection = connection
+        return connection
+
+    def get_image_key(self, image_path: Union[str, Path]) -> str:
+        """
+        The key of the image: the hash of its content, or its file name when the image is not on the disk (e.g. the
+        image path of a results file from another machine). CLEVR image names are unique in their split.
+        """
+        image_path = str(image_path)
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return f"name:{Path(image_path).name}"
+
+        cached_key = self._image_keys.get(image_path)
+        if cached_key is not None and cached_key[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached_key[2]
+
+        content_hash = hashlib.sha256()
+        with open(image_path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                content_hash.update(chunk)
+        image_key = f"sha256:{content_hash.hexdigest()}"
+        self._image_keys[image_path] = (stat.st_mtime_ns, stat.st_size, image_key)
+        return image_key
+
+    def get(self, image_path: Union[str, Path], source: DescriptionSourceEnum, fingerprint: str) -> Optional[str]:
+        """
+        The cached description of the image from the source, or None if it was not cached with this fingerprint.
+        """
+        key = (self.get_image_key(image_path), source.value)
+        cached = self._descriptions.get(key)
+        if cached is None:
+            row = self.get_connection().execute(
+                "SELECT fingerprint, description FROM descriptions WHERE image_key = ? AND source = ?", key
+            ).fetchone()
+            if row is not None:
+                cached = (row[0], row[1])
+                self._descriptions[key] = cached
+
+        hit = cached is not None and cached[0] == fingerprint
+        metrics.record_cache_lookup(cache="description", hit=hit)
+        with self._lock:
+            if hit:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        return None
+
+    def put(self, image_path: Union[str, Path], source: DescriptionSourceEnum, fingerprint: str, description: str):
+        """
+        Cache the description of the image from the source, replacing a description with another fingerprint.
+        """
+        key = (self.get_image_key(image_path), source.value)
+        self.get_connection().execute(
+            "INSERT OR REPLACE INTO descriptions (image_key, source, fingerprint, description, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (*key, fingerprint, description, time.time())
+        )
+        self._descriptions[key] = (fingerprint, description)
+
+    def get_or_create(
+            self,
+            image_path: Union[str, Path],
+            source: DescriptionSourceEnum,
+            fingerprint: str,
+            create: Callable[[], str]
+    ) -> str:
+        """
+        The cached description of the image from the source, or a new description from create, that is cached.
+        """
+        description = self.get(image_path=image_path, source=source, fingerprint=fingerprint)
+        if description is None:
+            description = create()
+            self.put(image_path=image_path, source=source, fingerprint=fingerprint, description=description)
+        return description
+
+    def get_stats(self) -> dict[str, int]:
+        return {"description_cache_hits": self.hits, "description_cache_misses": self.misses}
@@ -0,0 +1,342 @@
+"""
+Module for validating the object detections in the results files against the CLEVR scenes annotations.
+
+The detections are the counting results of the ObjectsCounter ('1. red balls: 1 large red metal/shiny ball.
+Total: 1') and the detection results of the SimpleObjectDetector ('There are 2 large shiny spheres, 1 small matte
+cube, and 3 objects in total.'). Every detection is parsed into counted groups of objects and the individually
+described objects, and all the detections of a results file are compared with their scenes at once: the scene
+objects, the groups and the described objects are encoded as arrays of attribute indices, so the true count of every
+group, and whether every described object is in its scene, are a few array operations over the whole file.
+
+The validation fills the detection_validation, explanation, number_of_objects and error_types fields of the results.
+"""
+import argparse
+import json
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from conf.data_config import DataConfig
+from data_enums.clevr_descriptions_enum import ClevrDescriptionsEnum
+from data_enums.detection_error_type_enum import DetectionErrorTypeEnum
+from data_enums.image_data_enum import ImageDataEnum
+from utils.clevr_objects import COLORS, MATERIALS, SHAPES, SIZES, ObjectDescription
+from utils.counting_result_parser import parse_counting_result
+
+ATTRIBUTES = ("size", "color", "material", "shape")
+ATTRIBUTE_VALUES = (SIZES, COLORS, MATERIALS, SHAPES)
+# The code of an attribute that is not specified, and matches every value
+ANY_VALUE = -1
+# A described object, e.g. '1 small gray metal/shiny cube' or '2 large matte cylinders (yellow and teal)'
+DESCRIBED_OBJECTS_PATTERN = re.compile(r"(\d+)\s+([a-z][a-z/\- ]*?)\s*(?:\([^)]*\))?\s*(?=,|;|\.|\band\b|$)")
+DETECTION_TOTAL_PATTERN = re.compile(r"(\d+) objects in total", re.IGNORECASE)
+# The details of a counting entry that are not described objects
+COUNTING_DETAILS_IGNORED_PATTERN = re.compile(r"total\s*:?\s*\d+", re.IGNORECASE)
+
+
+@dataclass
+class ParsedDetection:
+    """
+    The counted groups of objects of a detection, and the objects it described individually.
+    """
+    # The name, the description and the count of every group, e.g. ("balls", ObjectDescription(shape="sphere"), 2)
+    groups: list[tuple[str, ObjectDescription, int]] = field(default_factory=list)
+    # The group index and the description of every described object (an object described as '2 ...' appears twice)
+    described_objects: list[tuple[int, ObjectDescription]] = field(default_factory=list)
+    total_objects: Optional[int] = None
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.groups and self.total_objects is None
+
+
+@dataclass
+class ValidationSummary:
+    validated: int = 0
+    correct: int = 0
+    # Detections that were kept, since they were already validated (e.g. manually)
+    kept: int = 0
+    missing_scene: int = 0
+    unparsed: int = 0
+    error_types: Counter = field(default_factory=Counter)
+
+
+def parse_described_objects(text: str) -> list[ObjectDescription]:
+    """
+    Parse the objects described in the text, e.g. '1 small gray metal/shiny cube, 2 large red balls'.
+    A description with a word that is not a CLEVR attribute (e.g. 'medium' or 'teal') is skipped.
+    """
+    described_objects = []
+    for count, description_text in DESCRIBED_OBJECTS_PATTERN.findall(text.lower()):
+        description = ObjectDescription.parse(description_text)
+        if description is not None and not description.is_all_objects:
+            described_objects.extend([description] * int(count))
+    return described_objects
+
+
+def parse_counting_result_detection(counting_result: Optional[str]) -> ParsedDetection:
+    """
+    Parse a counting result of the ObjectsCounter: every entry is a group, and its details describe its objects.
+    """
+    parsed_counting_result = parse_counting_result(counting_result)
+    parsed_detection = ParsedDetection(total_objects=parsed_counting_result.total_objects)
+    for entry in parsed_counting_result.entries:
+        if entry.description is None or entry.count is None:
+            continue
+        group_index = len(parsed_detection.groups)
+        parsed_detection.groups.append((entry.name, entry.description, entry.count))
+        details = COUNTING_DETAILS_IGNORED_PATTERN.sub("", entry.details)
+        parsed_detection.described_objects.extend(
+            (group_index, described_object) for described_object in parse_described_objects(details)
+        )
+    return parsed_detection
+
+
+def parse_detection_result(detection_result: Optional[str]) -> ParsedDetection:
+    """
+    Parse a detection result of the SimpleObjectDetector: every described group ('2 large shiny spheres') is a
+    group, and its objects are described by the group description. The colors in parentheses are ignored.
+    """
+    parsed_detection = ParsedDetection()
+    if not detection_result:
+        return parsed_detection
+
+    total_match = DETECTION_TOTAL_PATTERN.search(detection_result)
+    if total_match is not None:
+        parsed_detection.total_objects = int(total_match.group(1))
+        detection_result = detection_result[:total_match.start()]
+    for count, description_text in DESCRIBED_OBJECTS_PATTERN.findall(detection_result.lower()):
+        description = ObjectDescription.parse(description_text)
+        if description is not None and not description.is_all_objects:
+            group_index = len(parsed_detection.groups)
+            parsed_detection.groups.append((description_text, description, int(count)))
+            parsed_detection.described_objects.extend([(group_index, description)] * int(count))
+    return parsed_detection
+
+
+def parse_detection(question_result: dict) -> Optional[ParsedDetection]:
+    """
+    Parse the detection of the question result, or None if the result has no detection.
+    """
+    if ImageDataEnum.COUNTING_RESULT in question_result:
+        return parse_counting_result_detection(question_result[ImageDataEnum.COUNTING_RESULT])
+    if ImageDataEnum.DETECTION_RESULT in question_result:
+        return parse_detection_result(question_result[ImageDataEnum.DETECTION_RESULT])
+    return None
+
+
+def encode_description(description: ObjectDescription) -> list[int]:
+    """
+    The attribute indices of the description, with ANY_VALUE for the attributes it doesn't specify.
+    """
+    return [
+        values.index(getattr(description, attribute)) if getattr(description, attribute) is not None else ANY_VALUE
+        for attribute, values in zip(ATTRIBUTES, ATTRIBUTE_VALUES)
+    ]
+
+
+def encode_scenes(scenes_objects: list[list[dict]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Encode the objects of the scenes as an array of attribute indices of shape
+    (number of scenes, max number of objects, number of attributes), and a mask of the objects that exist.
+    """
+    max_objects = max((len(scene_objects) for scene_objects in scenes_objects), default=0)
+    encoded_scenes = np.full((len(scenes_objects), max_objects, len(ATTRIBUTES)), ANY_VALUE, dtype=np.int8)
+    exists = np.zeros((len(scenes_objects), max_objects), dtype=bool)
+    for scene_index, scene_objects in enumerate(scenes_objects):
+        for object_index, scene_object in enumerate(scene_objects):
+            encoded_scenes[scene_index, object_index] = [
+                values.index(scene_object[attribute]) for attribute, values in zip(ATTRIBUTES, ATTRIBUTE_VALUES)
+            ]
+        exists[scene_index, :len(scene_objects)] = True
+    return encoded_scenes, exists
+
+
+def count_mismatches(scene_objects: np.ndarray, descriptions: np.ndarray) -> np.ndarray:
+    """
+    The number of attributes every scene object doesn't match, for every description.
+    scene_objects has the shape (n, max number of objects, number of attributes), and descriptions (n, number of
+    attributes). Returns an array of shape (n, max number of objects).
+    """
+    descriptions = descriptions[:, None, :]
+    return ((scene_objects != descriptions) & (descriptions != ANY_VALUE)).sum(axis=2)
+
+
+class DetectionValidator:
+    """
+    Validates the detections of the results files against the objects of the CLEVR scenes annotations.
+    """
+
+    def __init__(self, scenes: list[dict]):
+        self.scenes_objects: dict[str, list[dict]] = {
+            scene[ClevrDescriptionsEnum.IMAGE_ID]: scene[ClevrDescriptionsEnum.OBJECTS] for scene in scenes
+        }
+
+    @classmethod
+    def from_scenes_file(cls, scenes_file: Path) -> "DetectionValidator":
+        with open(scenes_file, "r") as f:
+            return cls(scenes=json.load(f)[ClevrDescriptionsEnum.SCENES])
+
+    def validate(self, results: dict[str, dict], overwrite: bool = False) -> ValidationSummary:
+        """
+        Validate the detections of the results, and fill their validation fields in place.
+        Detections that were already validated (e.g. manually) are kept, unless overwrite is set.
+        """
+        summary = ValidationSummary()
+        question_indices, detections, scenes_objects = [], [], []
+        for question_index, question_result in results.items():
+            if question_result.get(ImageDataEnum.DETECTION_VALIDATION) is not None and not overwrite:
+                summary.kept += 1
+                continue
+            detection = parse_detection(question_result)
+            if detection is None or detection.is_empty:
+                summary.unparsed += 1
+                continue
+            scene_objects = self.scenes_objects.get(question_result[ImageDataEnum.IMAGE_ID])
+            if scene_objects is None:
+                summary.missing_scene += 1
+                continue
+            question_indices.append(question_index)
+            detections.append(detection)
+            scenes_objects.append(scene_objects)
+
+        for question_index, validation in zip(question_indices, self.compare(detections, scenes_objects)):
+            results[question_index].update(validation)
+            summary.validated += 1
+            summary.correct += validation[ImageDataEnum.DETECTION_VALIDATION]
+            summary.error_types.update(validation[ImageDataEnum.ERROR_TYPES])
+        return summary
+
+    @staticmethod
+    def compare(detections: list[ParsedDetection], scenes_objects: list[list[dict]]) -> list[dict]:
+        """
+        Compare every detection with the objects of its scene, and return the validation fields of every detection.
+        """
+        encoded_scenes, exists = encode_scenes(scenes_objects)
+        group_detections = np.array(
+            [detection_index for detection_index, detection in enumerate(detections) for _ in detection.groups],
+            dtype=np.int64
+        )
+        groups = np.array(
+            [encode_description(description) for detection in detections for _, description, _ in detection.groups],
+            dtype=np.int8
+        ).reshape(-1, len(ATTRIBUTES))
+        reported_counts = np.array(
+            [count for detection in detections for _, _, count in detection.groups], dtype=np.int64
+        )
+        group_offsets = np.cumsum([0] + [len(detection.groups) for detection in detections])
+        object_groups = np.array(
+            [
+                group_offsets[detection_index] + group_index
+                for detection_index, detection in enumerate(detections)
+                for group_index, _ in detection.described_objects
+            ],
+            dtype=np.int64
+        )
+        described_objects = np.array(
+            [
+                encode_description(description)
+                for detection in detections
+                for _, description in detection.described_objects
+            ],
+            dtype=np.int8
+        ).reshape(-1, len(ATTRIBUTES))
+
+        # The true count of every group
+        group_matches = (count_mismatches(encoded_scenes[group_detections], groups) == 0) & exists[group_detections]
+        true_counts = group_matches.sum(axis=1)
+        wrong_groups = reported_counts != true_counts
+
+        # Every described object is in its scene, differs from a scene object by a single attribute, or is not in
+        # the scene at all, and either belongs to the group it was counted in or not
+        object_detections = group_detections[object_groups]
+        object_mismatches = np.where(
+            exists[object_detections], count_mismatches(encoded_scenes[object_detections], described_objects), 99
+        )
+        min_mismatches = object_mismatches.min(axis=1, initial=99)
+        group_descriptions = groups[object_groups]
+        in_group = (
+            (described_objects == group_descriptions)
+            | (group_descriptions == ANY_VALUE)
+            | (described_objects == ANY_VALUE)
+        ).all(axis=1)
+
+        def any_object_per_group(object_flags: np.ndarray) -> np.ndarray:
+            group_flags = np.zeros(len(groups), dtype=bool)
+            np.logical_or.at(group_flags, object_groups, object_flags)
+            return group_flags
+
+        grouping_errors = wrong_groups & any_object_per_group(~in_group)
+        feature_errors = wrong_groups & ~grouping_errors & any_object_per_group(min_mismatches == 1)
+        hallucination_errors = wrong_groups & ~grouping_errors & any_object_per_group(min_mismatches > 1)
+        counting_errors = wrong_groups & ~(grouping_errors | feature_errors | hallucination_errors)
+
+        validations = []
+        for detection_index, detection in enumerate(detections):
+            number_of_objects = len(scenes_objects[detection_index])
+            error_types = set()
+            explanations = []
+            for group_index in range(group_offsets[detection_index], group_offsets[detection_index + 1]):
+                if not wrong_groups[group_index]:
+                    continue
+                name = detection.groups[group_index - group_offsets[detection_index]][0]
+                explanations.append(f"{name}: counted {reported_counts[group_index]}, "
+                                    f"the scene has {true_counts[group_index]}")
+                for error_type, errors in (
+                        (DetectionErrorTypeEnum.GROUPING, grouping_errors),
+                        (DetectionErrorTypeEnum.FEATURE_IDENTIFICATION, feature_errors),
+                        (DetectionErrorTypeEnum.HALLUCINATION, hallucination_errors),
+                        (DetectionErrorTypeEnum.COUNTING, counting_errors),
+                ):
+                    if errors[group_index]:
+                        error_types.add(error_type)
+            if detection.total_objects is not None and detection.total_objects != number_of_objects:
+                explanations.append(f"objects: counted {detection.total_objects}, the scene has {number_of_objects}")
+                error_types.add(DetectionErrorTypeEnum.COUNTING)
+
+            validations.append({
+                ImageDataEnum.DETECTION_VALIDATION: not explanations,
+                ImageDataEnum.VALIDATION_EXPLANATION: "; ".join(explanations),
+                ImageDataEnum.NUMBER_OF_OBJECTS: number_of_objects,
+                ImageDataEnum.ERROR_TYPES: sorted(error_type.value for error_type in error_types),
+            })
+        return validations
+
+
+def format_summary(results_file: Path, summary: ValidationSummary) -> str:
+    error_types = ", ".join(f"{error_type}: {count}" for error_type, count in summary.error_types.most_common())
+    return (f"{results_file}: validated {summary.validated} detections, {summary.correct} correct"
+            f"{f' ({error_types})' if error_types else ''}. Kept {summary.kept} validated detections, "
+            f"{summary.missing_scene} without a scene, {summary.unparsed} without a detection.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the object detections of results files against the "
+                                                 "CLEVR scenes annotations, and save the validation in the files.")
+    parser.add_argument("results_files", type=Path, nargs="+", help="The results files to validate.")
+    parser.add_argument("--scenes", type=Path, default=DataConfig().clevr_val_scenes,
+                        help="The CLEVR scenes file of the images of the results.")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Validate again the detections that were already validated (e.g. manually).")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the summary, without saving the files.")
+    args = parser.parse_args()
+
+    validator = DetectionValidator.from_scenes_file(args.scenes)
+    for results_file in args.results_files:
+        start_time = time.perf_counter()
+        with open(results_file, "r") as f:
+            results = json.load(f)
+        summary = validator.validate(results, overwrite=args.overwrite)
+        if not args.dry_run:
+            with open(results_file, "w") as f:
+                json.dump(results, f)
+        print(f"{format_summary(results_file, summary)} ({time.perf_counter() - start_time:.2f} seconds)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,142 @@
-"""Module for logging"""
+"""Module for logging
+
+The loggers only put the records on a queue, and a listener thread formats them and writes them to the console and
+files, so logging never blocks the request path on I/O. The log file and the per-request log are JSON lines.
+Fields set with log_context (e.g. the question index and stage) are added to every record logged in that context,
+from threads and asyncio tasks alike.
+"""
+import atexit
+import json
 import logging
+import queue
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from typing import Optional
 
+REQUEST_LOGGER_NAME = "gpt_requests"
+# The attributes every LogRecord has, that are not extra fields of the record
+LOG_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
 
-def init_logger(file_name: str, level=logging.INFO, init_file_handler=False):
-    logger = logging.getLogger()
-    logger.setLevel(level)
+_log_context: ContextVar[dict] = ContextVar("log_context", default={})
+_queue_listeners: list[QueueListener] = []
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Add the fields to every record that is logged in this context.
+    """
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class LogContextFilter(logging.Filter):
+    """
+    Adds the fields of the current log context to the record. It runs in the thread (or task) that logs the record,
+    before the record is put on the queue.
+    """
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats the record as a JSON object, with its extra fields.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update({key: value for key, value in vars(record).items() if key not in LOG_RECORD_ATTRIBUTES})
+        return json.dumps(data, default=str)
+
+
+def get_request_logger() -> logging.Logger:
+    """
+    The logger of the GPT requests, that writes one JSON line per request to the per-request log.
+    """
+    return logging.getLogger(REQUEST_LOGGER_NAME)
+
+
+def stop_queue_listeners():
+    """
+    Write the records that are still on the queues and stop the listener threads.
+    """
+    while _queue_listeners:
+        _queue_listeners.pop().stop()
 
-    # Remove existing handlers if present to avoid duplication
-    for handler in logger.handlers:
+
+def attach_queue_handler(logger: logging.Logger, handlers: list[logging.Handler]):
+    # Copy the handlers list, since removing handlers while iterating over logger.handlers skips some of them
+    for handler in list(logger.handlers):
         logger.removeHandler(handler)
+        handler.close()
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    logger.addHandler(queue_handler)
+
+    queue_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    queue_listener.start()
+    _queue_listeners.append(queue_listener)
+
+
+def init_logger(
+        file_name: str,
+        level=logging.INFO,
+        init_file_handler=False,
+        request_log_file: Optional[str] = None
+):
+    """
+    Initialize the root logger, and the GPT requests logger.
+    The requests are logged to request_log_file, by default the file name with a .requests.jsonl suffix. The file is
+    created only when the first request is logged, and appended to, so the commands that send no requests (e.g. the
+    queue status) and the other processes that log to the same file (e.g. the queue workers) don't truncate it.
+    """
+    stop_queue_listeners()
+
+    logger = logging.getLogger()
+    logger.setLevel(level)
 
     # create console handler with a higher log level
     ch = logging.StreamHandler()
     ch.setLevel(level)
     # create formatter and add it to the handlers
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    # add the handlers to the logger
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    handlers: list[logging.Handler] = [ch]
 
-    # create file handler which logs even debug messages
+    # create file handler which logs even debug messages, as JSON lines
     if init_file_handler:
         fh = logging.FileHandler(file_name, mode='w')
         fh.setLevel(logging.DEBUG)
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
+        fh.setFormatter(JsonFormatter())
+        handlers.append(fh)
+
+    attach_queue_handler(logger, handlers)
+
+    if request_log_file is None:
+        request_log_file = str(Path(file_name).with_suffix(".requests.jsonl"))
+    request_logger = get_request_logger()
+    request_logger.setLevel(logging.INFO)
+    request_logger.propagate = False
+    request_handler = logging.FileHandler(request_log_file, mode='a', delay=True)
+    request_handler.setFormatter(JsonFormatter())
+    attach_queue_handler(request_logger, [request_handler])
 
     return logger
+
+
+atexit.register(stop_queue_listeners)
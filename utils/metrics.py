@@ -0,0 +1,249 @@
+"""
+Module for live metrics of a run, served over HTTP in the Prometheus text format.
+
+The solvers and the GPT clients update counters and gauges (e.g. requests in flight, completed questions, tokens,
+retries and cache lookups) that are kept in memory, and are rendered only when the endpoint is scraped, so a
+long-running sweep can be watched (and its concurrency tuned) while it runs. Metrics are recorded only when they are
+enabled (`python twostagegpt.py --metrics-port <port> <command>`), and otherwise cost a single check.
+
+The counters are cumulative, so rates are computed by the scraper, e.g. the completed questions per second of every
+stage: `rate(twostagegpt_questions_total{outcome="solved"}[1m])`.
+"""
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Optional
+
+from data_enums.image_data_enum import ImageDataEnum
+
+REQUESTS_IN_FLIGHT = "twostagegpt_requests_in_flight"
+REQUESTS_WAITING = "twostagegpt_requests_waiting"
+REQUESTS_TOTAL = "twostagegpt_requests_total"
+REQUEST_SECONDS_TOTAL = "twostagegpt_request_seconds_total"
+TOKENS_TOTAL = "twostagegpt_tokens_total"
+RETRIES_TOTAL = "twostagegpt_retries_total"
+RETRY_WAIT_SECONDS_TOTAL = "twostagegpt_retry_wait_seconds_total"
+QUESTIONS_TOTAL = "twostagegpt_questions_total"
+ANSWERS_TOTAL = "twostagegpt_answers_total"
+CORRECT_ANSWERS_TOTAL = "twostagegpt_correct_answers_total"
+ACCURACY = "twostagegpt_accuracy"
+CACHE_LOOKUPS_TOTAL = "twostagegpt_cache_lookups_total"
+CACHE_HIT_RATIO = "twostagegpt_cache_hit_ratio"
+QUEUE_QUESTIONS = "twostagegpt_queue_questions"
+
+# The type and help of every metric
+METRICS: dict[str, tuple[str, str]] = {
+    REQUESTS_IN_FLIGHT: ("gauge", "GPT requests that were sent and not answered yet."),
+    REQUESTS_WAITING: ("gauge", "GPT requests waiting for the concurrency limit of their backend."),
+    REQUESTS_TOTAL: ("counter", "GPT requests by their outcome (success or the error category)."),
+    REQUEST_SECONDS_TOTAL: ("counter", "Total latency of the GPT requests."),
+    TOKENS_TOTAL: ("counter", "Prompt and completion tokens of the GPT requests, as reported by the backend."),
+    RETRIES_TOTAL: ("counter", "Retries of GPT requests, by the error that was retried."),
+    RETRY_WAIT_SECONDS_TOTAL: ("counter", "Time spent waiting before retrying GPT requests (rate limit waits)."),
+    QUESTIONS_TOTAL: ("counter", "Questions of every stage that were solved or failed."),
+    ANSWERS_TOTAL: ("counter", "Answered questions of every stage, by the question template."),
+    CORRECT_ANSWERS_TOTAL: ("counter", "Correctly answered questions of every stage, by the question template."),
+    ACCURACY: ("gauge", "Running accuracy of every stage, by the question template."),
+    CACHE_LOOKUPS_TOTAL: ("counter", "Cache lookups, by the cache and whether they hit."),
+    CACHE_HIT_RATIO: ("gauge", "Hit ratio of every cache."),
+    QUEUE_QUESTIONS: ("gauge", "Questions in the work queues, by their status."),
+}
+
+Labels = tuple[tuple[str, str], ...]
+# A metric sample: the metric name, its labels and its value
+Sample = tuple[str, Labels, float]
+
+
+def get_labels(labels: dict) -> Labels:
+    return tuple((name, str(value)) for name, value in labels.items())
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped_labels = (
+        (name, value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for name, value in labels
+    )
+    return "{" + ",".join(f"{name}=\"{value}\"" for name, value in escaped_labels) + "}"
+
+
+class MetricsRegistry:
+    """
+    The values of the metrics of all the threads, by metric name and labels. Collectors add samples that are computed
+    only when the metrics are rendered, e.g. the depth of a work queue.
+    """
+
+    def __init__(self):
+        self._values: dict[str, dict[Labels, float]] = defaultdict(dict)
+        self._lock = threading.Lock()
+        self._collectors: list[Callable[[], Iterable[Sample]]] = []
+
+    def add(self, name: str, value: float, **labels):
+        key = get_labels(labels)
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._values[name][get_labels(labels)] = value
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], Iterable[Sample]]):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def get_value(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._values[name].get(get_labels(labels), 0)
+
+    def collect(self) -> dict[str, dict[Labels, float]]:
+        """
+        The samples of all the metrics, with the derived ratios and the samples of the collectors.
+        """
+        with self._lock:
+            samples = {name: dict(values) for name, values in self._values.items()}
+            collectors = list(self._collectors)
+
+        samples[ACCURACY] = {
+            labels: samples.get(CORRECT_ANSWERS_TOTAL, {}).get(labels, 0) / answers
+            for labels, answers in samples.get(ANSWERS_TOTAL, {}).items() if answers > 0
+        }
+        cache_lookups: dict[Labels, list[float]] = defaultdict(lambda: [0, 0])
+        for labels, lookups in samples.get(CACHE_LOOKUPS_TOTAL, {}).items():
+            labels_dict = dict(labels)
+            cache_labels = get_labels({"cache": labels_dict["cache"]})
+            cache_lookups[cache_labels][0] += lookups if labels_dict["result"] == "hit" else 0
+            cache_lookups[cache_labels][1] += lookups
+        samples[CACHE_HIT_RATIO] = {labels: hits / lookups for labels, (hits, lookups) in cache_lookups.items()}
+
+        for collector in collectors:
+            for name, labels, value in collector():
+                samples.setdefault(name, {})[labels] = value
+        return samples
+
+    def render(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, values in self.collect().items():
+            if not values:
+                continue
+            metric_type, metric_help = METRICS.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {metric_help}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(f"{name}{format_labels(labels)} {value:g}" for labels, value in sorted(values.items()))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not logged, like the requests of the other endpoints of the run
+        pass
+
+
+class MetricsServer:
+    """
+    Serves the metrics of the registry at http://<host>:<port>/metrics, from a daemon thread.
+    """
+
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = "127.0.0.1"):
+        handler = type("RegistryMetricsRequestHandler", (MetricsRequestHandler,), {"registry": registry})
+        self.http_server = ThreadingHTTPServer((host, port), handler)
+        self.http_server.daemon_threads = True
+        self._thread = threading.Thread(target=self.http_server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        return self.http_server.server_address[1]
+
+    def close(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        self._thread.join()
+
+
+_registry: Optional[MetricsRegistry] = None
+
+
+def enable_metrics() -> MetricsRegistry:
+    global _registry
+    _registry = MetricsRegistry()
+    return _registry
+
+
+def disable_metrics():
+    global _registry
+    _registry = None
+
+
+def get_registry() -> Optional[MetricsRegistry]:
+    return _registry
+
+
+def serve_metrics(port: int, host: str = "127.0.0.1") -> MetricsServer:
+    """
+    Enable the metrics, and serve them on the port (0 for any free port).
+    """
+    registry = _registry if _registry is not None else enable_metrics()
+    return MetricsServer(registry=registry, port=port, host=host)
+
+
+def add(name: str, value: float = 1, **labels):
+    if _registry is not None:
+        _registry.add(name, value, **labels)
+
+
+def set_gauge(name: str, value: float, **labels):
+    if _registry is not None:
+        _registry.set(name, value, **labels)
+
+
+def add_collector(collector: Callable[[], Iterable[Sample]]):
+    if _registry is not None:
+        _registry.add_collector(collector)
+
+
+def remove_collector(collector: Callable[[], Iterable[Sample]]):
+    if _registry is not None:
+        _registry.remove_collector(collector)
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    if _registry is not None:
+        _registry.add(CACHE_LOOKUPS_TOTAL, 1, cache=cache, result="hit" if hit else "miss")
+
+
+def record_question(stage: str, result: Optional[dict]):
+    """
+    Count a question of the stage as solved (or failed, when there is no result), and count its answer by its
+    template when the stage checks the answers.
+    """
+    if _registry is None:
+        return
+    _registry.add(QUESTIONS_TOTAL, 1, stage=stage, outcome="solved" if result is not None else "failed")
+    if result is None or ImageDataEnum.IS_CORRECT not in result:
+        return
+    template = result.get(ImageDataEnum.TEMPLATE) or "unknown"
+    _registry.add(ANSWERS_TOTAL, 1, stage=stage, template=template)
+    if result[ImageDataEnum.IS_CORRECT]:
+        _registry.add(CORRECT_ANSWERS_TOTAL, 1, stage=stage, template=template)
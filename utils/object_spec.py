@@ -0,0 +1,236 @@
+"""
+Module for compact object specs: a group of CLEVR objects as a bitmask of its allowed attribute values.
+
+Every value of every attribute has a bit (2 sizes, 8 colors, 2 materials and 3 shapes, 15 bits), and a spec allows
+the values whose bits are set, so 'red balls' allows both sizes and materials, only the red color and only the sphere
+shape. Inclusion and intersection of specs are then single bitwise operations.
+
+The objects counter can ask the vision model for an inventory of the objects of the image, grouped only by the
+attributes the objects list refers to (e.g. 'red balls, cylinders' needs the color and the shape), and derive the
+count of every object from the list locally, as the sum of the inventory groups it includes.
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+from utils.clevr_objects import COLORS, MATERIALS, ObjectDescription, SHAPES, SIZES
+
+ATTRIBUTE_VALUES: dict[str, tuple[str, ...]] = {
+    "size": SIZES,
+    "color": COLORS,
+    "material": MATERIALS,
+    "shape": SHAPES,
+}
+
+
+def create_value_bits() -> dict[str, dict[str, int]]:
+    """
+    The bit of every value of every attribute, each attribute in a consecutive range of bits.
+    """
+    value_bits = {}
+    offset = 0
+    for attribute_name, values in ATTRIBUTE_VALUES.items():
+        value_bits[attribute_name] = {value: 1 << (offset + index) for index, value in enumerate(values)}
+        offset += len(values)
+    return value_bits
+
+
+VALUE_BITS = create_value_bits()
+ATTRIBUTE_MASKS = {attribute_name: sum(bits.values()) for attribute_name, bits in VALUE_BITS.items()}
+ALL_OBJECTS_MASK = sum(ATTRIBUTE_MASKS.values())
+
+# The groups of the example in the inventory prompt
+EXAMPLE_GROUPS = (
+    (ObjectDescription(size="small", color="red", material="metal", shape="sphere"), 2),
+    (ObjectDescription(size="large", color="blue", material="rubber", shape="cube"), 1),
+)
+# The marker of a numbered or bulleted list item, e.g. '1. ', '2) ' or '- '
+LIST_MARKER_PATTERN = re.compile(r"^\s*(?:\d+[.)]|[-*])\s+")
+INVENTORY_LINE_PATTERN = re.compile(r"^\W*(?P<count>\d+)\s*x?\s+(?P<group>[a-z][a-z /-]*?)\W*$", re.IGNORECASE)
+NOT_PRESENT = "Not present in the image"
+
+
+@dataclass(frozen=True)
+class ObjectSpec:
+    """
+    A group of CLEVR objects, as the bitmask of the attribute values its objects can have.
+    A spec with no allowed value for some attribute matches no objects.
+    """
+    mask: int = ALL_OBJECTS_MASK
+
+    @classmethod
+    def from_description(cls, description: ObjectDescription) -> "ObjectSpec":
+        mask = ALL_OBJECTS_MASK
+        for attribute_name, value in description.specified_attributes.items():
+            mask &= ~ATTRIBUTE_MASKS[attribute_name] | VALUE_BITS[attribute_name][value]
+        return cls(mask)
+
+    @classmethod
+    def parse(cls, text: str) -> Optional["ObjectSpec"]:
+        """
+        Parse a description such as 'small gray metal cubes' (see ObjectDescription.parse).
+        """
+        description = ObjectDescription.parse(text)
+        return cls.from_description(description) if description is not None else None
+
+    @property
+    def is_empty(self) -> bool:
+        return any(self.mask & attribute_mask == 0 for attribute_mask in ATTRIBUTE_MASKS.values())
+
+    @property
+    def restricted_attributes(self) -> set[str]:
+        """
+        The attributes the spec doesn't allow every value of.
+        """
+        return {
+            attribute_name for attribute_name, attribute_mask in ATTRIBUTE_MASKS.items()
+            if self.mask & attribute_mask != attribute_mask
+        }
+
+    def includes(self, other: "ObjectSpec") -> bool:
+        """
+        Whether every object of other is also an object of this spec, e.g. 'balls' includes 'red balls'.
+        """
+        return other.is_empty or other.mask & ~self.mask == 0
+
+    def intersection(self, other: "ObjectSpec") -> "ObjectSpec":
+        return ObjectSpec(self.mask & other.mask)
+
+    def is_disjoint(self, other: "ObjectSpec") -> bool:
+        return self.intersection(other).is_empty
+
+    def project(self, attribute_names: set[str]) -> "ObjectSpec":
+        """
+        The spec with every value allowed for the attributes that are not in attribute_names.
+        """
+        mask = self.mask
+        for attribute_name, attribute_mask in ATTRIBUTE_MASKS.items():
+            if attribute_name not in attribute_names:
+                mask |= attribute_mask
+        return ObjectSpec(mask)
+
+    def to_description(self) -> Optional[ObjectDescription]:
+        """
+        The description of the spec, or None if it allows several (but not all) values of an attribute.
+        """
+        attributes = {}
+        for attribute_name in self.restricted_attributes:
+            values = [value for value, bit in VALUE_BITS[attribute_name].items() if self.mask & bit]
+            if len(values) != 1:
+                return None
+            attributes[attribute_name] = values[0]
+        return ObjectDescription(**attributes)
+
+    def __str__(self) -> str:
+        description = self.to_description()
+        return str(description) if description is not None else f"{self.mask:#06x}"
+
+
+def parse_objects_list(objects_list: str) -> Optional[list[tuple[str, ObjectSpec]]]:
+    """
+    Canonicalize the objects list of the objects parser (e.g. 'small gray metal cubes, gray metal objects') into the
+    spec of each of its objects. Returns None if an object is not a CLEVR description.
+    """
+    names = [name.strip(" .'\"") for name in objects_list.replace("\n", ",").split(",")]
+    object_specs = []
+    for name in names:
+        if not name:
+            continue
+        object_spec = ObjectSpec.parse(name)
+        if object_spec is None:
+            return None
+        object_specs.append((name, object_spec))
+    return object_specs or None
+
+
+def get_inventory_attributes(object_specs: list[ObjectSpec]) -> list[str]:
+    """
+    The attributes the objects of the image should be grouped by, so the count of every spec can be derived from the
+    groups: the attributes that at least one of the specs restricts, in the order of ATTRIBUTE_VALUES.
+    """
+    restricted_attributes = set().union(*(object_spec.restricted_attributes for object_spec in object_specs))
+    return [attribute_name for attribute_name in ATTRIBUTE_VALUES if attribute_name in restricted_attributes]
+
+
+@dataclass
+class ObjectInventory:
+    """
+    The objects of an image, as the number of objects of each group.
+    """
+    groups: list[tuple[ObjectSpec, int]] = field(default_factory=list)
+
+    @property
+    def total_objects(self) -> int:
+        return sum(count for _, count in self.groups)
+
+    def get_count(self, object_spec: ObjectSpec) -> Optional[int]:
+        """
+        The number of objects of the spec, as the sum of the groups it includes.
+        Returns None if a group is only partly included, e.g. 'red balls' of a 'red objects' group.
+        """
+        count = 0
+        for group, group_count in self.groups:
+            if object_spec.includes(group):
+                count += group_count
+            elif not object_spec.is_disjoint(group):
+                return None
+        return count
+
+    def to_counting_result(self, object_specs: list[tuple[str, ObjectSpec]]) -> str:
+        """
+        The counts of the objects from the objects list, in the format of the counting results of the
+        ObjectsCounter. The last entry is always the total number of objects.
+        """
+        lines = []
+        for name, object_spec in object_specs:
+            if object_spec.mask == ALL_OBJECTS_MASK:
+                continue
+            count = self.get_count(object_spec)
+            details = ", ".join(
+                format_group(group, group_count) for group, group_count in self.groups
+                if group_count > 0 and object_spec.includes(group)
+            )
+            total = f". Total: {count}" if count is not None else ""
+            lines.append(f"{len(lines) + 1}. {name}: {details or NOT_PRESENT}{total}")
+        lines.append(f"{len(lines) + 1}. objects: {self.total_objects}")
+        return "\n".join(lines)
+
+
+def format_group(group: ObjectSpec, count: int) -> str:
+    return f"{count} {group}{'s' if count != 1 else ''}"
+
+
+def format_inventory_example(attribute_names: list[str]) -> str:
+    """
+    An example inventory, grouped by the attributes, e.g. '2 red spheres\n1 blue cube' for the color and the shape.
+    """
+    return "\n".join(
+        format_group(ObjectSpec.from_description(description).project(set(attribute_names)), count)
+        for description, count in EXAMPLE_GROUPS
+    )
+
+
+def parse_object_inventory(response: Optional[str]) -> Optional[ObjectInventory]:
+    """
+    Parse an inventory response, with a group in every line, e.g.:
+    '2 small red spheres
+    1 large blue metal cube'
+    The groups may be list items (e.g. '1. 2 small red spheres'), and the lines that are not counts (e.g. 'Here is
+    the inventory:') are skipped.
+    Returns None if a count is not of a CLEVR description, a CLEVR description has no count (e.g. '2. small gray metal
+    cubes', where the count may be the list marker), or there are no groups.
+    """
+    inventory = ObjectInventory()
+    for line in (response or "").strip().strip("'\"`").splitlines():
+        text = LIST_MARKER_PATTERN.sub("", line).strip()
+        match = INVENTORY_LINE_PATTERN.match(text)
+        if match is None:
+            description = ObjectDescription.parse(text)
+            if description is not None and not description.is_all_objects:
+                return None
+            continue
+        group = ObjectSpec.parse(match.group("group"))
+        if group is None:
+            return None
+        inventory.groups.append((group, int(match.group("count"))))
+    return inventory if inventory.groups else None
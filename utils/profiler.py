@@ -0,0 +1,159 @@
+"""
+Module for a sampling profiler of all the threads of the process, that writes a flamegraph of the run.
+
+A background thread samples the stacks of the other threads at a fixed interval, so the profiled code is not slowed
+down by tracing every call. The samples are saved as folded stacks (the input format of flamegraph.pl, speedscope and
+similar tools) and rendered as an SVG flamegraph.
+"""
+import html
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import FrameType
+from typing import Union
+
+DEFAULT_INTERVAL_SECONDS = 0.005
+SVG_WIDTH = 1200
+SVG_FRAME_HEIGHT = 16
+SVG_FONT_SIZE = 11
+SVG_CHARACTER_WIDTH = 6.5
+
+
+def get_frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+def get_folded_stack(frame: FrameType, thread_name: str) -> str:
+    names = []
+    while frame is not None:
+        names.append(get_frame_name(frame))
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all the threads, except its own, every interval_seconds while it is running.
+    """
+
+    def __init__(self, interval_seconds: float = DEFAULT_INTERVAL_SECONDS):
+        self.interval_seconds = interval_seconds
+        self.samples: Counter = Counter()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _run(self):
+        profiler_thread_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval_seconds):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == profiler_thread_id:
+                    continue
+                self.samples[get_folded_stack(frame, thread_names.get(thread_id, str(thread_id)))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def __enter__(self) -> "SamplingProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def write_folded_stacks(self, file_path: Union[str, Path]):
+        with open(file_path, "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+
+    def write_flamegraph(self, file_path: Union[str, Path], title: str = "Flamegraph"):
+        with open(file_path, "w") as f:
+            f.write(render_flamegraph(self.samples, title=title))
+
+
+def build_stack_tree(samples: Counter) -> dict:
+    """
+    Merge the folded stacks into a tree of frames, where every node holds its number of samples and its children.
+    """
+    root = {"count": 0, "children": {}}
+    for stack, count in samples.items():
+        root["count"] += count
+        node = root
+        for frame_name in stack.split(";"):
+            node = node["children"].setdefault(frame_name, {"count": 0, "children": {}})
+            node["count"] += count
+    return root
+
+
+def get_tree_depth(node: dict) -> int:
+    return 1 + max((get_tree_depth(child) for child in node["children"].values()), default=0)
+
+
+def render_flamegraph(samples: Counter, title: str = "Flamegraph") -> str:
+    """
+    Render the samples as an SVG flamegraph: the width of every frame is its share of the samples, and the frames
+    it called are stacked above it.
+    """
+    root = build_stack_tree(samples)
+    depth = get_tree_depth(root)
+    height = (depth + 1) * SVG_FRAME_HEIGHT
+    total_samples = max(root["count"], 1)
+    rectangles = []
+
+    def render_node(name: str, node: dict, x: float, level: int):
+        width = node["count"] / total_samples * SVG_WIDTH
+        if width < 0.5:
+            return
+        y = height - (level + 1) * SVG_FRAME_HEIGHT
+        label = name
+        if len(name) * SVG_CHARACTER_WIDTH > width:
+            label = name[:max(int(width / SVG_CHARACTER_WIDTH) - 2, 0)]
+        hue = 10 + sum(map(ord, name)) % 40
+        rectangles.append(
+            f'<g><title>{html.escape(name)} ({node["count"]} samples, '
+            f'{node["count"] / total_samples:.1%})</title>'
+            f'<rect x="{x:.2f}" y="{y}" width="{width:.2f}" height="{SVG_FRAME_HEIGHT - 1}" '
+            f'fill="hsl({hue}, 90%, 60%)"/>'
+            f'<text x="{x + 2:.2f}" y="{y + SVG_FRAME_HEIGHT - 4}" font-size="{SVG_FONT_SIZE}">'
+            f'{html.escape(label)}</text></g>'
+        )
+        child_x = x
+        for child_name, child in sorted(node["children"].items()):
+            render_node(child_name, child, child_x, level + 1)
+            child_x += child["count"] / total_samples * SVG_WIDTH
+
+    render_node("all", root, 0, 0)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{SVG_WIDTH}" height="{height + SVG_FRAME_HEIGHT}" '
+        f'font-family="monospace">'
+        f'<text x="{SVG_WIDTH / 2}" y="{SVG_FRAME_HEIGHT - 2}" text-anchor="middle">{html.escape(title)}</text>'
+        f'{"".join(rectangles)}</svg>\n'
+    )
+
+
+def profile_run(function, flamegraph_file: Union[str, Path], interval_seconds: float = DEFAULT_INTERVAL_SECONDS):
+    """
+    Run the function with the sampling profiler, and write the flamegraph (SVG) and the folded stacks
+    (next to it, with a .folded suffix) of the run.
+    """
+    profiler = SamplingProfiler(interval_seconds=interval_seconds)
+    start_time = time.perf_counter()
+    try:
+        with profiler:
+            return function()
+    finally:
+        duration = time.perf_counter() - start_time
+        flamegraph_file = Path(flamegraph_file)
+        profiler.write_folded_stacks(flamegraph_file.with_suffix(".folded"))
+        profiler.write_flamegraph(
+            flamegraph_file,
+            title=f"{sum(profiler.samples.values())} samples in {duration:.1f}s",
+        )
@@ -0,0 +1,10 @@
+"""Module for progress bars"""
+
+
+def tqdm(*args, **kwargs):
+    """
+    A tqdm progress bar. tqdm is imported only when the first progress bar is created, so that importing the
+    experiments modules (e.g. to show the command line help) stays fast.
+    """
+    from tqdm import tqdm as tqdm_progress_bar
+    return tqdm_progress_bar(*args, **kwargs)
@@ -0,0 +1,331 @@
+"""
+Module for generating synthetic CLEVR-math questions from CLEVR scenes, for scale and load tests.
+
+The questions follow the addition, subtraction, subtraction-multihop and adversarial templates of CLEVR-math, with
+the same synonyms (e.g. 'tiny shiny balls'), and their labels are computed exactly from the objects of the scene.
+The generated rows have the fields of the CLEVR-math dataset rows (ClevrMathLabelsEnum), so every solver can solve
+them when DataConfig.synthetic_questions_file points to the generated file. Together with the replay clients of the
+benchmarks, every stage can be load tested with any number of questions and without calling the API.
+
+Run `python twostagegpt.py generate-questions --questions 10000 --output <questions.jsonl>` from the root directory.
+"""
+import argparse
+import json
+import random
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional, Sequence, Union
+
+from data_enums.clevr_descriptions_enum import ClevrDescriptionsEnum
+from data_enums.clevr_math_labels_enum import ClevrMathLabelsEnum
+from data_enums.question_template_enum import QuestionTemplateEnum
+from utils.clevr_objects import COLORS, MATERIALS, SHAPES, SIZES, ObjectDescription
+from utils.object_spec import ObjectSpec
+
+ROOT_DIRECTORY = Path(__file__).parent.parent
+DEFAULT_SCENES_FILE = ROOT_DIRECTORY.joinpath("data", "CLEVR_val_scenes.json")
+DEFAULT_IMAGES_DIRECTORY = ROOT_DIRECTORY.joinpath("data", "images")
+
+# The words of every attribute value in the questions, as in the CLEVR-math questions
+SIZE_WORDS = {"small": ("small", "tiny"), "large": ("large", "big")}
+MATERIAL_WORDS = {"rubber": ("rubber", "matte"), "metal": ("metal", "metallic", "shiny")}
+SHAPE_WORDS = {"cube": ("cubes", "blocks"), "sphere": ("spheres", "balls"), "cylinder": ("cylinders",)}
+GENERIC_OBJECT_WORDS = ("objects", "things")
+MAX_ADDED_OBJECTS = 8
+MIN_RANDOM_SCENE_OBJECTS = 3
+MAX_RANDOM_SCENE_OBJECTS = 10
+
+
+def count_objects(
+        objects: Sequence[ObjectSpec],
+        target: ObjectSpec,
+        subtracted: Sequence[ObjectSpec] = ()
+) -> int:
+    """
+    The number of objects of the target that are not of any of the subtracted groups.
+    """
+    return sum(
+        1 for scene_object in objects
+        if target.includes(scene_object) and not any(group.includes(scene_object) for group in subtracted)
+    )
+
+
+class QuestionGenerator:
+    """
+    Generates CLEVR-math questions about random scenes, with the label computed from the objects of the scene.
+    """
+
+    def __init__(
+            self,
+            scenes: list[dict],
+            images_directory: Path = DEFAULT_IMAGES_DIRECTORY,
+            image_path: Optional[Path] = None,
+            seed: int = 0
+    ):
+        """
+        The image of every question is in images_directory, unless image_path is given, and then all the questions
+        have the same image (e.g. to load test the vision stages without the CLEVR images).
+        """
+        self.rng = random.Random(seed)
+        self.images_directory = images_directory
+        self.image_path = image_path
+        # The image id and objects of every scene that has objects
+        self.scenes: list[tuple[str, list[ObjectDescription]]] = []
+        for scene_index, scene in enumerate(scenes):
+            objects = [
+                ObjectDescription(
+                    size=scene_object["size"],
+                    color=scene_object["color"],
+                    material=scene_object["material"],
+                    shape=scene_object["shape"],
+                )
+                for scene_object in scene[ClevrDescriptionsEnum.OBJECTS]
+            ]
+            if objects:
+                image_id = scene.get(ClevrDescriptionsEnum.IMAGE_ID, f"CLEVR_synthetic_{scene_index:06d}.png")
+                self.scenes.append((image_id, objects))
+        if not self.scenes:
+            raise ValueError("The scenes have no objects to generate questions about.")
+
+    def describe(self, description: ObjectDescription) -> str:
+        """
+        The words of a group of objects in a question, e.g. 'tiny shiny balls' or 'gray things'.
+        """
+        words = []
+        if description.size is not None:
+            words.append(self.rng.choice(SIZE_WORDS[description.size]))
+        if description.color is not None:
+            words.append(description.color)
+        if description.material is not None:
+            words.append(self.rng.choice(MATERIAL_WORDS[description.material]))
+        shape_words = SHAPE_WORDS[description.shape] if description.shape is not None else GENERIC_OBJECT_WORDS
+        words.append(self.rng.choice(shape_words))
+        return " ".join(words)
+
+    def sample_description(self, objects: list[ObjectDescription], in_scene: bool = True) -> ObjectDescription:
+        """
+        A group of objects with 1 to 3 attributes, of an object of the scene or of a random object.
+        """
+        if in_scene:
+            scene_object = self.rng.choice(objects)
+        else:
+            scene_object = ObjectDescription(
+                size=self.rng.choice(SIZES),
+                color=self.rng.choice(COLORS),
+                material=self.rng.choice(MATERIALS),
+                shape=self.rng.choice(SHAPES),
+            )
+        attributes = scene_object.specified_attributes
+        attribute_names = self.rng.sample(sorted(attributes), k=self.rng.randint(1, 3))
+        return ObjectDescription(**{attribute_name: attributes[attribute_name] for attribute_name in attribute_names})
+
+    def generalize(self, description: ObjectDescription) -> ObjectDescription:
+        """
+        A group that includes the description, with some of its attributes removed (e.g. 'cylinders' for 'red
+        cylinders'), or all the objects if it has a single attribute.
+        """
+        attributes = description.specified_attributes
+        if len(attributes) <= 1:
+            return ObjectDescription()
+        attribute_names = self.rng.sample(sorted(attributes), k=self.rng.randint(1, len(attributes) - 1))
+        return ObjectDescription(**{attribute_name: attributes[attribute_name] for attribute_name in attribute_names})
+
+    def generate_addition(self, objects: list[ObjectSpec], descriptions: list[ObjectDescription]) -> tuple[str, int]:
+        added = self.sample_description(descriptions, in_scene=self.rng.random() < 0.75)
+        added_text = self.describe(added)
+        number_of_added = self.rng.randint(1, MAX_ADDED_OBJECTS)
+        if self.rng.random() < 0.3:
+            return f"Add {number_of_added} {added_text}. How many objects exist?", len(objects) + number_of_added
+        query = self.rng.choice(("exist", "are left"))
+        label = count_objects(objects, ObjectSpec.from_description(added)) + number_of_added
+        return f"Add {number_of_added} {added_text}. How many {added_text} {query}?", label
+
+    def generate_subtraction(
+            self,
+            objects: list[ObjectSpec],
+            descriptions: list[ObjectDescription]
+    ) -> tuple[str, int]:
+        subtracted = self.sample_description(descriptions)
+        subtracted_spec = ObjectSpec.from_description(subtracted)
+        subtracted_text = self.describe(subtracted)
+        subtracted_count = count_objects(objects, subtracted_spec)
+        variant = self.rng.random()
+        if variant < 0.35:
+            target = self.generalize(subtracted)
+            label = count_objects(objects, ObjectSpec.from_description(target), subtracted=[subtracted_spec])
+            return f"Subtract all {subtracted_text}. How many {self.describe(target)} are left?", label
+        if variant < 0.7:
+            number_of_subtracted = self.rng.randint(1, subtracted_count)
+            if self.rng.random() < 0.5:
+                return (f"Subtract {number_of_subtracted} {subtracted_text}. How many objects are left?",
+                        len(objects) - number_of_subtracted)
+            return (f"Subtract {number_of_subtracted} {subtracted_text}. How many {subtracted_text} are left?",
+                    subtracted_count - number_of_subtracted)
+        if variant < 0.85:
+            remaining = self.rng.randint(0, subtracted_count - 1)
+            return (f"How many {subtracted_text} must be subtracted to get {remaining} {subtracted_text}?",
+                    subtracted_count - remaining)
+        return f"Subtract all {subtracted_text}. How many objects are left?", len(objects) - subtracted_count
+
+    def generate_subtraction_multihop(
+            self,
+            objects: list[ObjectSpec],
+            descriptions: list[ObjectDescription]
+    ) -> tuple[str, int]:
+        first, second = self.sample_description(descriptions), self.sample_description(descriptions)
+        label = count_objects(
+            objects,
+            ObjectSpec(),
+            subtracted=[ObjectSpec.from_description(first), ObjectSpec.from_description(second)]
+        )
+        return (f"Subtract all {self.describe(first)}. Subtract all {self.describe(second)}. "
+                f"How many objects are left?", label)
+
+    def generate_adversarial(
+            self,
+            objects: list[ObjectSpec],
+            descriptions: list[ObjectDescription]
+    ) -> tuple[str, int]:
+        """
+        Subtract one or two groups, and count only some of the remaining objects: the objects of the shape of the
+        first group, or an unrelated group.
+        """
+        subtracted = [self.sample_description(descriptions)]
+        if self.rng.random() < 0.7:
+            subtracted.append(self.sample_description(descriptions))
+            target = ObjectDescription(shape=subtracted[0].shape or self.rng.choice(SHAPES))
+        else:
+            target = self.sample_description(descriptions, in_scene=self.rng.random() < 0.5)
+        label = count_objects(
+            objects,
+            ObjectSpec.from_description(target),
+            subtracted=[ObjectSpec.from_description(description) for description in subtracted]
+        )
+        operations = " ".join(f"Subtract all {self.describe(description)}." for description in subtracted)
+        return f"{operations} How many {self.describe(target)} are left?", label
+
+    def generate_question(self, template: QuestionTemplateEnum) -> dict:
+        """
+        A question of the template about a random scene, as a CLEVR-math dataset row.
+        """
+        image_id, descriptions = self.rng.choice(self.scenes)
+        objects = [ObjectSpec.from_description(description) for description in descriptions]
+        generate = {
+            QuestionTemplateEnum.ADDITION: self.generate_addition,
+            QuestionTemplateEnum.SUBTRACTION: self.generate_subtraction,
+            QuestionTemplateEnum.SUBTRACTION_MULTIHOP: self.generate_subtraction_multihop,
+            QuestionTemplateEnum.ADVERSARIAL: self.generate_adversarial,
+        }[template]
+        question, label = generate(objects, descriptions)
+        image_path = self.image_path if self.image_path is not None else self.images_directory.joinpath(image_id)
+        return {
+            ClevrMathLabelsEnum.TEMPLATE.value: template.value,
+            ClevrMathLabelsEnum.QUESTION.value: question,
+            ClevrMathLabelsEnum.IMAGE.value: SimpleNamespace(filename=str(image_path)),
+            ClevrMathLabelsEnum.ID.value: image_id,
+            ClevrMathLabelsEnum.LABEL.value: label,
+        }
+
+    def generate(
+            self,
+            number_of_questions: int,
+            templates: Sequence[QuestionTemplateEnum] = tuple(QuestionTemplateEnum)
+    ) -> list[dict]:
+        """
+        The questions, with the templates in turns, so every template has the same number of questions.
+        """
+        return [self.generate_question(templates[index % len(templates)]) for index in range(number_of_questions)]
+
+
+def create_random_scenes(number_of_scenes: int, seed: int = 0) -> list[dict]:
+    """
+    CLEVR scenes with random objects, for generating questions without the CLEVR scenes file.
+    """
+    rng = random.Random(seed)
+    return [
+        {
+            ClevrDescriptionsEnum.IMAGE_ID.value: f"CLEVR_synthetic_{scene_index:06d}.png",
+            ClevrDescriptionsEnum.OBJECTS.value: [
+                {
+                    "size": rng.choice(SIZES),
+                    "color": rng.choice(COLORS),
+                    "material": rng.choice(MATERIALS),
+                    "shape": rng.choice(SHAPES),
+                }
+                for _ in range(rng.randint(MIN_RANDOM_SCENE_OBJECTS, MAX_RANDOM_SCENE_OBJECTS))
+            ],
+        }
+        for scene_index in range(number_of_scenes)
+    ]
+
+
+def save_synthetic_questions(questions: list[dict], file_path: Union[str, Path]):
+    """
+    Save the questions as JSON lines, with the path of the image instead of the image.
+    """
+    with open(file_path, "w") as f:
+        for question in questions:
+            image = question[ClevrMathLabelsEnum.IMAGE.value]
+            f.write(json.dumps({**question, ClevrMathLabelsEnum.IMAGE.value: image.filename}) + "\n")
+
+
+def load_synthetic_questions(file_path: Union[str, Path]) -> list[dict]:
+    """
+    Load the questions of a generated questions file, as CLEVR-math dataset rows (the image has only a filename).
+    """
+    questions = []
+    with open(file_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            question = json.loads(line)
+            question[ClevrMathLabelsEnum.IMAGE.value] = SimpleNamespace(
+                filename=question[ClevrMathLabelsEnum.IMAGE.value]
+            )
+            questions.append(question)
+    return questions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic CLEVR-math questions from CLEVR scenes.")
+    parser.add_argument("--output", type=Path, required=True, help="The generated questions file (JSON lines).")
+    parser.add_argument("--questions", type=int, default=10_000, help="The number of questions to generate.")
+    parser.add_argument("--templates", nargs="+", choices=[template.value for template in QuestionTemplateEnum],
+                        default=[template.value for template in QuestionTemplateEnum])
+    parser.add_argument("--scenes", type=Path, default=DEFAULT_SCENES_FILE, help="The CLEVR scenes file.")
+    parser.add_argument("--random-scenes", type=int, default=None,
+                        help="Generate the questions about this number of random scenes instead of the scenes file.")
+    parser.add_argument("--images-dir", type=Path, default=DEFAULT_IMAGES_DIRECTORY,
+                        help="The directory of the images of the scenes.")
+    parser.add_argument("--image", type=Path, default=None,
+                        help="Use this image for all the questions, instead of the images of the scenes.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.random_scenes is not None:
+        scenes = create_random_scenes(args.random_scenes, seed=args.seed)
+        # The oracle stages read the objects of the images from the scenes file
+        scenes_file = args.output.with_name(f"{args.output.stem}_scenes.json")
+        with open(scenes_file, "w") as f:
+            json.dump({ClevrDescriptionsEnum.SCENES.value: scenes}, f)
+        print(f"Saved the random scenes in {scenes_file}")
+    else:
+        with open(args.scenes, "r") as f:
+            scenes = json.load(f)[ClevrDescriptionsEnum.SCENES.value]
+
+    question_generator = QuestionGenerator(
+        scenes=scenes,
+        images_directory=args.images_dir,
+        image_path=args.image,
+        seed=args.seed,
+    )
+    questions = question_generator.generate(
+        number_of_questions=args.questions,
+        templates=[QuestionTemplateEnum(template) for template in args.templates],
+    )
+    save_synthetic_questions(questions, file_path=args.output)
+    print(f"Saved {len(questions)} questions about {len(question_generator.scenes)} scenes in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
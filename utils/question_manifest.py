@@ -0,0 +1,190 @@
+"""
+Module for the question manifest: the metadata of the questions of a CLEVR-math split, without their images.
+
+Reading a row of the dataset decodes its image, even when only the image path, the template or the label are needed.
+The manifest keeps the fields the solvers use (image id, image path, template, question, label and scene index) in
+columns, built once per split from the dataset columns without decoding any image, and saved as a JSON file, so
+the next runs don't load the dataset at all. Getting the record of a question is then a lookup in the columns.
+"""
+import json
+import sys
+from array import array
+from pathlib import Path
+from typing import Any, Iterable, Mapping, Optional, Union
+
+from data_enums.clevr_math_labels_enum import ClevrMathLabelsEnum
+
+# Change when the format of the manifest file changes, to build the manifests again
+MANIFEST_VERSION = 1
+
+
+def get_scene_index(image_id: str) -> int:
+    """
+    The index of the scene of the image in the CLEVR scenes file, e.g. 0 for CLEVR_val_000000.png.
+    """
+    return int(image_id.split(".")[0].split("_")[-1])
+
+
+class QuestionRecord:
+    """
+    The metadata of a single question.
+    """
+    __slots__ = ("question_index", "image_id", "image_path", "template", "question", "label", "scene_index")
+
+    def __init__(
+            self,
+            question_index: int,
+            image_id: str,
+            image_path: str,
+            template: str,
+            question: str,
+            label: int,
+            scene_index: int
+    ):
+        self.question_index = question_index
+        self.image_id = image_id
+        self.image_path = image_path
+        self.template = template
+        self.question = question
+        self.label = label
+        self.scene_index = scene_index
+
+    def __repr__(self) -> str:
+        return f"QuestionRecord(question_index={self.question_index}, image_id={self.image_id!r}, " \
+               f"template={self.template!r}, question={self.question!r}, label={self.label})"
+
+
+class QuestionManifest:
+    """
+    The metadata of the questions of a split, in columns. The questions are indexed by their index in the split,
+    or by the given question indices when the manifest has only some of the questions of the split.
+    """
+
+    def __init__(
+            self,
+            image_ids: list[str],
+            image_paths: list[str],
+            templates: list[str],
+            questions: list[str],
+            labels: Iterable[int],
+            source: str = "",
+            question_indices: Optional[Iterable[int]] = None
+    ):
+        self.source = source
+        self.image_ids = image_ids
+        self.image_paths = image_paths
+        # There are only a few templates, so all the questions of a template share its string
+        self.templates = [sys.intern(template) for template in templates]
+        self.questions = questions
+        self.labels = array("q", labels)
+        self.scene_indices = array("q", (get_scene_index(image_id) for image_id in image_ids))
+        self.question_indices: Optional[array] = None
+        self._positions: Optional[dict[int, int]] = None
+        if question_indices is not None:
+            self.question_indices = array("q", question_indices)
+            self._positions = {
+                question_index: position for position, question_index in enumerate(self.question_indices)
+            }
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    def __contains__(self, question_index: int) -> bool:
+        if self._positions is not None:
+            return question_index in self._positions
+        return 0 <= question_index < len(self)
+
+    def __getitem__(self, question_index: int) -> QuestionRecord:
+        position = self._positions[question_index] if self._positions is not None else question_index
+        if position < 0:
+            raise IndexError(f"Question index {question_index} is not in the manifest.")
+        return QuestionRecord(
+            question_index=question_index,
+            image_id=self.image_ids[position],
+            image_path=self.image_paths[position],
+            template=self.templates[position],
+            question=self.questions[position],
+            label=self.labels[position],
+            scene_index=self.scene_indices[position],
+        )
+
+    @classmethod
+    def from_rows(
+            cls,
+            rows: Union[list[Mapping[str, Any]], Mapping[int, Mapping[str, Any]]],
+            source: str = ""
+    ) -> "QuestionManifest":
+        """
+        Build the manifest from rows in the format of the CLEVR-math dataset rows (e.g. the generated questions),
+        given as a list, or keyed by their question index.
+        """
+        question_indices = None
+        if isinstance(rows, Mapping):
+            question_indices = [int(question_index) for question_index in rows]
+            rows = list(rows.values())
+        return cls(
+            image_ids=[row[ClevrMathLabelsEnum.ID] for row in rows],
+            image_paths=[str(row[ClevrMathLabelsEnum.IMAGE].filename) for row in rows],
+            templates=[row[ClevrMathLabelsEnum.TEMPLATE] for row in rows],
+            questions=[row[ClevrMathLabelsEnum.QUESTION] for row in rows],
+            labels=[int(row[ClevrMathLabelsEnum.LABEL]) for row in rows],
+            source=source,
+            question_indices=question_indices,
+        )
+
+    @classmethod
+    def from_dataset(cls, dataset, source: str = "") -> "QuestionManifest":
+        """
+        Build the manifest from the columns of a CLEVR-math split (a datasets.Dataset). The image paths are read
+        from the image column as stored, without decoding the images.
+        """
+        image_column = dataset.data.column(ClevrMathLabelsEnum.IMAGE.value)
+        image_paths = [str(path) for chunk in image_column.chunks for path in chunk.field("path").to_pylist()]
+        return cls(
+            image_ids=list(dataset[ClevrMathLabelsEnum.ID.value]),
+            image_paths=image_paths,
+            templates=list(dataset[ClevrMathLabelsEnum.TEMPLATE.value]),
+            questions=list(dataset[ClevrMathLabelsEnum.QUESTION.value]),
+            labels=list(dataset[ClevrMathLabelsEnum.LABEL.value]),
+            source=source,
+        )
+
+    def save(self, file_path: Union[str, Path]):
+        data = {
+            "version": MANIFEST_VERSION,
+            "source": self.source,
+            "image_ids": self.image_ids,
+            "image_paths": self.image_paths,
+            "templates": self.templates,
+            "questions": self.questions,
+            "labels": self.labels.tolist(),
+            "question_indices": self.question_indices.tolist() if self.question_indices is not None else None,
+        }
+        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(file_path, "w") as f:
+            json.dump(data, f)
+
+    @classmethod
+    def load(cls, file_path: Union[str, Path], source: str = "") -> Optional["QuestionManifest"]:
+        """
+        Load a saved manifest. Returns None if there is no manifest file, if it is of another source or version, or if
+        its images are no longer at their paths (e.g. the Hugging Face cache was cleared or moved).
+        """
+        if not Path(file_path).exists():
+            return None
+        with open(file_path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != MANIFEST_VERSION or data.get("source") != source:
+            return None
+        # Checking the first image is enough, since the images of a split are cached together
+        if data["image_paths"] and not Path(data["image_paths"][0]).exists():
+            return None
+        return cls(
+            image_ids=data["image_ids"],
+            image_paths=data["image_paths"],
+            templates=data["templates"],
+            questions=data["questions"],
+            labels=data["labels"],
+            source=source,
+            question_indices=data["question_indices"],
+        )
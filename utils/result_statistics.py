@@ -0,0 +1,338 @@
+"""
+Module for statistical comparison of experiment results.
+
+All the experiments are evaluated on the same sampled questions, so their results can be compared as paired
+samples. The results are first converted to a boolean correctness matrix of shape
+(number of experiments, number of questions), and all the resampling is done on that matrix at once:
+a bootstrap resample is represented by a vector of multinomial counts over the questions, so the accuracy of every
+experiment on every resample is a single matrix product.
+"""
+import argparse
+import itertools
+import json
+import math
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional, Sequence, Union
+
+import numpy as np
+
+from data_enums.image_data_enum import ImageDataEnum
+
+DEFAULT_NUMBER_OF_RESAMPLES = 10_000
+DEFAULT_CONFIDENCE_LEVEL = 0.95
+ALL_TEMPLATES = "all"
+
+
+@dataclass
+class CorrectnessMatrix:
+    """
+    Boolean correctness of several experiments over the same questions.
+    correct[i, j] is True if experiment i answered question j correctly.
+    """
+    experiment_names: list[str]
+    question_indices: list[str]
+    templates: np.ndarray
+    correct: np.ndarray
+
+    def select_template(self, template: str) -> "CorrectnessMatrix":
+        """
+        Return the sub matrix that contains only the questions of the given template.
+        """
+        if template == ALL_TEMPLATES:
+            return self
+        mask = self.templates == template
+        return CorrectnessMatrix(
+            experiment_names=self.experiment_names,
+            question_indices=[index for index, keep in zip(self.question_indices, mask) if keep],
+            templates=self.templates[mask],
+            correct=self.correct[:, mask],
+        )
+
+
+@dataclass
+class ConfidenceInterval:
+    estimate: float
+    lower: float
+    upper: float
+
+
+@dataclass
+class PairedComparison:
+    """
+    The comparison of the accuracy of experiment a against experiment b on the same questions.
+    """
+    experiment_a: str
+    experiment_b: str
+    template: str
+    number_of_questions: int
+    accuracy_a: ConfidenceInterval
+    accuracy_b: ConfidenceInterval
+    accuracy_difference: ConfidenceInterval
+    paired_bootstrap_p_value: float
+    only_a_correct: int
+    only_b_correct: int
+    mcnemar_p_value: float
+
+
+def build_correctness_matrix(
+        results_by_experiment: dict[str, dict[str, dict]],
+        question_indices: Optional[Sequence[str]] = None
+) -> CorrectnessMatrix:
+    """
+    Build the correctness matrix of the given experiments results.
+    Only the questions that appear in all the experiments (or in question_indices, if given) are used.
+    """
+    experiment_names = list(results_by_experiment.keys())
+    if question_indices is None:
+        common_keys = set.intersection(*(set(results.keys()) for results in results_by_experiment.values()))
+        question_indices = sorted(common_keys, key=int)
+    question_indices = [str(question_index) for question_index in question_indices]
+
+    first_results = results_by_experiment[experiment_names[0]]
+    templates = np.array(
+        [first_results[question_index].get(ImageDataEnum.TEMPLATE) for question_index in question_indices]
+    )
+    correct = np.array(
+        [
+            [results[question_index].get(ImageDataEnum.IS_CORRECT) is True for question_index in question_indices]
+            for results in results_by_experiment.values()
+        ],
+        dtype=bool,
+    ).reshape(len(experiment_names), len(question_indices))
+
+    return CorrectnessMatrix(
+        experiment_names=experiment_names,
+        question_indices=question_indices,
+        templates=templates,
+        correct=correct,
+    )
+
+
+def draw_resample_weights(
+        number_of_questions: int,
+        number_of_resamples: int = DEFAULT_NUMBER_OF_RESAMPLES,
+        seed: Optional[int] = None
+) -> np.ndarray:
+    """
+    Draw the bootstrap resamples as a (number_of_resamples, number_of_questions) matrix, where each row counts
+    how many times each question was drawn in that resample.
+    The same weights must be used for all the experiments being compared, to keep the resamples paired.
+    """
+    rng = np.random.default_rng(seed)
+    probabilities = np.full(number_of_questions, 1 / number_of_questions)
+    return rng.multinomial(number_of_questions, probabilities, size=number_of_resamples).astype(np.float32)
+
+
+def bootstrap_accuracies(correct: np.ndarray, resample_weights: np.ndarray) -> np.ndarray:
+    """
+    Compute the accuracy of every experiment on every resample.
+    Returns a matrix of shape (number of experiments, number of resamples).
+    """
+    number_of_questions = correct.shape[-1]
+    return np.atleast_2d(correct).astype(np.float32) @ resample_weights.T / number_of_questions
+
+
+def percentile_interval(
+        estimate: float,
+        resampled_values: np.ndarray,
+        confidence_level: float = DEFAULT_CONFIDENCE_LEVEL
+) -> ConfidenceInterval:
+    alpha = 1 - confidence_level
+    lower, upper = np.quantile(resampled_values, [alpha / 2, 1 - alpha / 2])
+    return ConfidenceInterval(estimate=float(estimate), lower=float(lower), upper=float(upper))
+
+
+def bootstrap_confidence_intervals(
+        correct: np.ndarray,
+        number_of_resamples: int = DEFAULT_NUMBER_OF_RESAMPLES,
+        confidence_level: float = DEFAULT_CONFIDENCE_LEVEL,
+        seed: Optional[int] = None
+) -> list[ConfidenceInterval]:
+    """
+    Compute a percentile bootstrap confidence interval for the accuracy of each experiment (row) of correct.
+    """
+    correct = np.atleast_2d(correct)
+    resample_weights = draw_resample_weights(correct.shape[-1], number_of_resamples=number_of_resamples, seed=seed)
+    resampled_accuracies = bootstrap_accuracies(correct=correct, resample_weights=resample_weights)
+    return [
+        percentile_interval(estimate=row.mean(), resampled_values=resampled, confidence_level=confidence_level)
+        for row, resampled in zip(correct, resampled_accuracies)
+    ]
+
+
+def paired_bootstrap_p_value(resampled_differences: np.ndarray) -> float:
+    """
+    Two-sided p-value for the null hypothesis that the accuracy difference is 0, given its bootstrap distribution.
+    """
+    number_of_resamples = resampled_differences.shape[-1]
+    at_most_zero = np.count_nonzero(resampled_differences <= 0, axis=-1)
+    at_least_zero = np.count_nonzero(resampled_differences >= 0, axis=-1)
+    return float(min(1.0, 2 * min(at_most_zero, at_least_zero) / number_of_resamples))
+
+
+def mcnemar_test(only_a_correct: int, only_b_correct: int, exact_threshold: int = 25) -> float:
+    """
+    McNemar test on the discordant pairs: the questions only experiment a answered correctly, and the questions only
+    experiment b answered correctly.
+    When there are only a few discordant pairs, the exact binomial test is used. Otherwise, the chi-square
+    approximation with continuity correction is used.
+    Returns the two-sided p-value.
+    """
+    discordant = only_a_correct + only_b_correct
+    if discordant == 0:
+        return 1.0
+
+    if discordant <= exact_threshold:
+        smaller = min(only_a_correct, only_b_correct)
+        tail = sum(math.comb(discordant, k) for k in range(smaller + 1)) / 2 ** discordant
+        return min(1.0, 2 * tail)
+
+    statistic = (abs(only_a_correct - only_b_correct) - 1) ** 2 / discordant
+    # The survival function of the chi-square distribution with 1 degree of freedom
+    return math.erfc(math.sqrt(statistic / 2))
+
+
+def compare_experiments(
+        matrix: CorrectnessMatrix,
+        pairs: Optional[Sequence[tuple[str, str]]] = None,
+        templates: Optional[Sequence[str]] = None,
+        number_of_resamples: int = DEFAULT_NUMBER_OF_RESAMPLES,
+        confidence_level: float = DEFAULT_CONFIDENCE_LEVEL,
+        seed: Optional[int] = None
+) -> list[PairedComparison]:
+    """
+    Compare the accuracy of each pair of experiments, overall and per template.
+    For every template the resample weights are drawn once and shared by all the experiments and pairs,
+    so the whole comparison is a handful of matrix products.
+    """
+    if pairs is None:
+        pairs = list(itertools.combinations(matrix.experiment_names, 2))
+    if not pairs:
+        raise ValueError(f"At least two experiments are required to compare, got {list(matrix.experiment_names)}.")
+    if templates is None:
+        templates = [ALL_TEMPLATES] + sorted(set(matrix.templates.tolist()) - {None})
+
+    experiment_positions = {name: position for position, name in enumerate(matrix.experiment_names)}
+    rng = np.random.default_rng(seed)
+    comparisons = []
+
+    for template in templates:
+        sub_matrix = matrix.select_template(template)
+        correct = sub_matrix.correct
+        number_of_questions = correct.shape[1]
+        if number_of_questions == 0:
+            continue
+
+        resample_weights = draw_resample_weights(
+            number_of_questions=number_of_questions,
+            number_of_resamples=number_of_resamples,
+            seed=int(rng.integers(2 ** 32)),
+        )
+        resampled_accuracies = bootstrap_accuracies(correct=correct, resample_weights=resample_weights)
+        accuracies = correct.mean(axis=1)
+
+        a_positions = np.array([experiment_positions[a] for a, _ in pairs])
+        b_positions = np.array([experiment_positions[b] for _, b in pairs])
+        resampled_differences = resampled_accuracies[a_positions] - resampled_accuracies[b_positions]
+        only_a_correct = np.count_nonzero(correct[a_positions] & ~correct[b_positions], axis=1)
+        only_b_correct = np.count_nonzero(~correct[a_positions] & correct[b_positions], axis=1)
+
+        for pair_index, (a, b) in enumerate(pairs):
+            a_position, b_position = experiment_positions[a], experiment_positions[b]
+            comparisons.append(PairedComparison(
+                experiment_a=a,
+                experiment_b=b,
+                template=template,
+                number_of_questions=number_of_questions,
+                accuracy_a=percentile_interval(
+                    accuracies[a_position], resampled_accuracies[a_position], confidence_level
+                ),
+                accuracy_b=percentile_interval(
+                    accuracies[b_position], resampled_accuracies[b_position], confidence_level
+                ),
+                accuracy_difference=percentile_interval(
+                    accuracies[a_position] - accuracies[b_position],
+                    resampled_differences[pair_index],
+                    confidence_level,
+                ),
+                paired_bootstrap_p_value=paired_bootstrap_p_value(resampled_differences[pair_index]),
+                only_a_correct=int(only_a_correct[pair_index]),
+                only_b_correct=int(only_b_correct[pair_index]),
+                mcnemar_p_value=mcnemar_test(int(only_a_correct[pair_index]), int(only_b_correct[pair_index])),
+            ))
+
+    return comparisons
+
+
+def get_experiment_name(file_path: Path) -> str:
+    """
+    The name of the experiment of a results file: its directory and file name without the suffix, so the results of
+    the same experiment on different sets (e.g. test_set_results/one_step_gpt_results) have different names.
+    """
+    if file_path.parent.name:
+        return f"{file_path.parent.name}/{file_path.stem}"
+    return file_path.stem
+
+
+def load_results_files(file_paths: Sequence[Union[str, Path]]) -> dict[str, dict[str, dict]]:
+    """
+    Load the results files, keyed by their experiment names.
+    """
+    results_by_experiment = {}
+    for file_path in file_paths:
+        file_path = Path(file_path)
+        experiment_name = get_experiment_name(file_path)
+        if experiment_name in results_by_experiment:
+            raise ValueError(f"Two results files have the experiment name {experiment_name}, e.g. {file_path}.")
+        with open(file_path, "r") as f:
+            results_by_experiment[experiment_name] = json.load(f)
+    return results_by_experiment
+
+
+def format_comparison(comparison: PairedComparison) -> str:
+    def interval(ci: ConfidenceInterval) -> str:
+        return f"{ci.estimate:.3f} [{ci.lower:.3f}, {ci.upper:.3f}]"
+
+    return (
+        f"{comparison.template:<22} {comparison.experiment_a} vs {comparison.experiment_b} "
+        f"(n={comparison.number_of_questions}): "
+        f"acc a={interval(comparison.accuracy_a)}, acc b={interval(comparison.accuracy_b)}, "
+        f"diff={interval(comparison.accuracy_difference)}, "
+        f"paired bootstrap p={comparison.paired_bootstrap_p_value:.4f}, "
+        f"McNemar p={comparison.mcnemar_p_value:.4f} "
+        f"(only a: {comparison.only_a_correct}, only b: {comparison.only_b_correct})"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the accuracy of experiments results files.")
+    parser.add_argument("results_files", nargs="+", help="The results files to compare (at least two).")
+    parser.add_argument("--resamples", type=int, default=DEFAULT_NUMBER_OF_RESAMPLES)
+    parser.add_argument("--confidence-level", type=float, default=DEFAULT_CONFIDENCE_LEVEL)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", type=Path, default=None, help="Save the comparisons as a json file.")
+    args = parser.parse_args()
+
+    if len(args.results_files) < 2:
+        parser.error("At least two results files are required.")
+
+    matrix = build_correctness_matrix(load_results_files(args.results_files))
+    comparisons = compare_experiments(
+        matrix=matrix,
+        number_of_resamples=args.resamples,
+        confidence_level=args.confidence_level,
+        seed=args.seed,
+    )
+    if not comparisons:
+        print("The results files have no questions in common.")
+    for comparison in comparisons:
+        print(format_comparison(comparison))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump([asdict(comparison) for comparison in comparisons], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+Module for lightweight tracing of the stages of solving a question.
+
+The code is instrumented with spans (e.g. loading, image encoding, messages building, network, rate limit waits,
+answer extraction and saving the results). Spans are recorded only when tracing is enabled, and otherwise cost a
+single check. The recorded spans can be exported as a Chrome trace (chrome://tracing, Perfetto) or as OTLP JSON.
+"""
+import functools
+import itertools
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator, Optional, Union
+
+from utils import metrics
+from utils.logger import log_context
+
+SPAN_LOAD = "load"
+SPAN_IMAGE_ENCODE = "image_encode"
+SPAN_MESSAGE_BUILD = "message_build"
+SPAN_QUEUE_WAIT = "queue_wait"
+SPAN_NETWORK = "network"
+SPAN_RATE_LIMIT_WAIT = "rate_limit_wait"
+SPAN_EXTRACTION = "extraction"
+SPAN_PERSIST = "persist"
+SPAN_QUESTION = "question"
+
+SERVICE_NAME = "twostagegpt"
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    trace_id: str
+    parent_span_id: Optional[str]
+    start_time_ns: int
+    thread_id: int
+    end_time_ns: Optional[int] = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+
+class Tracer:
+    """
+    Records the spans of all the threads. The spans of a question share a trace id, and nested spans point to
+    their parent span.
+    """
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+        self._current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+        self._span_ids = itertools.count(1)
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        parent = self._current_span.get()
+        span = Span(
+            name=name,
+            span_id=f"{next(self._span_ids):016x}",
+            trace_id=parent.trace_id if parent is not None else secrets.token_hex(16),
+            parent_span_id=parent.span_id if parent is not None else None,
+            start_time_ns=time.time_ns(),
+            thread_id=threading.get_ident(),
+            attributes=attributes,
+        )
+        token = self._current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.attributes["error"] = repr(e)
+            raise
+        finally:
+            span.end_time_ns = time.time_ns()
+            self._current_span.reset(token)
+            with self._lock:
+                self.spans.append(span)
+
+    def add_span(self, name: str, start_time_ns: int, end_time_ns: int, **attributes):
+        """
+        Record a span that was measured without a context manager, e.g. the time a question waited in a queue.
+        """
+        parent = self._current_span.get()
+        span = Span(
+            name=name,
+            span_id=f"{next(self._span_ids):016x}",
+            trace_id=parent.trace_id if parent is not None else secrets.token_hex(16),
+            parent_span_id=parent.span_id if parent is not None else None,
+            start_time_ns=start_time_ns,
+            end_time_ns=end_time_ns,
+            thread_id=threading.get_ident(),
+            attributes=attributes,
+        )
+        with self._lock:
+            self.spans.append(span)
+
+    def to_chrome_trace(self) -> dict:
+        """
+        The spans in the Chrome trace event format, as complete events with microseconds timestamps.
+        """
+        process_id = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": span.name,
+                    "cat": span.attributes.get("stage", SERVICE_NAME),
+                    "ph": "X",
+                    "ts": span.start_time_ns / 1000,
+                    "dur": (span.end_time_ns - span.start_time_ns) / 1000,
+                    "pid": process_id,
+                    "tid": span.thread_id,
+                    "args": {key: str(value) for key, value in span.attributes.items()},
+                }
+                for span in self.spans
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def to_otlp_json(self) -> dict:
+        """
+        The spans in the OTLP JSON format (an ExportTraceServiceRequest), that OpenTelemetry collectors accept.
+        """
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [get_otlp_attribute("service.name", SERVICE_NAME)]},
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": SERVICE_NAME},
+                            "spans": [
+                                {
+                                    "traceId": span.trace_id,
+                                    "spanId": span.span_id,
+                                    "parentSpanId": span.parent_span_id or "",
+                                    "name": span.name,
+                                    "kind": 1,
+                                    "startTimeUnixNano": str(span.start_time_ns),
+                                    "endTimeUnixNano": str(span.end_time_ns),
+                                    "attributes": [
+                                        get_otlp_attribute(key, value) for key, value in span.attributes.items()
+                                    ] + [get_otlp_attribute("thread.id", span.thread_id)],
+                                }
+                                for span in self.spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def export(self, file_path: Union[str, Path], trace_format: str = "chrome"):
+        data = self.to_otlp_json() if trace_format == "otlp" else self.to_chrome_trace()
+        with open(file_path, "w") as f:
+            json.dump(data, f)
+
+
+def get_otlp_attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+_tracer: Optional[Tracer] = None
+
+
+def enable_tracing() -> Tracer:
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable_tracing():
+    global _tracer
+    _tracer = None
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def span(name: str, **attributes):
+    """
+    A span of the given name, or a no-op context manager when tracing is disabled.
+    """
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.span(name, **attributes)
+
+
+def add_span(name: str, start_time_ns: int, end_time_ns: int, **attributes):
+    if _tracer is not None:
+        _tracer.add_span(name, start_time_ns=start_time_ns, end_time_ns=end_time_ns, **attributes)
+
+
+def trace_question(solve_question):
+    """
+    Decorator of the solve_question method of the solvers, that traces every question in its own span, so all the
+    spans of the question share its trace id. The question index and stage are also added to the log records of the
+    question (e.g. the per-request log), and the question is counted in the live metrics of its stage.
+    """
+    @functools.wraps(solve_question)
+    def traced_solve_question(self, question_index: int, question_data: dict) -> dict:
+        stage = type(self).__name__
+        result = None
+        try:
+            with log_context(question_index=question_index, stage=stage):
+                if _tracer is None:
+                    result = solve_question(self, question_index=question_index, question_data=question_data)
+                else:
+                    with _tracer.span(SPAN_QUESTION, stage=stage, question_index=question_index):
+                        result = solve_question(self, question_index=question_index, question_data=question_data)
+            return result
+        finally:
+            metrics.record_question(stage=stage, result=result)
+
+    return traced_solve_question
@@ -0,0 +1,332 @@
+"""
+Module for a durable work queue of questions, backed by a SQLite database.
+
+Several worker processes, on the same machine or on different machines that share the database file over a shared
+filesystem, lease questions from the queue, solve them and save their results in it. A worker keeps its leases alive
+with heartbeats, and the questions of a worker that stopped sending heartbeats (e.g. it crashed or its machine went
+down) are leased again by the other workers once their lease expires. Workers can be added at any point of the run.
+When all the questions are done, the results of all the workers are merged into a single results file.
+
+The lease expiration times are wall clock times, so the clocks of the machines should be synchronized.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from logging import Logger
+from pathlib import Path
+from typing import Callable, Iterator, Optional, Union
+
+from data_enums.error_category_enum import ErrorCategoryEnum
+from data_enums.task_status_enum import TaskStatusEnum
+from gpt_clients.errors import classify_error
+from utils import metrics, tracing
+
+CREATE_TABLES_QUERY = """
+CREATE TABLE IF NOT EXISTS tasks (
+    question_index INTEGER PRIMARY KEY,
+    question_data TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_status_index ON tasks (status, lease_expires_at);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def get_default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class SqliteWorkQueue:
+    """
+    A work queue of questions, keyed by the question index.
+    Every operation is a short transaction on its own connection, so the queue can be used from several threads
+    and processes. The rollback journal is used instead of WAL, since WAL does not work over network filesystems.
+    """
+
+    def __init__(
+            self,
+            db_path: Union[str, Path],
+            lease_seconds: float = 300,
+            max_attempts: int = 3,
+            busy_timeout_seconds: float = 60,
+    ):
+        self.db_path = Path(db_path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.busy_timeout_seconds = busy_timeout_seconds
+        connection = self.connect()
+        try:
+            connection.execute("PRAGMA journal_mode=DELETE")
+            connection.executescript(CREATE_TABLES_QUERY)
+        finally:
+            connection.close()
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=self.busy_timeout_seconds, isolation_level=None)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Open a connection and run the statements in a single write transaction.
+        """
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def set_metadata(self, key: str, value: str):
+        with self.transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", (key, value))
+
+    def get_metadata(self, key: str) -> Optional[str]:
+        with self.transaction() as connection:
+            row = connection.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def enqueue(self, questions: dict[Union[int, str], dict]) -> int:
+        """
+        Add the questions to the queue. Questions that are already in the queue are not added again, so the queue
+        can be initialized more than once.
+        Returns the number of questions that were added.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            cursor = connection.executemany(
+                "INSERT OR IGNORE INTO tasks (question_index, question_data, status, updated_at) VALUES (?, ?, ?, ?)",
+                [
+                    (int(question_index), json.dumps(question_data), TaskStatusEnum.PENDING.value, now)
+                    for question_index, question_data in questions.items()
+                ]
+            )
+            return cursor.rowcount
+
+    def lease(self, worker_id: str, batch_size: int = 1) -> dict[int, dict]:
+        """
+        Lease up to batch_size questions that are pending, or whose lease expired.
+        Questions whose lease expired after their last attempt are marked as failed.
+        Returns the leased questions data by their question index.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = ?, error = ?, updated_at = ? "
+                "WHERE status = ? AND lease_expires_at < ? AND attempts >= ?",
+                (TaskStatusEnum.FAILED.value, "Lease expired", now,
+                 TaskStatusEnum.LEASED.value, now, self.max_attempts)
+            )
+            rows = connection.execute(
+                "SELECT question_index, question_data FROM tasks "
+                "WHERE status = ? OR (status = ? AND lease_expires_at < ?) "
+                "ORDER BY question_index LIMIT ?",
+                (TaskStatusEnum.PENDING.value, TaskStatusEnum.LEASED.value, now, batch_size)
+            ).fetchall()
+            connection.executemany(
+                "UPDATE tasks SET status = ?, worker_id = ?, lease_expires_at = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE question_index = ?",
+                [
+                    (TaskStatusEnum.LEASED.value, worker_id, now + self.lease_seconds, now, question_index)
+                    for question_index, _ in rows
+                ]
+            )
+        return {question_index: json.loads(question_data) for question_index, question_data in rows}
+
+    def heartbeat(self, worker_id: str) -> int:
+        """
+        Extend the leases of all the questions the worker is solving.
+        Returns the number of extended leases.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET lease_expires_at = ?, updated_at = ? WHERE status = ? AND worker_id = ?",
+                (now + self.lease_seconds, now, TaskStatusEnum.LEASED.value, worker_id)
+            )
+            return cursor.rowcount
+
+    def complete(self, question_index: int, worker_id: str, result: dict):
+        """
+        Save the result of the question. If the lease of the worker expired and the question was leased by another
+        worker, the first result that is saved is kept.
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = ?, worker_id = ?, result = ?, error = NULL, updated_at = ? "
+                "WHERE question_index = ? AND status != ?",
+                (TaskStatusEnum.DONE.value, worker_id, json.dumps(result), time.time(),
+                 question_index, TaskStatusEnum.DONE.value)
+            )
+
+    def fail(self, question_index: int, worker_id: str, error: str, retryable: bool = True):
+        """
+        Release the question after a failed attempt. It is retried until it reaches the maximal number of attempts,
+        unless the error is not retryable.
+        """
+        max_attempts = self.max_attempts if retryable else 0
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                "lease_expires_at = NULL, error = ?, updated_at = ? "
+                "WHERE question_index = ? AND status = ? AND worker_id = ?",
+                (max_attempts, TaskStatusEnum.FAILED.value, TaskStatusEnum.PENDING.value, error, time.time(),
+                 question_index, TaskStatusEnum.LEASED.value, worker_id)
+            )
+
+    def retry_failed(self) -> int:
+        """
+        Move the failed questions back to the queue, with a new set of attempts.
+        Returns the number of questions that were moved.
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET status = ?, attempts = 0, updated_at = ? WHERE status = ?",
+                (TaskStatusEnum.PENDING.value, time.time(), TaskStatusEnum.FAILED.value)
+            )
+            return cursor.rowcount
+
+    def get_status_counts(self) -> dict[str, int]:
+        with self.transaction() as connection:
+            rows = connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        counts = {status.value: 0 for status in TaskStatusEnum}
+        counts.update(dict(rows))
+        return counts
+
+    def collect_metrics(self) -> list[metrics.Sample]:
+        """
+        The number of questions in each status, as live metrics samples (counted when the metrics are scraped).
+        """
+        return [
+            (metrics.QUEUE_QUESTIONS, metrics.get_labels({"queue": self.db_path.name, "status": status}), count)
+            for status, count in self.get_status_counts().items()
+        ]
+
+    def has_unfinished_questions(self) -> bool:
+        counts = self.get_status_counts()
+        return counts[TaskStatusEnum.PENDING.value] + counts[TaskStatusEnum.LEASED.value] > 0
+
+    def get_results(self) -> dict[int, dict]:
+        """
+        The results of all the questions that are done, by their question index.
+        """
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT question_index, result FROM tasks WHERE status = ? ORDER BY question_index",
+                (TaskStatusEnum.DONE.value,)
+            ).fetchall()
+        return {question_index: json.loads(result) for question_index, result in rows}
+
+    def get_failures(self) -> dict[int, str]:
+        with self.transaction() as connection:
+            rows = connection.execute(
+                "SELECT question_index, error FROM tasks WHERE status = ? ORDER BY question_index",
+                (TaskStatusEnum.FAILED.value,)
+            ).fetchall()
+        return dict(rows)
+
+    def merge(self, output_file: Union[str, Path]) -> dict[int, dict]:
+        """
+        Save the results of all the workers in a single results file, in the format of the experiment results files.
+        """
+        results = self.get_results()
+        with open(output_file, "w") as f:
+            json.dump(results, f)
+        return results
+
+
+class LeaseHeartbeat:
+    """
+    Extends the leases of a worker in a background thread, every third of the lease duration, while it is solving
+    questions that may take longer than the lease.
+    """
+
+    def __init__(self, queue: SqliteWorkQueue, worker_id: str, logger: Logger):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.logger = logger
+        self.interval_seconds = queue.lease_seconds / 3
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            try:
+                self.queue.heartbeat(worker_id=self.worker_id)
+            except sqlite3.Error as e:
+                self.logger.warning(f"Failed to send a heartbeat for worker {self.worker_id}: {e}")
+
+    def __enter__(self) -> "LeaseHeartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop_event.set()
+        self._thread.join()
+
+
+def run_worker(
+        queue: SqliteWorkQueue,
+        solve_question: Callable[[int, dict], dict],
+        logger: Logger,
+        worker_id: Optional[str] = None,
+        batch_size: int = 1,
+        poll_interval_seconds: float = 10,
+) -> int:
+    """
+    Lease questions from the queue and solve them until no question is pending or leased.
+    While the remaining questions are leased by other workers, the worker waits in case their leases expire.
+    Returns the number of questions the worker solved.
+    """
+    if worker_id is None:
+        worker_id = get_default_worker_id()
+
+    metrics.add_collector(queue.collect_metrics)
+    solved_questions = 0
+    with LeaseHeartbeat(queue=queue, worker_id=worker_id, logger=logger):
+        while True:
+            questions = queue.lease(worker_id=worker_id, batch_size=batch_size)
+            lease_time_ns = time.time_ns()
+            if not questions:
+                if not queue.has_unfinished_questions():
+                    break
+                time.sleep(poll_interval_seconds)
+                continue
+
+            for question_index, question_data in questions.items():
+                # The time the question waited for the previous questions of the batch
+                tracing.add_span(tracing.SPAN_QUEUE_WAIT, start_time_ns=lease_time_ns, end_time_ns=time.time_ns(),
+                                 question_index=question_index, worker_id=worker_id)
+                try:
+                    result = solve_question(question_index, question_data)
+                except Exception as e:
+                    logger.exception(f"Worker {worker_id} failed to solve question {question_index}: {e}")
+                    queue.fail(
+                        question_index=question_index,
+                        worker_id=worker_id,
+                        error=repr(e),
+                        retryable=classify_error(e) == ErrorCategoryEnum.RETRYABLE,
+                    )
+                    continue
+                queue.complete(question_index=question_index, worker_id=worker_id, result=result)
+                solved_questions += 1
+
+    logger.info(f"Worker {worker_id} finished after solving {solved_questions} questions.")
+    return solved_questions